@@ -1,42 +1,156 @@
 import argparse
+import atexit
 import logging
 import traceback
 import os
+import tempfile
 import requests
 
 from flask import Flask
 from flask import make_response
+from werkzeug.exceptions import HTTPException
 
+from object_detector_backend.blueprints.extensions import init_app, init_worker, shutdown_app
 from object_detector_backend.blueprints.images import images
+from object_detector_backend.blueprints.labels import labels
+from object_detector_backend.blueprints.operations import operations
+from object_detector_backend.util.metrics import clear_snapshots
 
+# gunicorn does not run on windows, which is served by a single process
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
 
-app = Flask(__name__)
-app.register_blueprint(images, url_prefix='/images')
 
-
-@app.errorhandler(Exception)
 def handle_exception(e):
     """Return JSON instead of HTML for HTTP errors."""
+    if isinstance(e, HTTPException):
+        return make_response({'message': e.description}, e.code)
+
     traceback.print_exc()
     response = make_response({
         'message': str(e)}, getattr(e, 'status_code', 500))
     return response
 
-@app.errorhandler(requests.exceptions.HTTPError)
-def handle_exception(e):
-    """User has provided invalid URL"""
+def handle_request_exception(e):
+    """User has provided invalid URL or the image could not be downloaded in time"""
     traceback.print_exc()
     response = make_response({
         'message': str(e)}, getattr(e, 'status_code', 400))
     return response
 
+
+def create_app(config: dict = None) -> Flask:
+    """Application factory. Resources like the database engine are created per process
+    on first use, call init_worker in each serving process to create them up front
+    """
+    app = Flask(__name__)
+    app.config.update(config or {})
+
+    app.register_blueprint(images, url_prefix='/images')
+    app.register_blueprint(labels, url_prefix='/labels')
+    app.register_blueprint(operations)
+    app.register_error_handler(Exception, handle_exception)
+    app.register_error_handler(requests.exceptions.RequestException, handle_request_exception)
+    init_app(app)
+
+    return app
+
+
+app = create_app()
+
+
+if BaseApplication is not None:
+    class GunicornApplication(BaseApplication):
+        """Serves the app with gunicorn worker processes, each building its own app
+        so database connections and detector clients are never shared across a fork
+        """
+        def __init__(self, config: dict, options: dict):
+            self.config_overrides = config
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            worker_app = create_app(self.config_overrides)
+            init_worker(worker_app)
+            return worker_app
+
+
+def worker_exit(server, worker):
+    """gunicorn hook draining detection jobs of a stopping worker
+    """
+    if not(shutdown_app(worker.wsgi)):
+        worker.log.warning('Detection jobs were still running at shutdown')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--cred', required=True, help='Filepath to Google API Auth file')
+    parser.add_argument('--detector', default=app.config['DETECTOR'],
+                        help='Default detector, i.e google or onnx')
+    parser.add_argument('--onnx-model', help='Filepath to ONNX image classification model of the onnx detector')
+    parser.add_argument('--onnx-labels', help='Filepath to class names of the ONNX model, one per line')
+    parser.add_argument('--db', default=app.config['DATABASE_URL'], help='Database connection string')
+    parser.add_argument('--blobs', default=app.config['BLOB_STORE_PATH'], help='Directory of the image blob store')
+    parser.add_argument('--pool-size', type=int, default=app.config['DATABASE_POOL_SIZE'],
+                        help='Number of pooled database connections')
+    parser.add_argument('--max-overflow', type=int, default=app.config['DATABASE_MAX_OVERFLOW'],
+                        help='Connections allowed above the pool size under load')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', 2)),
+                        help='Number of worker processes serving requests')
+    parser.add_argument('--threads', type=int, default=4, help='Request threads per worker')
+    parser.add_argument('--bind', default='0.0.0.0:8080', help='Address to listen on')
+    parser.add_argument('--timeout', type=int, default=60,
+                        help='Seconds a request may take before its worker is restarted')
+    parser.add_argument('--response-cache', action=argparse.BooleanOptionalAction,
+                        help='Cache read responses in each worker, on by default with a single worker only '
+                             'as other workers serve stale responses for up to RESPONSE_CACHE_TTL seconds after a write')
+    parser.add_argument('--metrics-dir',
+                        help='Directory where workers share metrics for GET /metrics, a temporary directory by default')
     args = parser.parse_args()
 
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = args.cred
-    
+
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
-    app.run(host='0.0.0.0', port=8080, debug=True)
+
+    config = {
+        'DATABASE_URL': args.db,
+        'BLOB_STORE_PATH': args.blobs,
+        'DATABASE_POOL_SIZE': args.pool_size,
+        'DATABASE_MAX_OVERFLOW': args.max_overflow,
+        'DETECTOR': args.detector,
+        'RESPONSE_CACHE_ENABLED': args.response_cache if args.response_cache is not None
+                                  else BaseApplication is None or args.workers == 1,
+    }
+    if args.onnx_model:
+        config['DETECTOR_OPTIONS'] = {
+            'onnx': {'model_path': args.onnx_model, 'labels_path': args.onnx_labels}
+        }
+
+    if BaseApplication is None:
+        # single process fallback without the debugger and reloader
+        logging.warning('gunicorn is not installed, serving with one process')
+        app = create_app(config)
+        init_worker(app)
+        atexit.register(shutdown_app, app)
+        host, port = args.bind.rsplit(':', 1)
+        app.run(host=host, port=int(port), debug=False, threaded=True)
+    else:
+        config['METRICS_DIR'] = args.metrics_dir or tempfile.mkdtemp(prefix='object-detector-metrics-')
+        clear_snapshots(config['METRICS_DIR'])
+        GunicornApplication(config, {
+            'bind': args.bind,
+            'workers': args.workers,
+            'worker_class': 'gthread',
+            'threads': args.threads,
+            'timeout': args.timeout,
+            # stopping workers finish in-flight requests and drain detection jobs
+            'graceful_timeout': args.timeout + app.config['SHUTDOWN_TIMEOUT'],
+            'worker_exit': worker_exit,
+        }).run()
@@ -0,0 +1,42 @@
+# gunicorn -c gunicorn.conf.py app:app
+# Google credentials are read from GOOGLE_APPLICATION_CREDENTIALS
+import os
+import tempfile
+
+from object_detector_backend.blueprints.extensions import DEFAULT_CONFIG
+
+bind = os.environ.get('BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 4))
+timeout = 60
+
+# caches of read responses are per worker, after a write the other workers serve stale
+# responses for up to RESPONSE_CACHE_TTL seconds, so they are off with several workers
+response_cache = os.environ.get('RESPONSE_CACHE_ENABLED', '1' if workers == 1 else '0') == '1'
+
+# stopping workers finish in-flight requests, then drain detection jobs in worker_exit
+graceful_timeout = timeout + DEFAULT_CONFIG['SHUTDOWN_TIMEOUT']
+
+
+# workers write snapshots of their metrics here, so GET /metrics reports totals over all of them
+metrics_dir = os.environ.get('METRICS_DIR') or tempfile.mkdtemp(prefix='object-detector-metrics-')
+
+
+def on_starting(server):
+    from object_detector_backend.util.metrics import clear_snapshots
+    clear_snapshots(metrics_dir)
+
+
+def post_worker_init(worker):
+    """Creates the database engine and warms detectors in each worker after it loaded the app
+    """
+    from object_detector_backend.blueprints.extensions import init_worker
+    worker.wsgi.config['METRICS_DIR'] = metrics_dir
+    worker.wsgi.config['RESPONSE_CACHE_ENABLED'] = response_cache
+    init_worker(worker.wsgi)
+
+
+def worker_exit(server, worker):
+    from app import worker_exit as drain_worker
+    drain_worker(server, worker)
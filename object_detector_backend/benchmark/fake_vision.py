@@ -0,0 +1,67 @@
+import hashlib
+import random
+import threading
+import time
+from typing import List
+
+from object_detector_backend.data.vision import Detector
+
+# labels the fake detector picks from, in order of how often they are returned
+VOCABULARY = [
+    'Animal', 'Dog', 'Cat', 'Mammal', 'Carnivore', 'Whale', 'Water', 'Sky', 'Tree', 'Plant',
+    'Building', 'Car', 'Vehicle', 'Person', 'Face', 'Food', 'Fish', 'Bird', 'Flower', 'Grass',
+    'Cloud', 'Road', 'Window', 'Wood', 'Sea', 'Beach', 'Mountain', 'Snow', 'Street', 'Art',
+] + [f'Label {i}' for i in range(970)]
+
+
+class FakeVisionDetector(Detector):
+    """Deterministic stand-in for GoogleVisionAPICaller with injectable latency.
+    The same content always gets the same labels, so runs are reproducible.
+    Each call sleeps latency seconds plus up to jitter seconds and fails with error_rate probability
+    """
+    source = 'Fake Vision'
+    version = 'v1'
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 labels_per_image: int = 5,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.labels_per_image = labels_per_image
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def annotate(self, content) -> list:
+        return self.annotate_batch([content])[0]
+
+    def annotate_batch(self, contents: List[bytes]) -> list:
+        """One simulated round trip for the whole batch
+        """
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+
+        time.sleep(delay)
+        if fail:
+            raise Exception('fake vision call failed')
+
+        return [self._to_labels(content) for content in contents]
+
+    def _to_labels(self, content: bytes) -> list:
+        # skewed towards the start of the vocabulary like real label frequencies
+        rng = random.Random(hashlib.md5(content).hexdigest())
+        labels = set()
+        while len(labels) < self.labels_per_image:
+            labels.add(VOCABULARY[min(int(rng.paretovariate(1.2)) - 1, len(VOCABULARY) - 1)])
+
+        return sorted(({
+            'label': label,
+            'score': round(rng.uniform(0.5, 1.0), 4),
+            'topicality': round(rng.uniform(0.5, 1.0), 4),
+        } for label in sorted(labels)), key=lambda label: label['score'], reverse=True)
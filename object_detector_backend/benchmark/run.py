@@ -0,0 +1,288 @@
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from object_detector_backend.benchmark.fake_vision import VOCABULARY, FakeVisionDetector
+from object_detector_backend.benchmark.seed import seed_database
+from object_detector_backend.blueprints.extensions import get_database, init_worker, shutdown_app
+from object_detector_backend.data.persistence import DatabaseAPI, Images
+from object_detector_backend.data.vision import register_detector
+
+# optional dependency of the upload scenario: pip install pillow
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+SCENARIOS = ('upload', 'list', 'search', 'by_id')
+
+# app.py with the application factory lives in the repository root, next to the package
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest rank percentile of values
+    """
+    if not(values):
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def make_images(count: int, size: int = 64, seed: int = 0) -> List[bytes]:
+    """Distinct random jpeg images, so uploads are neither exact nor near duplicates
+    """
+    if Image is None:
+        raise ImportError('The upload scenario requires pillow to be installed')
+
+    rng = random.Random(seed)
+    contents = []
+    for _ in range(count):
+        image = Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+        out = io.BytesIO()
+        image.save(out, format='JPEG', quality=90)
+        contents.append(out.getvalue())
+
+    return contents
+
+
+class Scenario():
+    """Issues one kind of request against the app, i is the index of the request within the run
+    """
+    def __init__(self, name: str, request: Callable, setup: Callable = None):
+        self.name = name
+        self.request = request
+        self.setup = setup
+
+
+def _sample_images(app, count: int, seed: int) -> List[Images]:
+    with app.app_context():
+        db_api = get_database().api()
+        total = db_api.session.query(Images).count()
+        if total == 0:
+            raise ValueError('Read scenarios need a seeded database, run with rows above 0')
+        rng = random.Random(seed)
+        offsets = sorted(rng.randrange(total) for _ in range(min(count, total)))
+
+        sample = [db_api.session.query(Images.id, Images.created_at)
+                  .order_by(Images.created_at, Images.id).offset(offset).limit(1).one()
+                  for offset in offsets]
+        db_api.session.close()
+        return sample
+
+
+def build_scenarios(app, requests: int, seed: int = 0) -> Dict[str, Scenario]:
+    rng = random.Random(seed)
+    context = {}
+
+    def setup_upload():
+        context['uploads'] = make_images(requests, seed=seed)
+
+    def upload(client, i: int):
+        return client.post('/images', data={
+            'image': (io.BytesIO(context['uploads'][i]), f'bench_{seed}_{i}.jpeg'),
+            'filename': f'bench_{seed}_{i}.jpeg',
+        })
+
+    def setup_reads():
+        if 'sample' not in context:
+            context['sample'] = _sample_images(app, min(requests, 1000), seed)
+            context['params'] = [(rng.choice([20, 50, 100]), rng.random()) for _ in range(requests)]
+
+    def list_page(client, i: int):
+        limit, position = context['params'][i]
+        # start pages at sampled images so listings are not all served from the first page
+        image = context['sample'][int(position * len(context['sample']))]
+        cursor = DatabaseAPI._encode_cursor(image)
+        return client.get('/images', query_string={'limit': limit, 'cursor': cursor})
+
+    def search(client, i: int):
+        _, position = context['params'][i]
+        # labels near the head of the vocabulary match many images, like real queries
+        first = VOCABULARY[int(position * 20)]
+        second = VOCABULARY[int(position * 97) % 30]
+        match = 'all' if i % 2 else 'any'
+        return client.get('/images', query_string={'objects': f'{first},{second}', 'match': match})
+
+    def by_id(client, i: int):
+        image = context['sample'][i % len(context['sample'])]
+        return client.get(f'/images/{image.id}')
+
+    return {
+        'upload': Scenario('upload', upload, setup_upload),
+        'list': Scenario('list', list_page, setup_reads),
+        'search': Scenario('search', search, setup_reads),
+        'by_id': Scenario('by_id', by_id, setup_reads),
+    }
+
+
+def _response_cache_hits(app) -> int:
+    response_cache = app.extensions['database'].response_cache
+    return response_cache.stats().get('hits', 0) if response_cache is not None else 0
+
+
+def run_scenario(app, scenario: Scenario, requests: int, concurrency: int) -> dict:
+    """Sends requests with concurrency threads, each with its own test client.
+    Returns latency percentiles in milliseconds, throughput, the number of failed requests
+    and of responses served from the response cache
+    """
+    if scenario.setup is not None:
+        scenario.setup()
+    hits = _response_cache_hits(app)
+
+    clients = threading.local()
+    latencies = []
+    errors = []
+
+    def send(i: int):
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = app.test_client()
+
+        start = time.perf_counter()
+        resp = scenario.request(client, i)
+        latencies.append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            errors.append(resp.status_code)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'scenario': scenario.name,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'cache_hits': _response_cache_hits(app) - hits,
+        'throughput_rps': round(requests / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def run_benchmark(config: dict,
+                  rows: int,
+                  requests: int,
+                  concurrency: int,
+                  scenarios: List[str] = SCENARIOS,
+                  seed: int = 0) -> dict:
+    """Seeds the database of config with rows images, then runs each scenario against an app built from config.
+    The fake detector is selectable as 'fake' while benchmarking, it is not registered in serving apps.
+    The response cache is off unless config enables it, so read latencies measure the database queries
+    """
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    from app import create_app
+
+    register_detector('fake', FakeVisionDetector)
+    app = create_app({'RESPONSE_CACHE_ENABLED': False, **config})
+    init_worker(app)
+
+    try:
+        start = time.perf_counter()
+        seeded = seed_database(app.extensions['database'], rows, seed=seed)
+        seed_seconds = time.perf_counter() - start
+
+        built = build_scenarios(app, requests, seed=seed)
+        results = []
+        for name in scenarios:
+            logger.info(f'running {name} with {requests} requests at concurrency {concurrency}')
+            results.append(run_scenario(app, built[name], requests, concurrency))
+
+        return {
+            'rows': rows,
+            'seeded': seeded,
+            'seed_seconds': round(seed_seconds, 2),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'scenarios': results,
+        }
+    finally:
+        shutdown_app(app)
+
+
+def format_report(report: dict) -> str:
+    columns = ('scenario', 'requests', 'concurrency', 'errors', 'cache_hits', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+    lines = [f"rows: {report['rows']}, seeded {report['seeded']} in {report['seed_seconds']}s, "
+             f"peak RSS {report['peak_rss_mb']} MB",
+             ' '.join(f'{c:>14}' for c in columns)]
+    for result in report['scenarios']:
+        lines.append(' '.join(f'{result[c]:>14}' for c in columns))
+
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m object_detector_backend.benchmark.run')
+    parser.add_argument('--db', default='sqlite:///benchmark.db',
+                        help='Database connection string, seeded rows are reused across runs')
+    parser.add_argument('--blobs', default='benchmark_blobs', help='Directory of the blob store')
+    parser.add_argument('--rows', type=int, default=1000, help='Images to seed, i.e 1000, 100000 or 1000000')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent requests')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma separated scenarios out of {', '.join(SCENARIOS)}")
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds each fake vision call takes')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Random seconds added to each fake vision call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of fake vision calls failing')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='Serve repeated reads from the response cache, cache hits are reported per scenario')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of generated data and requests')
+    parser.add_argument('--json', help='Write the report as json to this file, i.e to compare runs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
+
+    scenarios = [s.strip() for s in args.scenarios.split(',')]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    report = run_benchmark({
+        'DATABASE_URL': args.db,
+        'BLOB_STORE_PATH': args.blobs,
+        'DATABASE_POOL_SIZE': args.concurrency,
+        'DETECTOR': 'fake',
+        'DETECTORS_WARMUP': ['fake'],
+        'DETECTOR_OPTIONS': {'fake': {
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'error_rate': args.error_rate,
+            'seed': args.seed,
+        }},
+        'RESPONSE_CACHE_ENABLED': args.response_cache,
+    }, rows=args.rows, requests=args.requests, concurrency=args.concurrency,
+        scenarios=scenarios, seed=args.seed)
+
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from object_detector_backend.benchmark.fake_vision import FakeVisionDetector
+from object_detector_backend.data.persistence import Database, Images, Labels, normalize_label
+
+logger = logging.getLogger(__name__)
+
+
+def seed_database(database: Database, rows: int, batch_size: int = 10000, seed: int = 0) -> int:
+    """Bulk inserts rows images labeled by the fake detector, skipping rows already seeded.
+    Contents are not stored, seeded images serve listing, label search and lookups by id.
+    Returns the number of inserted images
+    """
+    db_api = database.api()
+    existing = db_api.session.query(Images).count()
+    if existing >= rows:
+        return 0
+
+    rng = random.Random(seed + existing)
+    detector = FakeVisionDetector(seed=seed)
+    start = datetime.utcnow() - timedelta(seconds=rows)
+    inserted = 0
+
+    with database.engine.begin() as conn:
+        for offset in range(existing, rows, batch_size):
+            images = []
+            labels = []
+
+            for i in range(offset, min(offset + batch_size, rows)):
+                image_id = str(uuid.UUID(int=rng.getrandbits(128)))
+                checksum = f'{rng.getrandbits(128):032x}'
+                images.append({
+                    'id': image_id,
+                    'filename': f'seed_{i}.jpeg',
+                    'filetype': 'jpeg',
+                    'checksum': checksum,
+                    'content_key': checksum,
+                    'phash': f'{rng.getrandbits(64):016x}',
+                    'created_at': start + timedelta(seconds=i),
+                })
+
+                for label in detector._to_labels(checksum.encode()):
+                    labels.append(dict(label,
+                                       id=str(uuid.UUID(int=rng.getrandbits(128))),
+                                       label_normalized=normalize_label(label['label']),
+                                       image_id=image_id,
+                                       source=detector.source))
+
+            conn.execute(Images.__table__.insert(), images)
+            conn.execute(Labels.__table__.insert(), labels)
+            inserted += len(images)
+            logger.info(f'seeded {existing + inserted} of {rows} images')
+
+    # labels were inserted without add_labels, which maintains label statistics
+    db_api.rebuild_label_stats()
+    db_api.session.close()
+    return inserted
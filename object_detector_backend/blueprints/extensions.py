@@ -0,0 +1,445 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, current_app, g, request
+
+from object_detector_backend.data.blobs import BlobStore, LocalBlobStore
+from object_detector_backend.data.cache import AnnotationCache
+from object_detector_backend.data.fetch import ImageFetcher
+from object_detector_backend.data.ingest import ImageNormalizer
+from object_detector_backend.data.jobs import JobQueue, ThreadPoolJobQueue
+from object_detector_backend.data.persistence import Database, DatabaseAPI
+from object_detector_backend.data.response_cache import MemoryResponseCache, ResponseCache
+from object_detector_backend.data.similarity import SimilarityIndex
+from object_detector_backend.data.thumbnails import ThumbnailCache
+from object_detector_backend.data.vision import BatchingAnnotator, Detector, DetectorRegistry
+from object_detector_backend.util.metrics import current_trace, end_trace, metrics, start_trace, write_snapshot
+
+DEFAULT_CONFIG = {
+    'DATABASE_URL': 'sqlite:///images.db',
+    'DATABASE_POOL_SIZE': 5,
+    'DATABASE_MAX_OVERFLOW': 10,
+    'DATABASE_POOL_TIMEOUT': 30,
+    'BLOB_STORE_PATH': 'blobs',
+    'BLOB_STORE': None, # BlobStore instance overriding the local store at BLOB_STORE_PATH
+    'MAX_REQUEST_BYTES': 100 * 1024 * 1024, # requests with a larger Content-Length are rejected before being read
+    'UPLOAD_MAX_BYTES': 20 * 1024 * 1024, # larger uploaded images are rejected while streaming
+    'UPLOAD_CHUNK_SIZE': 64 * 1024, # bytes of an upload held in memory at a time
+    'CONTENT_HASH': 'md5', # md5, blake2b or xxhash, images stored under another algorithm are not deduplicated against new ones
+    'RESPONSE_CACHE_ENABLED': True, # cache GET /images responses until a write changes them, other processes see writes only after RESPONSE_CACHE_TTL
+    'RESPONSE_CACHE': None, # ResponseCache instance overriding the in-process cache, i.e one shared by all workers
+    'RESPONSE_CACHE_SIZE': 1024, # responses kept in memory
+    'RESPONSE_CACHE_TTL': 60, # seconds responses are kept, bounds staleness when other processes write
+    'IMAGES_PAGE_SIZE': 100,
+    'IMAGES_MAX_PAGE_SIZE': 1000,
+    'LABELS_PAGE_SIZE': 100, # default number of facets returned by GET /labels
+    'EXPORT_BATCH_SIZE': 1000, # rows fetched from the database at a time by GET /images/export
+    'IMAGE_CONTENT_MAX_AGE': 3600, # seconds clients may reuse content before revalidating
+    'ANNOTATION_CACHE_SIZE': 1024, # labels of this many images are kept in memory
+    'ANNOTATION_CACHE_TTL': 30 * 24 * 3600, # seconds before cached labels are detected again, None to keep forever
+    'DETECTION_ASYNC': False, # default of the 'async' form field of POST /images
+    'DETECTION_WORKERS': 4, # threads running background detection jobs
+    'SHUTDOWN_TIMEOUT': 30, # seconds a stopping worker waits for running detection jobs
+    'DETECTOR': 'google', # default detector, overridden by the 'detector' form field
+    'DETECTOR_OPTIONS': {}, # detector name -> constructor arguments, i.e {'onnx': {'model_path': ..., 'labels_path': ...}}
+    'DETECTORS_WARMUP': None, # detectors loaded and warmed up when a worker starts, None for the default DETECTOR
+    'DETECTORS_FAN_OUT': [], # detectors run concurrently on every upload, overridden by the 'detectors' form field
+    'DETECTOR_TIMEOUT': 10.0, # seconds a fanned out detector may take before it is left out
+    'DETECTOR_TIMEOUTS': {}, # detector name -> timeout overriding DETECTOR_TIMEOUT
+    'LABEL_AGGREGATION': 'mean', # mean, max or weighted, overridden by the 'aggregation' form field
+    'DETECTOR_WEIGHTS': {}, # detector name -> weight of its scores in weighted aggregation
+    'FAN_OUT_WORKERS': 8, # threads calling fanned out detectors
+    'FETCH_CONNECT_TIMEOUT': 3.05, # seconds to connect to the host of an image url
+    'FETCH_READ_TIMEOUT': 10, # seconds to wait for each chunk of an image url
+    'FETCH_MAX_TIME': 30, # seconds a whole image download may take
+    'FETCH_MAX_BYTES': 20 * 1024 * 1024, # larger url images are rejected while downloading
+    'FETCH_WORKERS': 8, # concurrent downloads of a batch upload
+    'INGEST_FORMAT': None, # re-encode uploads to jpeg, png or webp, None keeps their format
+    'INGEST_QUALITY': 85, # quality of re-encoded jpeg and webp images
+    'INGEST_MAX_DIMENSION': None, # uploads with a longer side are downscaled before storage
+    'DETECTION_IMAGE_SIZE': 640, # larger images are sent to detectors as a copy downscaled to this size, None to send them as stored
+    'THUMBNAIL_SIZES': [64, 128, 256, 512], # sizes served by GET /images/<image_id>/thumbnail
+    'THUMBNAIL_DEFAULT_SIZE': 256,
+    'THUMBNAIL_CACHE_SIZE': 256, # thumbnails kept in memory in front of the blob store
+    'THUMBNAIL_QUALITY': 80,
+    'THUMBNAIL_EAGER_SIZES': [], # thumbnails generated during upload instead of on first request
+    'PHASH_ENABLED': True, # compute perceptual hashes of uploads, requires pillow
+    'NEAR_DUPLICATE_DISTANCE': 4, # bits two perceptual hashes may differ by for labels to be reused
+    'SIMILAR_MAX_DISTANCE': 10, # default max_distance of GET /images/<image_id>/similar
+    'SIMILARITY_LOOKBACK': 60, # seconds of images read again when the similarity index sees new images, covers rows committed late by other workers
+    'SIMILARITY_RESCAN_INTERVAL': 600, # seconds between background reads of every image by the similarity index, picks up backfilled hashes, None to never read again
+    'VISION_BATCH_SIZE': 16, # images per batched annotate call, 16 is the Vision API maximum
+    'VISION_BATCH_MAX_WAIT': 0.05, # seconds an image waits for a batch to fill up
+    'METRICS_DIR': None, # directory shared by the worker processes of a server, GET /metrics then reports totals over all workers
+    'METRICS_SNAPSHOT_INTERVAL': 5.0, # seconds between snapshots of a worker's metrics written to METRICS_DIR
+    'SERVER_TIMING': True, # report per stage durations and query counts of each request in a Server-Timing header
+    'PROFILE_REQUESTS': False, # profile requests with cProfile, adds overhead so only enable it while investigating
+    'PROFILE_MIN_SECONDS': 1.0, # profiles of requests taking longer are written to PROFILE_DIR
+    'PROFILE_DIR': 'profiles',
+}
+
+logger = logging.getLogger(__name__)
+
+_init_lock = threading.RLock()
+
+
+def init_app(app: Flask):
+    """Registers default configuration and per request cleanup of shared resources
+    """
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    # flask rejects bodies over MAX_CONTENT_LENGTH with 413 before parsing them
+    if app.config.get('MAX_CONTENT_LENGTH') is None:
+        app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_REQUEST_BYTES']
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_end_request)
+    app.teardown_appcontext(_remove_session)
+
+
+def create_database(app: Flask) -> Database:
+    """Creates the process wide database engine from app configuration.
+    Schema creation happens here once instead of on every request
+    """
+    blob_store: BlobStore = app.config['BLOB_STORE'] or LocalBlobStore(app.config['BLOB_STORE_PATH'])
+    database = Database(conn_str=app.config['DATABASE_URL'],
+                        pool_size=app.config['DATABASE_POOL_SIZE'],
+                        max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+                        pool_timeout=app.config['DATABASE_POOL_TIMEOUT'],
+                        blob_store=blob_store,
+                        response_cache=_create_response_cache(app))
+    app.extensions['database'] = database
+
+    # resources bound to a previous database are recreated on demand
+    app.extensions.pop('annotation_cache', None)
+    app.extensions.pop('similarity_index', None)
+    app.extensions.pop('thumbnail_cache', None)
+    return database
+
+
+def _create_response_cache(app: Flask) -> ResponseCache:
+    if not(app.config['RESPONSE_CACHE_ENABLED']):
+        return None
+
+    return app.config['RESPONSE_CACHE'] or MemoryResponseCache(
+        max_entries=app.config['RESPONSE_CACHE_SIZE'],
+        ttl=app.config['RESPONSE_CACHE_TTL'])
+
+
+def _get_or_create(name: str, factory):
+    """Returns the process wide resource stored under name, creating it on first use
+    """
+    resource = current_app.extensions.get(name)
+    if resource is None:
+        with _init_lock:
+            resource = current_app.extensions.get(name)
+            if resource is None:
+                resource = factory()
+                current_app.extensions[name] = resource
+
+    return resource
+
+
+def get_database() -> Database:
+    return _get_or_create('database', lambda: create_database(current_app))
+
+
+def get_annotation_cache() -> AnnotationCache:
+    return _get_or_create('annotation_cache', lambda: AnnotationCache(
+        get_database(),
+        max_entries=current_app.config['ANNOTATION_CACHE_SIZE'],
+        ttl=current_app.config['ANNOTATION_CACHE_TTL']))
+
+
+def get_image_normalizer() -> ImageNormalizer:
+    """Ingest stage of uploads, cheap to build so configuration changes apply right away
+    """
+    return ImageNormalizer(format=current_app.config['INGEST_FORMAT'],
+                           quality=current_app.config['INGEST_QUALITY'],
+                           max_dimension=current_app.config['INGEST_MAX_DIMENSION'],
+                           detection_size=current_app.config['DETECTION_IMAGE_SIZE'],
+                           max_bytes=current_app.config['UPLOAD_MAX_BYTES'])
+
+
+def get_thumbnail_cache() -> ThumbnailCache:
+    return _get_or_create('thumbnail_cache', lambda: ThumbnailCache(
+        get_database().blob_store,
+        sizes=current_app.config['THUMBNAIL_SIZES'],
+        max_entries=current_app.config['THUMBNAIL_CACHE_SIZE'],
+        quality=current_app.config['THUMBNAIL_QUALITY']))
+
+
+def get_similarity_index() -> SimilarityIndex:
+    """BK-tree of perceptual hashes, filled from the database on first use
+    """
+    return _get_or_create('similarity_index', lambda: SimilarityIndex(
+        lookback=current_app.config['SIMILARITY_LOOKBACK']))
+
+
+def get_detector_registry() -> DetectorRegistry:
+    return _get_or_create('detectors', lambda: DetectorRegistry(
+        options=current_app.config['DETECTOR_OPTIONS']))
+
+
+def get_detector(name: str = None) -> Detector:
+    """Detector shared by all requests, the configured DETECTOR unless a name is given
+    """
+    return get_detector_registry().get(name or current_app.config['DETECTOR'])
+
+
+def get_batching_annotator(name: str = None) -> BatchingAnnotator:
+    """Coalesces images of concurrent bulk uploads into batched detector calls
+    """
+    name = name or current_app.config['DETECTOR']
+    annotators = _get_or_create('batching_annotators', dict)
+
+    if name not in annotators:
+        detector = get_detector(name)
+        with _init_lock:
+            if name not in annotators:
+                annotators[name] = BatchingAnnotator(
+                    detector,
+                    batch_size=current_app.config['VISION_BATCH_SIZE'],
+                    max_wait=current_app.config['VISION_BATCH_MAX_WAIT'])
+
+    return annotators[name]
+
+
+def warmup_detectors(app: Flask):
+    """Loads detectors listed in DETECTORS_WARMUP so the first request does not pay for it
+    """
+    names = app.config['DETECTORS_WARMUP']
+    if names is None:
+        names = [app.config['DETECTOR']]
+
+    with app.app_context():
+        get_detector_registry().warmup(names)
+
+
+def get_fan_out_executor() -> ThreadPoolExecutor:
+    return _get_or_create('fan_out_executor', lambda: ThreadPoolExecutor(
+        max_workers=current_app.config['FAN_OUT_WORKERS'],
+        thread_name_prefix='fan-out'))
+
+
+def get_fetcher() -> ImageFetcher:
+    """Downloads url images over connections shared by all requests
+    """
+    return _get_or_create('fetcher', lambda: ImageFetcher(
+        connect_timeout=current_app.config['FETCH_CONNECT_TIMEOUT'],
+        read_timeout=current_app.config['FETCH_READ_TIMEOUT'],
+        max_time=current_app.config['FETCH_MAX_TIME'],
+        max_bytes=current_app.config['FETCH_MAX_BYTES'],
+        max_workers=current_app.config['FETCH_WORKERS']))
+
+
+def get_job_queue() -> JobQueue:
+    """Queue running background detection jobs, set app.extensions['job_queue'] to replace it
+    """
+    return _get_or_create('job_queue', lambda: ThreadPoolJobQueue(
+        max_workers=current_app.config['DETECTION_WORKERS']))
+
+
+def init_worker(app: Flask):
+    """Per process initialisation of a serving worker: its own database engine and
+    connection pool, which must not be shared with a forking parent, and warm detectors
+    """
+    database = app.extensions.pop('database', None)
+    if database is not None:
+        database.dispose()
+
+    for name in ('detectors', 'batching_annotators', 'fetcher', 'fan_out_executor', 'job_queue'):
+        app.extensions.pop(name, None)
+
+    for name in ('metrics_snapshots', 'similarity_rescans'):
+        stop = app.extensions.pop(name, None)
+        if stop is not None:
+            stop.set()
+
+    create_database(app)
+    warmup_detectors(app)
+
+    if app.config['METRICS_DIR']:
+        _start_metrics_snapshots(app)
+    if app.config['SIMILARITY_RESCAN_INTERVAL']:
+        _start_similarity_rescans(app)
+
+
+def _start_metrics_snapshots(app: Flask):
+    """Writes snapshots of the worker's metrics to METRICS_DIR every METRICS_SNAPSHOT_INTERVAL seconds
+    """
+    stop = threading.Event()
+
+    def run():
+        while not(stop.wait(app.config['METRICS_SNAPSHOT_INTERVAL'])):
+            try:
+                with app.app_context():
+                    write_snapshot(app.config['METRICS_DIR'], update=record_resource_metrics)
+            except Exception:
+                logger.exception('Writing metrics snapshot failed')
+
+    threading.Thread(target=run, name='metrics-snapshots', daemon=True).start()
+    app.extensions['metrics_snapshots'] = stop
+
+
+def _start_similarity_rescans(app: Flask):
+    """Reads every image into the similarity index every SIMILARITY_RESCAN_INTERVAL seconds,
+    so hashes backfilled on older images are found without searches reading the whole table
+    """
+    stop = threading.Event()
+
+    def run():
+        while not(stop.wait(app.config['SIMILARITY_RESCAN_INTERVAL'])):
+            # workers which never searched have no index to keep up to date
+            similarity_index = app.extensions.get('similarity_index')
+            if similarity_index is None:
+                continue
+            try:
+                with app.app_context():
+                    similarity_index.rescan(get_db_api())
+            except Exception:
+                logger.exception('Rescanning the similarity index failed')
+
+    threading.Thread(target=run, name='similarity-rescans', daemon=True).start()
+    app.extensions['similarity_rescans'] = stop
+
+
+def shutdown_app(app: Flask, timeout: float = None) -> bool:
+    """Graceful shutdown of a worker: waits up to timeout for running detection jobs,
+    then releases threads, connections and detector clients.
+    Returns False if detection jobs were still running
+    """
+    timeout = app.config['SHUTDOWN_TIMEOUT'] if timeout is None else timeout
+    drained = True
+
+    job_queue = app.extensions.pop('job_queue', None)
+    if job_queue is not None:
+        drained = job_queue.drain(timeout=timeout)
+        job_queue.shutdown(wait=drained)
+
+    fan_out_executor = app.extensions.pop('fan_out_executor', None)
+    if fan_out_executor is not None:
+        fan_out_executor.shutdown(wait=False)
+
+    for batching_annotator in app.extensions.pop('batching_annotators', {}).values():
+        batching_annotator.close()
+
+    fetcher = app.extensions.pop('fetcher', None)
+    if fetcher is not None:
+        fetcher.close()
+
+    database = app.extensions.pop('database', None)
+    if database is not None:
+        database.dispose()
+
+    similarity_rescans = app.extensions.pop('similarity_rescans', None)
+    if similarity_rescans is not None:
+        similarity_rescans.set()
+
+    # counters of the stopping worker stay part of the totals
+    metrics_snapshots = app.extensions.pop('metrics_snapshots', None)
+    if metrics_snapshots is not None:
+        metrics_snapshots.set()
+        write_snapshot(app.config['METRICS_DIR'])
+
+    return drained
+
+
+def record_resource_metrics():
+    """Copies pool usage and cache counters of this worker into the process metrics
+    """
+    pool = get_database().pool_status()
+    for state in ('checked_out', 'checked_in', 'overflow'):
+        if state in pool:
+            metrics.set('db_pool_connections', pool[state], state=state)
+    if 'wait_time_total' in pool:
+        metrics.set('db_pool_wait_seconds_total', pool['wait_time_total'])
+
+    response_cache = get_database().response_cache
+    caches = {
+        'annotations': get_annotation_cache().stats(),
+        'thumbnails': get_thumbnail_cache().stats(),
+        'responses': response_cache.stats() if response_cache is not None else {},
+    }
+    for cache, stats in caches.items():
+        for result, key in (('hit', 'hits'), ('miss', 'misses')):
+            if key in stats:
+                metrics.set('cache_requests_total', stats[key], cache=cache, result=result)
+
+
+def get_db_api() -> DatabaseAPI:
+    """DatabaseAPI bound to the session of the current request
+    """
+    return get_database().api()
+
+
+def _remove_session(exception=None):
+    database = current_app.extensions.get('database')
+    if database is not None:
+        database.remove_session()
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.trace_token = start_trace()
+
+    if current_app.config['PROFILE_REQUESTS']:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profiler = profiler
+        except ValueError:
+            # only one profiler can be active at a time on python 3.12 and later
+            pass
+
+
+def _finish_request(response):
+    """Records request metrics and writes the profile of a slow request
+    """
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unmatched'
+    metrics.inc('http_requests_total', method=request.method, endpoint=endpoint, status=response.status_code)
+    metrics.observe('http_request_duration_seconds', elapsed, method=request.method, endpoint=endpoint)
+
+    trace = current_trace()
+    if trace is not None and current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = ', '.join(
+            timing for timing in (trace.server_timing(), f'total;dur={elapsed * 1000:.1f}') if timing)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        if elapsed >= current_app.config['PROFILE_MIN_SECONDS']:
+            _write_profile(profiler, endpoint, elapsed, trace)
+
+    return response
+
+
+def _write_profile(profiler: cProfile.Profile, endpoint: str, elapsed: float, trace):
+    """Dumps a profile readable with pstats or snakeviz, i.e python3 -m pstats <path>
+    """
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{endpoint}-{elapsed * 1000:.0f}ms-{uuid.uuid4().hex[:8]}.prof")
+    profiler.dump_stats(path)
+    metrics.inc('profiles_written_total', endpoint=endpoint)
+    logger.warning(f'{request.method} {request.path} took {elapsed:.3f}s, profile written to {path}, '
+                   f'stages: {trace.to_dict() if trace is not None else {}}')
+
+
+def _end_request(exception=None):
+    # responses which never reached after_request still stop profiling
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+    token = g.pop('trace_token', None)
+    if token is not None:
+        end_trace(token)
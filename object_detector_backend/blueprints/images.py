@@ -1,12 +1,22 @@
+import hashlib
+import io
 import uuid
 import logging
+import mimetypes
+from functools import partial
+from typing import Tuple
 
-from flask import Blueprint, request, make_response
+from flask import Blueprint, current_app, json, request, make_response, send_file, stream_with_context
 from object_detector_backend.data.models import ImageModel, LabelModel
 
-from object_detector_backend.data.persistence import DatabaseAPI
-from object_detector_backend.data.vision import GoogleVisionAPICaller
+from object_detector_backend.blueprints.extensions import get_db_api, get_database, get_annotation_cache, get_detector, get_job_queue, get_batching_annotator, get_fan_out_executor, get_fetcher, get_similarity_index, get_image_normalizer, get_thumbnail_cache
+from object_detector_backend.data.export import gzip_chunks, ndjson_chunks
+from object_detector_backend.data.detection import AGGREGATED_SOURCE, AGGREGATIONS, detect_labels, detect_labels_many, detect_labels_fan_out, reuse_near_duplicate_labels
+from object_detector_backend.data.ingest import NormalizedImage
+from object_detector_backend.data.similarity import dhash
+from object_detector_backend.data.jobs import run_detection_job
 from object_detector_backend.util.exceptions import InvalidInputException
+from object_detector_backend.util.metrics import stage
 
 images = Blueprint('image', __name__)
 logger = logging.getLogger(__name__)
@@ -16,20 +26,50 @@ def get_images():
     """
     Endpoint to retrieve images.
     If labels are provided, images with specified labels will be retrieved.
-    i.e /images?objects="cat,dog"
+    i.e /images?objects="cat,dog"&match=all&min_score=0.5&order_by=score
+
+    Otherwise images are returned a page at a time.
+    i.e /images?limit=50&cursor=<next_cursor>&fields=id,label
+
+    Responses carry an ETag for If-None-Match and are cached until images or labels are written
     """
+    db_api = get_db_api()
+    query = '&'.join(f'{key}={value}' for key, value in sorted(request.args.items(multi=True)))
+
+    response_cache = db_api.response_cache
+    key = response_cache.collection_key(query) if response_cache is not None else None
+    return _cached_response(response_cache, key, lambda: _find_images(db_api))
+
+def _find_images(db_api) -> dict:
     objects = request.args.get('objects')
-    db_api = DatabaseAPI()
 
     if objects:
         objects = [o.strip() for o in objects.strip('"').split(',')]
-        to_return = db_api.get_images_by_label(labels=objects)
+        return {
+            'images': db_api.get_images_by_label(
+                labels=objects,
+                match=request.args.get('match', 'any'),
+                min_score=request.args.get('min_score', None, type=float),
+                order_by=request.args.get('order_by', None))
+        }
+
+    limit = request.args.get('limit', current_app.config['IMAGES_PAGE_SIZE'], type=int)
+    if limit is None or not(0 < limit <= current_app.config['IMAGES_MAX_PAGE_SIZE']):
+        raise InvalidInputException(
+            f"'limit' must be between 1 and {current_app.config['IMAGES_MAX_PAGE_SIZE']}")
+
+    fields = request.args.get('fields')
+    if fields:
+        fields = [f.strip() for f in fields.split(',')]
+
+    to_return, next_cursor = db_api.get_images_page(
+        limit=limit,
+        cursor=request.args.get('cursor'),
+        fields=fields)
 
-    else:
-        to_return = db_api.get_images()
-    
     return {
-        'images': to_return
+        'images': to_return,
+        'next_cursor': next_cursor
     }
 
 @images.route('/<image_id>', methods=['GET'])
@@ -37,7 +77,13 @@ def get_image_by_id(image_id: str):
     """
     Retrieve image metadata and its labels  of an image with specified image_id
     """
-    db_api = DatabaseAPI()
+    db_api = get_db_api()
+
+    response_cache = db_api.response_cache
+    key = response_cache.image_key(image_id) if response_cache is not None else None
+    return _cached_response(response_cache, key, lambda: _find_image(db_api, image_id))
+
+def _find_image(db_api, image_id: str) -> dict:
     images = db_api.get_images(id=image_id)
     
     if len(images) != 0:
@@ -47,24 +93,169 @@ def get_image_by_id(image_id: str):
     else:
         return {}
 
+def _cached_response(response_cache, key: str, build):
+    """Serves the serialized response cached under key, building and caching it on a miss.
+    Without a response cache the response is built on every request.
+    Requests with a matching If-None-Match get 304 either way
+    """
+    entry = response_cache.get(key) if response_cache is not None else None
+    if entry is None:
+        body = json.dumps(build()).encode()
+        entry = (body, hashlib.md5(body).hexdigest())
+        if response_cache is not None:
+            response_cache.set(key, entry)
+
+    body, etag = entry
+    resp = make_response(body)
+    resp.mimetype = 'application/json'
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+@images.route('/export', methods=['GET'])
+def export_images():
+    """
+    Stream every image with its labels as newline delimited json, one image per line.
+    Images can be filtered by labels like GET /images and the stream gzipped on the fly.
+    i.e /images/export?objects=cat,dog&match=all&min_score=0.5&gzip=true
+    """
+    db_api = get_db_api()
+    objects = request.args.get('objects')
+    objects = [o.strip() for o in objects.strip('"').split(',')] if objects else None
+    _gzip = request.args.get('gzip', 'False', type=str).upper() == 'TRUE'
+
+    records = db_api.iter_images(labels=objects,
+                                 match=request.args.get('match', 'any'),
+                                 min_score=request.args.get('min_score', None, type=float),
+                                 batch_size=current_app.config['EXPORT_BATCH_SIZE'])
+    chunks = ndjson_chunks(records)
+    if _gzip:
+        chunks = gzip_chunks(chunks)
+
+    # the request context, and with it the database session, lives until the stream ends
+    resp = current_app.response_class(stream_with_context(chunks), mimetype='application/x-ndjson')
+    if _gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+@images.route('/<image_id>/similar', methods=['GET'])
+def get_similar_images(image_id: str):
+    """
+    Retrieve images which look like the image with specified image_id,
+    i.e re-encoded or resized copies, ordered by the distance of their perceptual hashes.
+    i.e /images/<image_id>/similar?max_distance=10&limit=20
+    """
+    max_distance = request.args.get('max_distance', current_app.config['SIMILAR_MAX_DISTANCE'], type=int)
+    limit = request.args.get('limit', current_app.config['IMAGES_PAGE_SIZE'], type=int)
+    if max_distance is None or max_distance < 0:
+        raise InvalidInputException("'max_distance' must be a non negative integer")
+    if limit is None or not(0 < limit <= current_app.config['IMAGES_MAX_PAGE_SIZE']):
+        raise InvalidInputException(
+            f"'limit' must be between 1 and {current_app.config['IMAGES_MAX_PAGE_SIZE']}")
+
+    db_api = get_db_api()
+    phash = db_api.get_image_phash(image_id)
+    if phash is None:
+        return {'images': []}
+
+    matches = [(distance, match_id) for distance, match_id
+               in get_similarity_index().search(db_api, phash, max_distance)
+               if match_id != image_id][:limit]
+    distances = {match_id: distance for distance, match_id in matches}
+
+    similar = db_api.get_images_by_ids([match_id for _, match_id in matches])
+    for image in similar:
+        image['distance'] = distances[image['id']]
+
+    return {
+        'images': similar
+    }
+
+@images.route('/<image_id>/content', methods=['GET'])
+def get_image_content(image_id: str):
+    """
+    Stream content of an image with specified image_id.
+    Supports Range requests and revalidation with If-None-Match against the checksum ETag
+    """
+    db_api = get_db_api()
+    source, image = db_api.open_image_content(image_id)
+
+    mimetype, _ = mimetypes.guess_type(f"image.{image['filetype']}")
+
+    return send_file(source,
+                     mimetype=mimetype or 'application/octet-stream',
+                     download_name=image['filename'],
+                     conditional=True,
+                     etag=image['check_sum'],
+                     max_age=current_app.config['IMAGE_CONTENT_MAX_AGE'])
+
+@images.route('/<image_id>/thumbnail', methods=['GET'])
+def get_image_thumbnail(image_id: str):
+    """
+    Jpeg thumbnail of an image with specified image_id, at most size pixels on its longer side.
+    Thumbnails are generated on first request and cached by checksum and size.
+    i.e /images/<image_id>/thumbnail?size=128
+    """
+    size = request.args.get('size', current_app.config['THUMBNAIL_DEFAULT_SIZE'], type=int)
+    thumbnail_cache = get_thumbnail_cache()
+    thumbnail_cache.validate_size(size)
+
+    db_api = get_db_api()
+    checksum = db_api.get_image_checksum(image_id)
+    etag = f'{checksum}-{size}'
+
+    # revalidation is answered without loading the thumbnail
+    if request.if_none_match.contains(etag):
+        resp = make_response('', 304)
+    else:
+        thumbnail = thumbnail_cache.get(checksum, size,
+                                        lambda: _open_thumbnail_source(db_api, image_id, size))
+        resp = make_response(thumbnail)
+        resp.mimetype = 'image/jpeg'
+
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.config['IMAGE_CONTENT_MAX_AGE']
+    return resp
+
+def _open_thumbnail_source(db_api, image_id: str, size: int):
+    # the detection copy is cheaper to decode and large enough for smaller thumbnails
+    detection_size = current_app.config['DETECTION_IMAGE_SIZE']
+    if detection_size and size <= detection_size:
+        return io.BytesIO(db_api.fetch_detection_content_by_id(image_id))
+
+    source, _ = db_api.open_image_content(image_id)
+    return open(source, 'rb') if isinstance(source, str) else source
+
+@images.route('/<image_id>/jobs', methods=['GET'])
+def get_image_jobs(image_id: str):
+    """
+    Status of detection jobs of an image with specified image_id, along with its labels
+    """
+    db_api = get_db_api()
+    # raises NotFoundException for unknown images
+    db_api.get_image_checksum(image_id)
+
+    return {
+        'jobs': db_api.get_jobs_by_image_id(image_id),
+        'labels': db_api.get_labels_by_image_id(image_id),
+    }
+
 @images.route('', methods=['POST'])
 def post_images():
     """
     Post new image. If detection is enabled, 
     calls Google Vision API to annotate the image with labels.
     Image will also be labeled with user provided label.
+    If async is enabled, detection runs as a background job
+    whose status is reported by GET /images/<image_id>/jobs
 
     """
 
     _url = request.form.get('url', type=str, default=None)
     _filename = request.form.get('filename', type=str, default=None)
-    _content = request.files.get('image', default=None)
+    _content = request.files.get('image', default=None) or None
     _optional_label = request.form.get('label', None, type=str)
 
-    # if image input is provided, read file as bytes
-    if _content:
-        _content = _content.read()
-
     if _content is None and _filename is None and _url is None:
         raise InvalidInputException("Either 'url' or 'image' must be provided as an input")
 
@@ -78,36 +269,92 @@ def post_images():
     _enable_detection = request.form.get('enable_detection', 'True', type=str)
     _enable_detection = _enable_detection.upper()
 
-    db_api = DatabaseAPI()
-    _image = ImageModel(id=str(uuid.uuid1()),
-                       filename=_filename,
-                       url=_url,
-                       content=_content)
+    # detector to annotate the image with, defaults to the configured DETECTOR
+    _detector = request.form.get('detector', None, type=str)
+
+    # several detectors run concurrently and their scores are aggregated
+    _detectors = request.form.get('detectors', None, type=str)
+    _detectors = [d.strip() for d in _detectors.split(',') if d.strip()] if _detectors \
+        else current_app.config['DETECTORS_FAN_OUT']
+    _aggregation = request.form.get('aggregation', current_app.config['LABEL_AGGREGATION'], type=str)
+    if _aggregation not in AGGREGATIONS:
+        raise InvalidInputException(f"'aggregation' must be one of {', '.join(AGGREGATIONS)}")
+
+    # a single entry selects that detector
+    if not(_detector) and len(_detectors) == 1:
+        _detector = _detectors[0]
+
+    fan_out = _enable_detection == 'TRUE' and len(_detectors) > 1 and not(_detector)
+
+    detect = None
+    sources = []
+    if fan_out:
+        detectors = {name: get_detector(name) for name in _detectors}
+        sources = [detector.source for detector in detectors.values()] + [AGGREGATED_SOURCE]
+        detect = partial(detect_labels_fan_out,
+                         detectors=detectors,
+                         executor=get_fan_out_executor(),
+                         timeouts=current_app.config['DETECTOR_TIMEOUTS'],
+                         default_timeout=current_app.config['DETECTOR_TIMEOUT'],
+                         method=_aggregation,
+                         weights=current_app.config['DETECTOR_WEIGHTS'],
+                         annotation_cache=get_annotation_cache())
+
+    elif _enable_detection == 'TRUE':
+        detector = get_detector(_detector)
+        sources = [detector.source]
+        detect = partial(detect_labels,
+                         detector=detector,
+                         annotation_cache=get_annotation_cache())
 
-    duplicate_image_found = db_api.check_duplicate_image(_image)
-    if not(duplicate_image_found):
-        committed_image = db_api.add_image(_image)
+    # run detection in the background and respond with 202 and a job id
+    _async = request.form.get('async', str(current_app.config['DETECTION_ASYNC']), type=str)
+    _async = _async.upper()
+
+    db_api = get_db_api()
+    if _content is None:
+        with stage('fetch'):
+            fetched = get_fetcher().fetch(_url)
+        _image, normalized = _ingest(io.BytesIO(fetched.content), fetched.filename, db_api, url=_url)
     else:
-        committed_image = duplicate_image_found
+        _image, normalized = _ingest(_content.stream, _filename, db_api, url=_url)
+
+    # returns the stored image when the same file was uploaded before
+    committed_image = db_api.add_image(_image)
 
     try:
-        if _enable_detection == 'TRUE':
+        job = None
+        detector_statuses = None
+        near_duplicate = None
+
+        # a re-encoded or resized copy of an annotated image gets its labels without detection
+        if detect is not None and _image.phash is not None:
+            with stage('near_duplicate'):
+                near_duplicate = reuse_near_duplicate_labels(db_api,
+                                                             committed_image,
+                                                             _image.phash,
+                                                             get_similarity_index(),
+                                                             sources,
+                                                             max_distance=current_app.config['NEAR_DUPLICATE_DISTANCE'])
+            if near_duplicate is not None:
+                logger.info(f'Reused labels of near duplicate image {near_duplicate}')
+                detect = None
+
+        if detect is not None and _async == 'TRUE':
+            logger.info('Detection enabled, queueing detection job...')
+            job = db_api.create_job(str(uuid.uuid1()), committed_image['id'])
+            get_job_queue().submit(run_detection_job,
+                                   get_database(),
+                                   job['id'],
+                                   committed_image,
+                                   detect)
+
+        elif detect is not None:
             logger.info('Detection enabled...')
-            vision_client = GoogleVisionAPICaller()
-            vision_labels = vision_client.annotate(\
-                content=db_api.fetch_image_content_by_id(committed_image['id']))
-
-            for label in vision_labels:
-                db_api.add_label(
-                    LabelModel(
-                        id=str(uuid.uuid1()),
-                        label=label['label'],
-                        score=label['score'],
-                        topicality=label['topicality'],
-                        image_id=committed_image['id'],
-                        source='Google Vision'
-                    )
-                )
+            with stage('detect'):
+                detected = detect(db_api, committed_image)
+            if fan_out:
+                _, detector_statuses = detected
 
         if _optional_label:
             logger.info(f'Optional label({_optional_label}) provided by the user')
@@ -120,22 +367,177 @@ def post_images():
                 )
             )
 
-        return make_response({
+        if job is not None:
+            return make_response({
+                'id': committed_image['id'],
+                'job_id': job['id'],
+                'status': job['status'],
+                'labels': db_api.get_labels_by_image_id(committed_image['id']),
+            }, 202)
+
+        to_return = {
             'id': committed_image['id'],    
             'labels': db_api.get_labels_by_image_id(committed_image['id']),
-        }, 200)
+            'ingest': normalized.to_dict(),
+        }
+
+        if detector_statuses is not None:
+            to_return['detectors'] = detector_statuses
+
+        if near_duplicate is not None:
+            to_return['near_duplicate_of'] = near_duplicate
+
+        return make_response(to_return, 200)
 
     except Exception as e:
         db_api.session.rollback()
         raise e
 
+@images.route('/batch', methods=['POST'])
+def post_images_batch():
+    """
+    Post many images at once. Every 'image' file and 'url' field is stored as an image.
+    If detection is enabled, images are annotated with batched detector calls.
+    Each image is also labeled with the optional user provided label.
+    Images which could not be stored or annotated are reported with an error
+    """
+    _files = request.files.getlist('image')
+    _urls = request.form.getlist('url')
+    _optional_label = request.form.get('label', None, type=str)
+
+    if not(_files) and not(_urls):
+        raise InvalidInputException("Either 'url' or 'image' must be provided as an input")
+
+    # detection enabled by default
+    _enable_detection = request.form.get('enable_detection', 'True', type=str)
+    _enable_detection = _enable_detection.upper()
+    _detector = request.form.get('detector', None, type=str)
+    annotator = get_batching_annotator(_detector) if _enable_detection == 'TRUE' else None
+
+    db_api = get_db_api()
+    results = []
+    committed_images = []
+    ingested = {}
+
+    # url images are downloaded concurrently
+    with stage('fetch'):
+        sources = [{'filename': f.filename, 'file': f} for f in _files] + \
+            [{'url': url, 'fetched': fetched} for url, fetched in zip(_urls, get_fetcher().fetch_many(_urls))]
+
+    for source in sources:
+        try:
+            if 'fetched' in source:
+                if isinstance(source['fetched'], Exception):
+                    raise source['fetched']
+                fetched = source['fetched']
+                _image, normalized = _ingest(io.BytesIO(fetched.content), fetched.filename, db_api, url=fetched.url)
+            else:
+                _image, normalized = _ingest(source['file'].stream, source['filename'], db_api)
+
+            committed_image = db_api.add_image(_image)
+            ingested[committed_image['id']] = normalized.to_dict()
+        except Exception as e:
+            db_api.session.rollback()
+            results.append({
+                'filename': source.get('filename'),
+                'url': source.get('url'),
+                'error': str(e),
+            })
+            continue
+
+        committed_images.append(committed_image)
+        results.append(committed_image)
+
+    if _optional_label:
+        db_api.add_labels([
+            LabelModel(
+                id=str(uuid.uuid1()),
+                label=_optional_label,
+                image_id=committed_image['id'],
+                source='User'
+            )
+            for committed_image in committed_images
+        ])
+
+    if _enable_detection == 'TRUE':
+        with stage('detect'):
+            detected = detect_labels_many(db_api,
+                                          committed_images,
+                                          annotator,
+                                          get_annotation_cache())
+        errors = {image['id']: labels for image, labels in zip(committed_images, detected)
+                  if isinstance(labels, Exception)}
+    else:
+        errors = {}
+
+    to_return = []
+    for result in results:
+        if 'error' in result:
+            to_return.append(result)
+        elif result['id'] in errors:
+            to_return.append({'id': result['id'], 'error': str(errors[result['id']])})
+        else:
+            to_return.append({
+                'id': result['id'],
+                'labels': db_api.get_labels_by_image_id(result['id']),
+                'ingest': ingested[result['id']],
+            })
+
+    return make_response({
+        'images': to_return
+    }, 200)
+
+def _ingest(stream, filename: str, db_api, url: str = None) -> Tuple[ImageModel, NormalizedImage]:
+    """Validates and normalizes uploaded content, then copies it into the blob store
+    chunk by chunk, hashing it on the way, so memory per upload stays bounded by the chunk size
+    unless the image is re-encoded. A smaller copy for detectors is stored along with it
+    """
+    with stage('normalize'):
+        normalized = get_image_normalizer().normalize(stream)
+
+    with stage('hash_and_store'):
+        image = ImageModel.from_stream(id=str(uuid.uuid1()),
+                                       filename=filename,
+                                       stream=normalized.stream,
+                                       blob_store=db_api.blob_store,
+                                       chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'],
+                                       max_bytes=current_app.config['UPLOAD_MAX_BYTES'],
+                                       hash_algorithm=current_app.config['CONTENT_HASH'])
+    image.url = url
+    # the type is taken from the content, not the filename extension
+    image.filetype = normalized.filetype
+
+    if normalized.detection_content is not None:
+        db_api.add_detection_content(image.content_key, normalized.detection_content)
+
+    if current_app.config['PHASH_ENABLED']:
+        with stage('phash'):
+            # perceptual hashes barely change with size, hashing the small copy decodes less
+            if normalized.detection_content is not None:
+                image.phash = dhash(normalized.detection_content)
+            else:
+                with db_api.blob_store.open(image.content_key) as f:
+                    image.phash = dhash(f)
+
+    for size in current_app.config['THUMBNAIL_EAGER_SIZES']:
+        with stage('thumbnails'):
+            get_thumbnail_cache().get(image.checksum, size, partial(_open_ingested, db_api, image, normalized, size))
+
+    return image, normalized
+
+def _open_ingested(db_api, image: ImageModel, normalized: NormalizedImage, size: int):
+    if normalized.detection_content is not None and size <= current_app.config['DETECTION_IMAGE_SIZE']:
+        return io.BytesIO(normalized.detection_content)
+    return db_api.blob_store.open(image.content_key)
+
 @images.route('reset', methods=['POST'])
 def reset_db():
     """
     Cleans up the database file and recreate tables based on ORM schema
     """
-    db_api = DatabaseAPI()
+    db_api = get_db_api()
     db_api.reset()
+    current_app.extensions.pop('similarity_index', None)
 
     return make_response({
         'message': 'database recreated'
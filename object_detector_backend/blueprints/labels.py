@@ -0,0 +1,35 @@
+from flask import Blueprint, current_app, request
+
+from object_detector_backend.blueprints.extensions import get_db_api
+from object_detector_backend.blueprints.images import _cached_response
+from object_detector_backend.util.exceptions import InvalidInputException
+
+labels = Blueprint('labels', __name__)
+
+
+@labels.route('', methods=['GET'])
+def get_labels():
+    """
+    Label facets: labels with the number of images carrying them, their mean score and a breakdown per source.
+    Counts are read from statistics maintained as labels are stored.
+    i.e /labels?prefix=do&source=Google Vision&order_by=count&limit=20
+    """
+    db_api = get_db_api()
+    query = '&'.join(f'{key}={value}' for key, value in sorted(request.args.items(multi=True)))
+
+    response_cache = db_api.response_cache
+    key = response_cache.collection_key(f'labels?{query}') if response_cache is not None else None
+    return _cached_response(response_cache, key, lambda: _find_labels(db_api))
+
+def _find_labels(db_api) -> dict:
+    limit = request.args.get('limit', current_app.config['LABELS_PAGE_SIZE'], type=int)
+    if limit is None or not(0 < limit <= current_app.config['IMAGES_MAX_PAGE_SIZE']):
+        raise InvalidInputException(
+            f"'limit' must be between 1 and {current_app.config['IMAGES_MAX_PAGE_SIZE']}")
+
+    return {
+        'labels': db_api.get_label_facets(source=request.args.get('source'),
+                                          prefix=request.args.get('prefix'),
+                                          order_by=request.args.get('order_by', 'count'),
+                                          limit=limit)
+    }
@@ -0,0 +1,45 @@
+from flask import Blueprint, current_app, make_response
+
+from object_detector_backend.blueprints.extensions import get_database, get_annotation_cache, get_thumbnail_cache, record_resource_metrics
+from object_detector_backend.util.metrics import collect, metrics, write_snapshot
+
+operations = Blueprint('operations', __name__)
+
+
+@operations.route('/pool', methods=['GET'])
+def get_pool_status():
+    """Connection pool metrics (checked out, overflow, wait time) of the shared engine
+    """
+    return get_database().pool_status()
+
+
+@operations.route('/cache', methods=['GET'])
+def get_cache_status():
+    """Hit and miss counters of the annotation, thumbnail and response caches
+    """
+    response_cache = get_database().response_cache
+
+    return {
+        'annotations': get_annotation_cache().stats(),
+        'thumbnails': get_thumbnail_cache().stats(),
+        'responses': response_cache.stats() if response_cache is not None else {},
+    }
+
+
+@operations.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, stage, query, blob store and detector metrics in the Prometheus text format,
+    along with the pool and cache counters. Totals over all worker processes when METRICS_DIR is set,
+    otherwise of the worker process answering the request
+    """
+    record_resource_metrics()
+
+    registry = metrics
+    directory = current_app.config['METRICS_DIR']
+    if directory:
+        write_snapshot(directory)
+        registry = collect(directory)
+
+    resp = make_response(registry.render())
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
@@ -0,0 +1,143 @@
+import argparse
+import logging
+import sys
+
+from sqlalchemy.engine import make_url
+
+from object_detector_backend.data.blobs import LocalBlobStore
+from object_detector_backend.data.bulk_import import BulkImporter, ImportCheckpoint, iter_directory, iter_manifest
+from object_detector_backend.data.cache import AnnotationCache
+from object_detector_backend.data.export import export_images
+from object_detector_backend.data.fetch import ImageFetcher
+from object_detector_backend.data.ingest import ImageNormalizer
+from object_detector_backend.data.persistence import Database, DatabaseAPI, upgrade_schema
+from object_detector_backend.data.vision import DetectorRegistry
+
+
+def migrate(args):
+    """Upgrades an existing database to the current schema
+    and moves image content out of the Images table into the blob store
+    """
+    db = DatabaseAPI(conn_str=args.db, blob_store=LocalBlobStore(args.blobs))
+
+    for change in upgrade_schema(db.engine):
+        print(change)
+
+    print(f'backfilled created_at of {db.backfill_created_at()} images')
+    print(f'backfilled label_normalized of {db.backfill_label_normalized()} labels')
+    print(f'moved content of {db.migrate_content_to_blob_store(batch_size=args.batch_size)} images to {args.blobs}')
+    print(f'computed perceptual hashes of {db.backfill_phash(batch_size=args.batch_size)} images')
+    print(f'rebuilt {db.rebuild_label_stats()} label statistics')
+
+    # reclaim the space freed by the moved blobs
+    if args.vacuum and make_url(args.db).get_backend_name() == 'sqlite':
+        db.session.close()
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('VACUUM')
+        print('vacuumed database')
+
+    db.database.dispose()
+
+
+def import_images(args):
+    """Imports a directory of images or a manifest of image urls, resuming from --checkpoint
+    """
+    database = Database(conn_str=args.db,
+                        pool_size=args.detection_workers + 1,
+                        blob_store=LocalBlobStore(args.blobs))
+    detector = None if args.no_detection else DetectorRegistry().get(args.detector)
+    fetcher = ImageFetcher(max_bytes=args.max_bytes, pool_size=args.workers)
+
+    importer = BulkImporter(database,
+                            detector=detector,
+                            annotation_cache=AnnotationCache(database) if detector is not None else None,
+                            fetcher=fetcher,
+                            normalizer=ImageNormalizer(detection_size=args.detection_size, max_bytes=args.max_bytes),
+                            workers=args.workers,
+                            detection_workers=args.detection_workers,
+                            batch_size=args.batch_size,
+                            max_bytes=args.max_bytes,
+                            hash_algorithm=args.hash,
+                            checkpoint=ImportCheckpoint(args.checkpoint))
+
+    try:
+        if args.dir:
+            stats = importer.run(iter_directory(args.dir), args.dir)
+        else:
+            stats = importer.run(iter_manifest(args.manifest), args.manifest)
+    finally:
+        fetcher.close()
+        database.dispose()
+
+    print(', '.join(f'{key}: {value}' for key, value in stats.items()))
+
+
+def export(args):
+    """Streams images with their labels as newline delimited json to --out or stdout
+    """
+    db = DatabaseAPI(conn_str=args.db, blob_store=LocalBlobStore(args.blobs))
+    labels = [o.strip() for o in args.objects.split(',')] if args.objects else None
+    gzip = args.gzip or args.out.endswith('.gz')
+
+    try:
+        if args.out == '-':
+            count = export_images(db, sys.stdout.buffer, gzip=gzip, batch_size=args.batch_size,
+                                  labels=labels, match=args.match, min_score=args.min_score)
+        else:
+            with open(args.out, 'wb') as out:
+                count = export_images(db, out, gzip=gzip, batch_size=args.batch_size,
+                                      labels=labels, match=args.match, min_score=args.min_score)
+    finally:
+        db.database.dispose()
+
+    # stdout may carry the export itself
+    print(f'exported {count} images', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m object_detector_backend.cli')
+    parser.add_argument('--db', default='sqlite:///images.db', help='Database connection string')
+    parser.add_argument('--blobs', default='blobs', help='Directory of the blob store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help=migrate.__doc__.splitlines()[0])
+    migrate_parser.add_argument('--batch-size', type=int, default=100,
+                                help='Images moved per transaction')
+    migrate_parser.add_argument('--vacuum', action='store_true',
+                                help='Compact sqlite database after moving content')
+    migrate_parser.set_defaults(func=migrate)
+
+    import_parser = subparsers.add_parser('import', help=import_images.__doc__.splitlines()[0])
+    source = import_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='Directory of images, searched recursively')
+    source.add_argument('--manifest', help='File listing image urls, one per line')
+    import_parser.add_argument('--checkpoint', help='File recording progress, an interrupted import resumes from it')
+    import_parser.add_argument('--workers', type=int, default=8, help='Threads reading or downloading images')
+    import_parser.add_argument('--detection-workers', type=int, default=4,
+                               help='Concurrent detector calls, keep it within the detector quota')
+    import_parser.add_argument('--batch-size', type=int, default=500, help='Images written per transaction')
+    import_parser.add_argument('--detector', default='google', help='Detector annotating new images, i.e google or onnx')
+    import_parser.add_argument('--no-detection', action='store_true', help='Store images without annotating them')
+    import_parser.add_argument('--detection-size', type=int, default=640,
+                               help='Larger images are sent to the detector downscaled to this size')
+    import_parser.add_argument('--max-bytes', type=int, default=20 * 1024 * 1024, help='Larger images are skipped')
+    import_parser.add_argument('--hash', default='md5', help='Content hash, md5, blake2b or xxhash')
+    import_parser.set_defaults(func=import_images)
+
+    export_parser = subparsers.add_parser('export', help=export.__doc__.splitlines()[0])
+    export_parser.add_argument('--out', default='-', help='File to write, gzipped if it ends with .gz, - for stdout')
+    export_parser.add_argument('--objects', help='Comma separated labels, only images with them are exported')
+    export_parser.add_argument('--match', default='any', help='any or all of the labels')
+    export_parser.add_argument('--min-score', type=float, help='Labels scoring lower do not match')
+    export_parser.add_argument('--gzip', action='store_true', help='Compress the output')
+    export_parser.add_argument('--batch-size', type=int, default=1000, help='Rows fetched from the database at a time')
+    export_parser.set_defaults(func=export)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+import hashlib
+import os
+import tempfile
+import threading
+from io import BytesIO
+from typing import BinaryIO, Callable, Iterable, Optional, Tuple
+
+from object_detector_backend.util.exceptions import PayloadTooLargeException
+from object_detector_backend.util.metrics import metrics
+
+
+class BlobStore():
+    """Content addressed storage for image bytes.
+    Keys are content checksums so storing the same bytes twice is a no-op.
+    Implement this interface to back images with another store, i.e an S3 bucket
+    """
+    def put(self, key: str, content: bytes) -> bool:
+        """Stores content under key. Returns False if the key was already stored
+        """
+        raise NotImplementedError
+
+    def put_stream(self,
+                   chunks: Iterable[bytes],
+                   hasher_factory: Callable = hashlib.md5,
+                   max_bytes: int = None) -> Tuple[str, int]:
+        """Stores content arriving in chunks, keyed by the checksum computed along the way.
+        Raises PayloadTooLargeException once more than max_bytes arrived.
+        Returns the key and size of the content.
+        Stores able to write incrementally should override this buffering default
+        """
+        hasher = hasher_factory()
+        buffer = BytesIO()
+
+        for chunk in _limit(chunks, max_bytes):
+            hasher.update(chunk)
+            buffer.write(chunk)
+
+        key = hasher.hexdigest()
+        self.put(key, buffer.getvalue())
+        return key, buffer.tell()
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def open(self, key: str) -> BinaryIO:
+        """Opens stored content as a readable binary file object
+        """
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes every stored blob
+        """
+        raise NotImplementedError
+
+    def path(self, key: str) -> Optional[str]:
+        """Filesystem path of stored content if the store is backed by local files
+        """
+        return None
+
+
+class LocalBlobStore(BlobStore):
+    """Stores blobs as files sharded into sub directories by the leading characters of the key.
+    i.e key 'e1f0ab68...' is stored in <root>/e1/f0/e1f0ab68...
+    A relative root is resolved against the working directory once, so paths handed to
+    send_file, which resolves relative paths against the app root, point at the same files.
+    Directories are created by the first write, constructing a store touches no files
+    """
+    def __init__(self, root: str = 'blobs', depth: int = 2, width: int = 2):
+        self.root = os.path.abspath(str(root))
+        self.depth = depth
+        self.width = width
+
+    def path(self, key: str) -> str:
+        if not(key) or not(key.isalnum()):
+            raise ValueError(f'Invalid blob key: {key}')
+
+        shards = [key[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        return os.path.join(self.root, *shards, key)
+
+    def put(self, key: str, content: bytes) -> bool:
+        path = self.path(key)
+        if os.path.exists(path):
+            return False
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # write to a temp file first so readers never see a partially written blob
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        return True
+
+    def put_stream(self,
+                   chunks: Iterable[bytes],
+                   hasher_factory: Callable = hashlib.md5,
+                   max_bytes: int = None) -> Tuple[str, int]:
+        """Writes chunks to a temp file while hashing them, then moves it under its key.
+        Memory use is bounded by the chunk size regardless of the content size
+        """
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        hasher = hasher_factory()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in _limit(chunks, max_bytes):
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            key = hasher.hexdigest()
+            path = self.path(key)
+
+            if os.path.exists(path):
+                # identical content is already stored
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return key, size
+
+    def get(self, key: str) -> bytes:
+        with self.open(key) as f:
+            return f.read()
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self.path(key), 'rb')
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def delete(self, key: str):
+        if self.exists(key):
+            os.remove(self.path(key))
+
+    def clear(self):
+        """Removes blob files and the shard directories holding them. Other files under root are
+        left alone, so a root pointing at a directory with other content is not wiped
+        """
+        for directory, _, files in os.walk(self.root, topdown=False):
+            relative = os.path.relpath(directory, self.root)
+            parts = [] if relative == os.curdir else relative.split(os.sep)
+
+            if parts == ['tmp']:
+                created = [name for name in files if name.endswith('.tmp')]
+            elif len(parts) <= self.depth and all(self._is_shard(part) for part in parts):
+                created = [name for name in files if name.endswith('.tmp') or self._is_blob(name, parts)]
+            else:
+                continue
+
+            for name in created:
+                os.remove(os.path.join(directory, name))
+
+            # directories still holding other files stay
+            if parts:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+    def _is_shard(self, name: str) -> bool:
+        return len(name) == self.width and name.isalnum()
+
+    def _is_blob(self, name: str, shards: list) -> bool:
+        return len(shards) == self.depth and name.isalnum() and \
+            [name[i * self.width:(i + 1) * self.width] for i in range(self.depth)] == shards
+
+
+class MemoryBlobStore(BlobStore):
+    """Keeps blobs in process memory. Useful for tests and as a stand-in for remote stores
+    """
+    def __init__(self):
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    def put(self, key: str, content: bytes) -> bool:
+        with self._lock:
+            if key in self._blobs:
+                return False
+            self._blobs[key] = bytes(content)
+            return True
+
+    def get(self, key: str) -> bytes:
+        return self._blobs[key]
+
+    def open(self, key: str) -> BinaryIO:
+        return BytesIO(self.get(key))
+
+    def exists(self, key: str) -> bool:
+        return key in self._blobs
+
+    def delete(self, key: str):
+        with self._lock:
+            self._blobs.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._blobs.clear()
+
+
+class InstrumentedBlobStore(BlobStore):
+    """Wraps another store, counting its calls and the bytes written and read in the process metrics
+    """
+    def __init__(self, store: BlobStore):
+        self.store = store
+
+    def put(self, key: str, content: bytes) -> bool:
+        metrics.inc('blob_operations_total', operation='put')
+        stored = self.store.put(key, content)
+        if stored:
+            metrics.inc('blob_bytes_total', len(content), direction='written')
+        return stored
+
+    def put_stream(self,
+                   chunks: Iterable[bytes],
+                   hasher_factory: Callable = hashlib.md5,
+                   max_bytes: int = None) -> Tuple[str, int]:
+        metrics.inc('blob_operations_total', operation='put_stream')
+        key, size = self.store.put_stream(chunks, hasher_factory=hasher_factory, max_bytes=max_bytes)
+        metrics.inc('blob_bytes_total', size, direction='written')
+        return key, size
+
+    def get(self, key: str) -> bytes:
+        metrics.inc('blob_operations_total', operation='get')
+        content = self.store.get(key)
+        metrics.inc('blob_bytes_total', len(content), direction='read')
+        return content
+
+    def open(self, key: str) -> BinaryIO:
+        metrics.inc('blob_operations_total', operation='open')
+        return self.store.open(key)
+
+    def exists(self, key: str) -> bool:
+        metrics.inc('blob_operations_total', operation='exists')
+        return self.store.exists(key)
+
+    def delete(self, key: str):
+        metrics.inc('blob_operations_total', operation='delete')
+        self.store.delete(key)
+
+    def clear(self):
+        self.store.clear()
+
+    def path(self, key: str) -> Optional[str]:
+        return self.store.path(key)
+
+
+def _limit(chunks: Iterable[bytes], max_bytes: int = None) -> Iterable[bytes]:
+    """Passes chunks through, failing as soon as more than max_bytes went by
+    """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise PayloadTooLargeException(f'Image is larger than {max_bytes} bytes')
+        yield chunk
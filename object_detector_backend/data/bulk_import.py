@@ -0,0 +1,264 @@
+import io
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List
+
+from object_detector_backend.data.cache import AnnotationCache
+from object_detector_backend.data.detection import detect_labels_many
+from object_detector_backend.data.fetch import ImageFetcher
+from object_detector_backend.data.ingest import ImageNormalizer
+from object_detector_backend.data.models import ImageModel
+from object_detector_backend.data.persistence import Database, detection_key
+from object_detector_backend.data.similarity import dhash
+from object_detector_backend.util.exceptions import InvalidInputException
+
+# files picked up when importing a directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+
+class ImportItem():
+    """A file or url to import. source identifies it in the checkpoint
+    """
+    def __init__(self, source: str, path: str = None, url: str = None, filename: str = None):
+        self.source = source
+        self.path = path
+        self.url = url
+        self.filename = filename
+
+
+def iter_directory(root: str, extensions: Iterable[str] = IMAGE_EXTENSIONS) -> Iterator[ImportItem]:
+    """Image files below root in a stable order, named by their path relative to root
+    """
+    extensions = tuple(e.lower() for e in extensions)
+    for directory, subdirectories, filenames in os.walk(root):
+        # walking in sorted order lets a checkpoint resume by position
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if not(filename.lower().endswith(extensions)):
+                continue
+
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            yield ImportItem(source=name, path=path, filename=name)
+
+
+def iter_manifest(path: str) -> Iterator[ImportItem]:
+    """Urls listed one per line, blank lines and lines starting with # are skipped
+    """
+    with open(path) as f:
+        for line in f:
+            url = line.strip()
+            if url and not(url.startswith('#')):
+                yield ImportItem(source=url, url=url)
+
+
+class ImportCheckpoint():
+    """Progress of an import saved after every batch, so an interrupted import resumes
+    after the last batch it completed
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict:
+        if self.path is None or not(os.path.exists(self.path)):
+            return {}
+
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, state: dict):
+        if self.path is None:
+            return
+
+        # replace the file at once so a crash never leaves a partial checkpoint
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+
+class BulkImporter():
+    """Imports images without going through the HTTP API.
+    Files are read or urls fetched by workers threads, which also validate, hash and store the content.
+    Each batch is deduplicated by checksum and written in one transaction, then only new content
+    is annotated, by detection_workers threads at a time each sending detection_batch_size images
+    in one annotate_batch call of detectors supporting it. Images sharing content within a batch are
+    annotated once and the labels copied to the others
+    """
+    def __init__(self,
+                 database: Database,
+                 detector=None,
+                 annotation_cache: AnnotationCache = None,
+                 fetcher: ImageFetcher = None,
+                 normalizer: ImageNormalizer = None,
+                 workers: int = 8,
+                 detection_workers: int = 4,
+                 detection_batch_size: int = 16,
+                 batch_size: int = 500,
+                 chunk_size: int = 64 * 1024,
+                 max_bytes: int = None,
+                 hash_algorithm: str = 'md5',
+                 phash: bool = True,
+                 checkpoint: ImportCheckpoint = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.database = database
+        self.detector = detector
+        self.annotation_cache = annotation_cache
+        self.fetcher = fetcher
+        self.normalizer = normalizer or ImageNormalizer(max_bytes=max_bytes)
+        self.workers = workers
+        self.detection_workers = detection_workers
+        self.detection_batch_size = detection_batch_size
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.hash_algorithm = hash_algorithm
+        self.phash = phash
+        self.checkpoint = checkpoint or ImportCheckpoint(None)
+
+    def run(self, items: Iterable[ImportItem], name: str) -> dict:
+        """Imports items of the input called name, i.e the directory or manifest path.
+        Returns counts of processed, imported, duplicate, failed and annotated images
+        """
+        state = self.checkpoint.load()
+        if state and state.get('input') != name:
+            raise InvalidInputException(f"Checkpoint {self.checkpoint.path} belongs to {state.get('input')}, not {name}")
+
+        stats = {key: state.get(key, 0) for key in ('processed', 'imported', 'duplicates', 'failed', 'annotated')}
+        items = iter(items)
+
+        if stats['processed']:
+            skipped = list(itertools.islice(items, stats['processed']))
+            if not(skipped) or skipped[-1].source != state.get('last'):
+                raise InvalidInputException(
+                    f'Input {name} changed since checkpoint {self.checkpoint.path} was written, delete it to start over')
+            self.logger.info(f"Resuming {name} after {stats['processed']} images")
+
+        start = time.perf_counter()
+        resumed_at = stats['processed']
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='import') as read_executor, \
+                ThreadPoolExecutor(max_workers=self.detection_workers, thread_name_prefix='import-detect') as detect_executor:
+            while True:
+                batch = list(itertools.islice(items, self.batch_size))
+                if not(batch):
+                    break
+
+                self._import_batch(batch, stats, read_executor, detect_executor)
+                stats['processed'] += len(batch)
+                self.checkpoint.save(dict(stats, input=name, last=batch[-1].source))
+
+                elapsed = time.perf_counter() - start
+                rate = (stats['processed'] - resumed_at) / elapsed if elapsed else 0.0
+                self.logger.info(f"{stats['processed']} processed, {stats['imported']} imported, "
+                                 f"{stats['duplicates']} duplicates, {stats['failed']} failed, "
+                                 f"{stats['annotated']} annotated, {rate:.1f} images/sec")
+
+        elapsed = time.perf_counter() - start
+        stats['seconds'] = round(elapsed, 2)
+        stats['images_per_second'] = round((stats['processed'] - resumed_at) / elapsed, 2) if elapsed else 0.0
+        return stats
+
+    def _import_batch(self, batch: List[ImportItem], stats: dict, read_executor, detect_executor):
+        images = []
+        for item, loaded in zip(batch, read_executor.map(self._load_or_error, batch)):
+            if isinstance(loaded, Exception):
+                self.logger.warning(f'Could not import {item.source}: {loaded}')
+                stats['failed'] += 1
+            else:
+                images.append(loaded)
+
+        db_api = self.database.api()
+        try:
+            # one lookup and one insert for the whole batch
+            stored = db_api.add_images(images)
+            new_images = [s for image, s in zip(images, stored) if s['id'] == image.id]
+            stats['imported'] += len(new_images)
+            stats['duplicates'] += len(images) - len(new_images)
+
+            if self.detector is not None and new_images:
+                stats['annotated'] += self._detect(db_api, new_images, detect_executor)
+        finally:
+            self.database.remove_session()
+
+    def _load_or_error(self, item: ImportItem):
+        try:
+            return self._load(item)
+        except Exception as e:
+            return e
+
+    def _load(self, item: ImportItem) -> ImageModel:
+        """Reads or fetches an item and streams it into the blob store, runs on a worker thread
+        """
+        if item.url is not None:
+            fetched = self.fetcher.fetch(item.url)
+            stream = io.BytesIO(fetched.content)
+            filename = fetched.filename
+        else:
+            stream = open(item.path, 'rb')
+            filename = item.filename
+
+        with stream:
+            normalized = self.normalizer.normalize(stream)
+            image = ImageModel.from_stream(id=str(uuid.uuid1()),
+                                           filename=filename,
+                                           stream=normalized.stream,
+                                           blob_store=self.database.blob_store,
+                                           chunk_size=self.chunk_size,
+                                           max_bytes=self.max_bytes,
+                                           hash_algorithm=self.hash_algorithm)
+
+        image.url = item.url
+        image.filetype = normalized.filetype
+
+        if normalized.detection_content is not None:
+            self.database.blob_store.put(detection_key(image.content_key), normalized.detection_content)
+
+        if self.phash:
+            if normalized.detection_content is not None:
+                image.phash = dhash(normalized.detection_content)
+            else:
+                with self.database.blob_store.open(image.content_key) as f:
+                    image.phash = dhash(f)
+
+        return image
+
+    def _detect(self, db_api, images: List[dict], executor) -> int:
+        """Annotates one image per checksum and copies its labels to the others.
+        Returns the number of images which got labels
+        """
+        by_checksum = {}
+        for image in images:
+            by_checksum.setdefault(image['check_sum'], []).append(image)
+
+        representatives = [same_content[0] for same_content in by_checksum.values()]
+        chunks = [representatives[i:i + self.detection_batch_size]
+                  for i in range(0, len(representatives), self.detection_batch_size)]
+
+        annotated = 0
+        for chunk, results in zip(chunks, executor.map(self._detect_chunk, chunks)):
+            for image, labels in zip(chunk, results):
+                if isinstance(labels, Exception):
+                    self.logger.warning(f"Could not annotate {image['filename']}: {labels}")
+                    continue
+
+                annotated += 1
+                for duplicate in by_checksum[image['check_sum']][1:]:
+                    db_api.copy_labels(image['id'], duplicate['id'], [self.detector.source])
+                    annotated += 1
+
+        return annotated
+
+    def _detect_chunk(self, images: List[dict]) -> list:
+        # runs on a detection thread with its own session
+        try:
+            return detect_labels_many(self.database.api(), images, self.detector, self.annotation_cache)
+        except Exception as e:
+            return [e] * len(images)
+        finally:
+            self.database.remove_session()
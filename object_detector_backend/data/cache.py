@@ -0,0 +1,49 @@
+import logging
+import threading
+from typing import List, Optional
+
+from object_detector_backend.data.persistence import Database
+from object_detector_backend.util.lru import LRUCache
+
+
+class AnnotationCache():
+    """Two tier cache of detector labels keyed by (checksum, detector source, detector version).
+    A bounded in-memory LRU sits in front of the annotations table so repeated
+    uploads of the same content never call the detector again
+    """
+    def __init__(self, database: Database, max_entries: int = 1024, ttl: float = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.database = database
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, checksum: str, source: str, version: str) -> Optional[List[dict]]:
+        key = (checksum, source, version)
+        labels = self.memory.get(key)
+
+        if labels is None:
+            labels = self.database.api().get_annotation(checksum, source, version, max_age=self.ttl)
+            if labels is not None:
+                self.memory.set(key, labels)
+
+        with self._lock:
+            if labels is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return labels
+
+    def put(self, checksum: str, source: str, version: str, labels: List[dict]):
+        self.database.api().put_annotation(checksum, source, version, labels)
+        self.memory.set((checksum, source, version), labels)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory': self.memory.stats(),
+        }
@@ -0,0 +1,271 @@
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Executor, TimeoutError
+from typing import Dict, List, Optional, Tuple
+
+from object_detector_backend.data.cache import AnnotationCache
+from object_detector_backend.data.models import LabelModel
+from object_detector_backend.data.persistence import DatabaseAPI, normalize_label
+from object_detector_backend.data.similarity import SimilarityIndex
+from object_detector_backend.data.vision import annotate_batch_timed, annotate_timed
+from object_detector_backend.util.exceptions import InvalidInputException
+
+logger = logging.getLogger(__name__)
+
+AGGREGATED_SOURCE = 'Aggregated'
+AGGREGATIONS = ('mean', 'max', 'weighted')
+
+
+def detect_labels(db_api: DatabaseAPI,
+                  image: dict,
+                  detector,
+                  annotation_cache: AnnotationCache = None) -> List[dict]:
+    """Annotates an image with the detector and stores the labels.
+    Labels of identical content annotated before are reused from the annotation cache.
+    Returns labels of the image
+    """
+    result = detect_labels_many(db_api, [image], detector, annotation_cache)[0]
+    if isinstance(result, Exception):
+        raise result
+
+    return result
+
+
+def detect_labels_many(db_api: DatabaseAPI,
+                       images: List[dict],
+                       detector,
+                       annotation_cache: AnnotationCache = None) -> list:
+    """Annotates several images and stores their labels.
+    Images missing from the annotation cache are sent together, in one annotate_batch call of
+    detectors supporting it or submitted to a BatchingAnnotator which batches them.
+    Returns labels per image, images which failed to annotate get an Exception instead
+    """
+    detected = [None] * len(images)
+
+    # identical content was annotated before, reuse its labels
+    if annotation_cache is not None:
+        for i, image in enumerate(images):
+            detected[i] = annotation_cache.get(image['check_sum'],
+                                               detector.source,
+                                               detector.version)
+
+    misses = [i for i, labels in enumerate(detected) if labels is None]
+    contents = [db_api.fetch_detection_content_by_id(images[i]['id']) for i in misses]
+
+    for i, labels in zip(misses, _annotate_many(detector, contents)):
+        detected[i] = labels
+
+        if annotation_cache is not None and not(isinstance(labels, Exception)):
+            annotation_cache.put(images[i]['check_sum'],
+                                 detector.source,
+                                 detector.version,
+                                 labels)
+
+    # labels of every image are written in one transaction
+    db_api.add_labels([_to_label_model(image['id'], label, detector.source)
+                       for image, detected_labels in zip(images, detected)
+                       if not(isinstance(detected_labels, Exception))
+                       for label in detected_labels])
+
+    to_return = []
+    for image, detected_labels in zip(images, detected):
+        if isinstance(detected_labels, Exception):
+            to_return.append(detected_labels)
+        else:
+            to_return.append(db_api.get_labels_by_image_id(image['id']))
+
+    return to_return
+
+
+def detect_labels_fan_out(db_api: DatabaseAPI,
+                          image: dict,
+                          detectors: Dict[str, object],
+                          executor: Executor,
+                          timeouts: Dict[str, float] = None,
+                          default_timeout: float = 10.0,
+                          method: str = 'mean',
+                          weights: Dict[str, float] = None,
+                          annotation_cache: AnnotationCache = None) -> Tuple[List[dict], Dict[str, str]]:
+    """Annotates an image with several detectors concurrently and stores the labels
+    of each detector along with their aggregate under the 'Aggregated' source.
+    A detector which does not answer within its timeout is left out of the aggregate,
+    its result is still cached once it arrives.
+    Returns labels of the image and the outcome per detector: done, timeout or failed
+    """
+    if method not in AGGREGATIONS:
+        raise InvalidInputException(f"'aggregation' must be one of {', '.join(AGGREGATIONS)}")
+
+    timeouts = timeouts or {}
+    results = OrderedDict()
+    futures = {}
+    content = None
+
+    for name, detector in detectors.items():
+        if annotation_cache is not None:
+            results[name] = annotation_cache.get(image['check_sum'], detector.source, detector.version)
+            if results[name] is not None:
+                continue
+
+        if content is None:
+            content = db_api.fetch_detection_content_by_id(image['id'])
+
+        futures[name] = executor.submit(_annotate_and_cache,
+                                        detector,
+                                        content,
+                                        image['check_sum'],
+                                        annotation_cache)
+
+    start = time.monotonic()
+    statuses = {name: 'done' for name in detectors}
+
+    for name, future in futures.items():
+        deadline = start + timeouts.get(name, default_timeout)
+        try:
+            results[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            logger.warning(f'Detector {name} did not answer within its timeout')
+            statuses[name] = 'timeout'
+            results.pop(name, None)
+        except Exception:
+            logger.exception(f'Detector {name} failed')
+            statuses[name] = 'failed'
+            results.pop(name, None)
+
+    to_store = []
+    for name, labels in results.items():
+        to_store.extend(_to_label_model(image['id'], label, detectors[name].source) for label in labels)
+
+    if results:
+        to_store.extend(_to_label_model(image['id'], label, AGGREGATED_SOURCE)
+                        for label in aggregate_labels(results, method=method, weights=weights))
+
+    # raw and aggregated labels are written in one transaction
+    db_api.add_labels(to_store)
+
+    return db_api.get_labels_by_image_id(image['id']), statuses
+
+
+def reuse_near_duplicate_labels(db_api: DatabaseAPI,
+                                image: dict,
+                                phash: str,
+                                similarity_index: SimilarityIndex,
+                                sources: List[str],
+                                max_distance: int = 4,
+                                candidates: int = 5) -> Optional[str]:
+    """Copies labels of a near duplicate, i.e a re-encoded or resized copy, instead of annotating the image again.
+    Only a near duplicate labeled by every source is used.
+    Returns id of the near duplicate whose labels were copied, None if there is none
+    """
+    matches = [image_id for _, image_id in similarity_index.search(db_api, phash, max_distance)
+               if image_id != image['id']]
+
+    for image_id in matches[:candidates]:
+        labeled_sources = {label['source'] for label in db_api.get_labels_by_image_id(image_id)}
+        if all(source in labeled_sources for source in sources):
+            db_api.copy_labels(image_id, image['id'], sources)
+            return image_id
+
+    return None
+
+
+def aggregate_labels(results: Dict[str, List[dict]],
+                     method: str = 'mean',
+                     weights: Dict[str, float] = None) -> List[dict]:
+    """Merges labels of several detectors, matching labels case insensitively.
+    Scores are combined over the detectors reporting a label:
+    'mean' averages them, 'max' keeps the highest and 'weighted' averages
+    them with per detector weights (1 by default). Returns labels ordered by score
+    """
+    weights = weights or {}
+    merged = OrderedDict()
+
+    for name, labels in results.items():
+        weight = weights.get(name, 1.0) if method == 'weighted' else 1.0
+
+        for label in labels:
+            entry = merged.setdefault(normalize_label(label['label']), {
+                'label': label['label'],
+                'scores': [],
+                'topicalities': [],
+                'weights': [],
+            })
+            entry['scores'].append(label['score'] or 0.0)
+            entry['topicalities'].append(label['topicality'] or 0.0)
+            entry['weights'].append(weight)
+
+    to_return = []
+    for entry in merged.values():
+        if method == 'max':
+            score = max(entry['scores'])
+            topicality = max(entry['topicalities'])
+        else:
+            total = sum(entry['weights']) or 1.0
+            score = sum(s * w for s, w in zip(entry['scores'], entry['weights'])) / total
+            topicality = sum(t * w for t, w in zip(entry['topicalities'], entry['weights'])) / total
+
+        to_return.append({
+            'label': entry['label'],
+            'score': score,
+            'topicality': topicality
+        })
+
+    return sorted(to_return, key=lambda label: label['score'], reverse=True)
+
+
+def _annotate_and_cache(detector, content: bytes, checksum: str, annotation_cache: AnnotationCache = None) -> list:
+    """Runs on an executor thread so a result is cached even when it misses its deadline
+    """
+    labels = annotate_timed(detector, content)
+
+    if annotation_cache is not None:
+        try:
+            annotation_cache.put(checksum, detector.source, detector.version, labels)
+        except Exception:
+            logger.exception(f'Caching labels of {detector.source} failed')
+        finally:
+            # executor threads are reused, release their thread local session
+            annotation_cache.database.remove_session()
+
+    return labels
+
+
+def _annotate_many(detector, contents: List[bytes]) -> list:
+    """Annotates contents, submitting them all at once to detectors which batch submitted images
+    and sending several in one annotate_batch call to detectors supporting it
+    """
+    if not(contents):
+        return []
+
+    if len(contents) > 1 and hasattr(detector, 'annotate_batch'):
+        return annotate_batch_timed(detector, contents)
+
+    if hasattr(detector, 'submit'):
+        futures = [detector.submit(content) for content in contents]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    results = []
+    for content in contents:
+        try:
+            results.append(annotate_timed(detector, content))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _to_label_model(image_id: str, label: dict, source: str) -> LabelModel:
+    return LabelModel(
+        id=str(uuid.uuid1()),
+        label=label['label'],
+        score=label['score'],
+        topicality=label['topicality'],
+        image_id=image_id,
+        source=source
+    )
@@ -0,0 +1,66 @@
+import json
+import zlib
+from typing import BinaryIO, Iterable, Iterator
+
+# bytes of encoded lines collected before a chunk is handed out
+CHUNK_SIZE = 64 * 1024
+
+
+def ndjson_chunks(records: Iterable[dict], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Encodes records as newline delimited json, one record per line,
+    handing out chunks of about chunk_size bytes instead of a write per record
+    """
+    buffer = []
+    size = 0
+    for record in records:
+        line = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+        buffer.append(line)
+        size += len(line)
+
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Compresses chunks into a gzip stream on the fly
+    """
+    # 16 + MAX_WBITS writes the gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export_images(db_api,
+                  out: BinaryIO,
+                  gzip: bool = False,
+                  batch_size: int = 1000,
+                  **filters) -> int:
+    """Writes every image with its labels to out as newline delimited json.
+    filters are labels, match and min_score of DatabaseAPI.iter_images.
+    Returns the number of exported images
+    """
+    count = 0
+
+    def counted(records):
+        nonlocal count
+        for record in records:
+            count += 1
+            yield record
+
+    chunks = ndjson_chunks(counted(db_api.iter_images(batch_size=batch_size, **filters)))
+    if gzip:
+        chunks = gzip_chunks(chunks)
+
+    for chunk in chunks:
+        out.write(chunk)
+
+    return count
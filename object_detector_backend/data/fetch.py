@@ -0,0 +1,96 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from object_detector_backend.util.exceptions import PayloadTooLargeException
+
+
+class FetchedImage():
+    """Content of an image downloaded from a URL
+    """
+    def __init__(self, url: str, content: bytes, content_type: str = None):
+        self.url = url
+        self.content = content
+        self.content_type = content_type
+        self.filename = url.split('/')[-1]
+
+
+class ImageFetcher():
+    """Downloads images over a pooled HTTP session.
+    Downloads are bounded by connect/read timeouts, a total time limit and a size cap
+    enforced while streaming. The content is hashed once it is stored, not here
+    """
+    def __init__(self,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 10,
+                 max_time: float = 30,
+                 max_bytes: int = 20 * 1024 * 1024,
+                 chunk_size: int = 64 * 1024,
+                 pool_size: int = 10,
+                 max_workers: int = 8):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_time = max_time
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+        # connections are reused across requests to the same host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url: str) -> FetchedImage:
+        deadline = time.monotonic() + self.max_time
+
+        with self.session.get(url, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+
+            declared = resp.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                raise PayloadTooLargeException(
+                    f'Image at {url} is larger than {self.max_bytes} bytes')
+
+            chunks = []
+            size = 0
+
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise PayloadTooLargeException(
+                        f'Image at {url} is larger than {self.max_bytes} bytes')
+
+                if time.monotonic() > deadline:
+                    raise requests.exceptions.Timeout(
+                        f'Downloading {url} took longer than {self.max_time} seconds')
+
+                chunks.append(chunk)
+
+            return FetchedImage(url=url,
+                                content=b''.join(chunks),
+                                content_type=resp.headers.get('Content-Type'))
+
+    def fetch_many(self, urls: List[str]) -> list:
+        """Downloads urls concurrently.
+        Returns a FetchedImage per url, urls which failed to download get an Exception instead
+        """
+        def fetch_or_error(url):
+            try:
+                return self.fetch(url)
+            except Exception as e:
+                self.logger.warning(f'Fetching {url} failed: {e}')
+                return e
+
+        if len(urls) <= 1:
+            return [fetch_or_error(url) for url in urls]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            return list(executor.map(fetch_or_error, urls))
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,157 @@
+import io
+import logging
+import os
+from typing import BinaryIO, Optional
+
+from object_detector_backend.util.exceptions import InvalidInputException, PayloadTooLargeException
+
+# optional dependency of re-encoding and detection copies: pip install pillow
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# leading bytes of each supported image type
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+
+# formats images can be re-encoded to
+ENCODE_FORMATS = {
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'webp': 'WEBP',
+}
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Image type from the magic bytes at the start of the content, None if it is not a supported image
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+
+    for signature, filetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return filetype
+
+    return None
+
+
+class NormalizedImage():
+    """Content to store after the ingest stage, along with a smaller copy to send to detectors
+    """
+    def __init__(self,
+                 stream: BinaryIO,
+                 filetype: str,
+                 original_bytes: int,
+                 stored_bytes: int,
+                 detection_content: bytes = None):
+        self.stream = stream
+        self.filetype = filetype
+        self.original_bytes = original_bytes
+        self.stored_bytes = stored_bytes
+        self.detection_content = detection_content
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - self.stored_bytes
+
+    def to_dict(self) -> dict:
+        return {
+            'filetype': self.filetype,
+            'original_bytes': self.original_bytes,
+            'stored_bytes': self.stored_bytes,
+            'bytes_saved': self.bytes_saved,
+            'detection_bytes': len(self.detection_content) if self.detection_content is not None
+                else self.stored_bytes,
+        }
+
+
+class ImageNormalizer():
+    """Ingest stage run on uploads before they are stored.
+    Validates the content is an image by its magic bytes, optionally re-encodes it to format
+    with quality and at most max_dimension pixels on its longer side, and makes a copy of at
+    most detection_size pixels for detectors. Re-encoding and detection copies need Pillow,
+    without it contents are only validated
+    """
+    def __init__(self,
+                 format: str = None,
+                 quality: int = 85,
+                 max_dimension: int = None,
+                 detection_size: int = None,
+                 max_bytes: int = None):
+        if format is not None and format not in ENCODE_FORMATS:
+            raise InvalidInputException(f"Image format must be one of {', '.join(ENCODE_FORMATS)}")
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.format = format
+        self.quality = quality
+        self.max_dimension = max_dimension
+        self.detection_size = detection_size
+        self.max_bytes = max_bytes
+
+    def normalize(self, stream: BinaryIO) -> NormalizedImage:
+        """Normalizes a seekable stream of uploaded content
+        """
+        original_bytes = stream.seek(0, os.SEEK_END)
+        stream.seek(0)
+        if self.max_bytes is not None and original_bytes > self.max_bytes:
+            raise PayloadTooLargeException(f'Image is larger than {self.max_bytes} bytes')
+
+        filetype = sniff_image_type(stream.read(16))
+        stream.seek(0)
+        if filetype is None:
+            raise InvalidInputException('Content is not a supported image type')
+
+        normalized = NormalizedImage(stream, filetype, original_bytes, original_bytes)
+        if Image is None or not(self.format or self.max_dimension or self.detection_size):
+            return normalized
+
+        try:
+            with Image.open(stream) as image:
+                size = max(image.size)
+                reencode = (self.format is not None and self.format != filetype) or \
+                    (self.max_dimension is not None and size > self.max_dimension)
+
+                # jpeg decoding downscales cheaply when the full size is not needed
+                smallest = self.max_dimension if reencode else self.detection_size
+                if smallest:
+                    image.draft('RGB', (smallest, smallest))
+
+                if reencode:
+                    encoded = self._encode(image, self.max_dimension, self.format or filetype)
+                    normalized.stream = io.BytesIO(encoded)
+                    normalized.filetype = self.format or filetype
+                    normalized.stored_bytes = len(encoded)
+
+                if self.detection_size is not None and size > self.detection_size:
+                    normalized.detection_content = self._encode(image, self.detection_size, 'jpeg')
+
+        except (OSError, Image.DecompressionBombError) as e:
+            raise InvalidInputException(f'Content is not a readable image: {e}')
+
+        finally:
+            stream.seek(0)
+
+        return normalized
+
+    def _encode(self, image, max_dimension: Optional[int], filetype: str) -> bytes:
+        # orientation is applied to the pixels as re-encoded copies drop the exif tag
+        image = ImageOps.exif_transpose(image)
+        if max_dimension is not None and max(image.size) > max_dimension:
+            image = image.copy()
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        if filetype == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        out = io.BytesIO()
+        image.save(out, format=ENCODE_FORMATS.get(filetype, filetype.upper()), quality=self.quality, optimize=True)
+        return out.getvalue()
@@ -0,0 +1,79 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable
+
+from object_detector_backend.data.detection import detect_labels
+from object_detector_backend.data.persistence import Database
+
+
+class JobQueue():
+    """Runs background jobs. Implement this interface to hand jobs to another queue,
+    i.e a message broker consumed by separate worker processes
+    """
+    def submit(self, fn: Callable, *args, **kwargs):
+        raise NotImplementedError
+
+    def drain(self, timeout: float = None) -> bool:
+        """Waits for submitted jobs to finish. Returns False if jobs are still running after timeout
+        """
+        raise NotImplementedError
+
+    def shutdown(self, wait: bool = True):
+        raise NotImplementedError
+
+
+class ThreadPoolJobQueue(JobQueue):
+    """Runs jobs on a pool of threads within the web process
+    """
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='detection')
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future = self.executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future: Future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def drain(self, timeout: float = None) -> bool:
+        with self._lock:
+            pending = set(self._pending)
+        _, not_done = wait(pending, timeout=timeout)
+        return not(not_done)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+
+def run_detection_job(database: Database,
+                      job_id: str,
+                      image: dict,
+                      detect: Callable = detect_labels,
+                      **kwargs):
+    """Detects labels of an image in the background and records the outcome on the job.
+    detect is called with a DatabaseAPI, the image and kwargs, i.e detect_labels with a detector
+    """
+    logger = logging.getLogger(__name__)
+    db_api = database.api()
+
+    try:
+        db_api.update_job(job_id, status='running')
+        detect(db_api, image, **kwargs)
+        db_api.update_job(job_id, status='done')
+
+    except Exception as e:
+        logger.exception(f'Detection job {job_id} failed')
+        db_api.session.rollback()
+        db_api.update_job(job_id, status='failed', error=str(e))
+
+    finally:
+        # worker threads are reused, release the thread local session
+        database.remove_session()
@@ -0,0 +1,108 @@
+import hashlib
+import io
+import logging
+from typing import List
+
+from object_detector_backend.data.vision import Detector
+
+# optional dependencies of the local detector: pip install onnxruntime numpy pillow
+try:
+    import numpy as np
+    import onnxruntime
+    from PIL import Image
+except ImportError:
+    np = None
+    onnxruntime = None
+    Image = None
+
+
+class OnnxDetector(Detector):
+    """Annotates images on the CPU with an image classification model in ONNX format.
+    The model takes a batch of normalized RGB images (N, 3, size, size) and returns
+    class scores (N, classes). labels_path lists one class name per line.
+    The model is loaded once in the constructor, the registry keeps one instance per process
+    """
+    source = 'ONNX'
+
+    def __init__(self,
+                 model_path: str,
+                 labels_path: str,
+                 input_size: int = 224,
+                 mean: List[float] = (0.485, 0.456, 0.406),
+                 std: List[float] = (0.229, 0.224, 0.225),
+                 top_k: int = 10,
+                 min_score: float = 0.05,
+                 threads: int = None):
+        if onnxruntime is None:
+            raise ImportError('OnnxDetector requires onnxruntime, numpy and pillow to be installed')
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.input_size = input_size
+        self.mean = np.array(mean, dtype=np.float32).reshape(3, 1, 1)
+        self.std = np.array(std, dtype=np.float32).reshape(3, 1, 1)
+        self.top_k = top_k
+        self.min_score = min_score
+
+        with open(labels_path) as f:
+            self.labels = [line.strip() for line in f if line.strip()]
+
+        # cached annotations are invalidated whenever the model file changes
+        with open(model_path, 'rb') as f:
+            self.version = hashlib.md5(f.read()).hexdigest()
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+
+        self.session = onnxruntime.InferenceSession(model_path,
+                                                    sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def warmup(self):
+        dummy = np.zeros((1, 3, self.input_size, self.input_size), dtype=np.float32)
+        self.session.run(None, {self.input_name: dummy})
+
+    def annotate(self, content) -> list:
+        """Returns list of labels with score and topicality ordered by score
+        """
+        return self.annotate_batch([content])[0]
+
+    def annotate_batch(self, contents: List[bytes]) -> list:
+        """Runs the model once over a batch of images
+        """
+        for content in contents:
+            if content is None:
+                raise Exception('content of an image cannot be none')
+
+        batch = np.stack([self._preprocess(content) for content in contents])
+        scores = self.session.run(None, {self.input_name: batch})[0]
+
+        return [self._to_labels(image_scores) for image_scores in scores]
+
+    def _preprocess(self, content: bytes):
+        image = Image.open(io.BytesIO(content)).convert('RGB')
+        image = image.resize((self.input_size, self.input_size), Image.BILINEAR)
+
+        pixels = np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255.0
+        return (pixels - self.mean) / self.std
+
+    def _to_labels(self, logits) -> list:
+        # softmax over class scores
+        exp = np.exp(logits - np.max(logits))
+        probabilities = exp / exp.sum()
+
+        to_return = []
+        for index in np.argsort(probabilities)[::-1][:self.top_k]:
+            score = float(probabilities[index])
+            if score < self.min_score:
+                break
+
+            to_return.append({
+                'label': self.labels[index],
+                'score': score,
+                # a classifier has no notion of topicality, use its confidence
+                'topicality': score
+            })
+
+        return to_return
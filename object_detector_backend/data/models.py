@@ -1,40 +1,53 @@
-import hashlib
-import requests
 from object_detector_backend.util.exceptions import InvalidInputException
+from object_detector_backend.util.hashing import checksum as content_checksum, get_hasher
 
 
 class ImageModel():
-    """Image class to hold image metadata and its content
+    """Image class to hold image metadata and its content.
+    Images from a URL are downloaded with an ImageFetcher, uploads are stored with from_stream
     """
     def __init__(self,
                  id: str,
                  filename:str = None,
                  url: str = None,
                  content = None,
-                 filetype:str = None):
+                 filetype:str = None,
+                 checksum: str = None,
+                 content_key: str = None,
+                 hash_algorithm: str = 'md5',
+                 phash: str = None):
         self.id = id
         self.url = url
         self.content = content
         self.filename = filename
         self.filetype = filetype
-        self.checksum = None
+        self.checksum = checksum
+        self.content_key = content_key # set when content was already streamed into the blob store
+        self.phash = phash # perceptual hash used to find near duplicates
 
-        if self.url and self.content is None:
-            resp = requests.get(self.url, stream=True)
-            resp.raise_for_status()
-            self.content = resp.content
-            self.filename = url.split('/')[-1]
-
-        if self.content is None:
+        if self.content is None and self.content_key is None:
             raise Exception('Image model should have file content')
 
-        self.checksum = hashlib.md5(self.content).hexdigest()
+        if self.checksum is None:
+            self.checksum = content_checksum(self.content, hash_algorithm)
 
         if not(self.filetype):
             filename_splits = self.filename.split('.')
             if len(filename_splits) > 1:
                 self.filetype = filename_splits[-1]
 
+    @classmethod
+    def from_stream(cls, id: str, filename: str, stream, blob_store, chunk_size: int = 64 * 1024,
+                    max_bytes: int = None, hash_algorithm: str = 'md5') -> 'ImageModel':
+        """Streams a file object into the blob store, hashing it chunk by chunk
+        instead of holding the whole image in memory
+        """
+        chunks = iter(lambda: stream.read(chunk_size), b'')
+        key, _ = blob_store.put_stream(chunks,
+                                       hasher_factory=get_hasher(hash_algorithm),
+                                       max_bytes=max_bytes)
+        return cls(id=id, filename=filename, checksum=key, content_key=key)
+
 
 class LabelModel():
     """Label class to hold label name, certainty of the label, and image id the label is related to.
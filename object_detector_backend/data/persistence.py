@@ -1,29 +1,62 @@
-import os
-from typing import List
+import base64
+import hashlib
+import json
+import threading
+import time
+import uuid
+from io import BytesIO
+from datetime import datetime, timedelta
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
 import logging
 
-from sqlalchemy import create_engine, ForeignKey, Column, Integer, String, LargeBinary, Float, func
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, inspect, select, text, ForeignKey, Column, Integer, String, Text, LargeBinary, Float, DateTime, Index, func, and_, or_, desc
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, selectinload, deferred, load_only, validates
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.sqltypes import LargeBinary
 
+from object_detector_backend.data.blobs import BlobStore, InstrumentedBlobStore, LocalBlobStore
 from object_detector_backend.data.models import ImageModel
+from object_detector_backend.data.response_cache import ResponseCache
 from object_detector_backend.data.models import LabelModel
+from object_detector_backend.data.similarity import dhash
+from object_detector_backend.util.exceptions import InvalidInputException, NotFoundException
+from object_detector_backend.util.metrics import observe_query, stage
 
 
 Base = declarative_base()
 
+def normalize_label(label: str) -> str:
+    """Case insensitive form of a label used for indexed label search
+    """
+    return label.strip().casefold() if label is not None else None
+
+
 class Labels(Base):
     """Labels mapping for each image
     """
     __tablename__ = 'labels'
+    __table_args__ = (
+        Index('ix_labels_label_normalized_image_id', 'label_normalized', 'image_id'),
+        Index('ix_labels_image_id', 'image_id'),
+    )
     id = Column(String, primary_key=True)
     label = Column(String)
+    label_normalized = Column(String) # kept in sync with label, searched instead of upper(label)
     score = Column(Float) # order by certainty when fetching images
     topicality = Column(Float) # order by certainty when fetching images
     image_id = Column(String, ForeignKey('images.id'))
     source = Column(String)
 
+    @validates('label')
+    def _normalize_label(self, key, label):
+        self.label_normalized = normalize_label(label)
+        return label
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -50,26 +83,89 @@ class Labels(Base):
                    self.source))
 
 
+# a unique index rather than a constraint so upgrade_schema can add it to sqlite tables.
+# source is coalesced as NULLs are distinct in a unique index, so labels without a source would repeat
+Index('uq_labels_image_id_label_coalesced_source',
+      Labels.image_id, Labels.label, func.coalesce(Labels.source, ''), unique=True)
+
+# unique indexes of older schemas, dropped by upgrade_schema in favour of the ones above
+REPLACED_INDEXES = {
+    'labels': ['uq_labels_image_id_label_source'],
+}
+
+
+# source of label statistics counted over every source
+ALL_SOURCES = '*'
+
+
+class LabelStats(Base):
+    """Per label aggregates kept up to date by DatabaseAPI.add_labels, so label facets
+    are read without grouping the whole labels table. Rows with source '*' count over every source
+    """
+    __tablename__ = 'label_stats'
+    label_normalized = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)
+    label = Column(String) # label as first stored
+    image_count = Column(Integer, default=0) # images carrying the label
+    score_total = Column(Float, default=0.0)
+    score_count = Column(Integer, default=0) # labels with a score, the mean score is score_total / score_count
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'count': self.image_count,
+            'mean_score': self.score_total / self.score_count if self.score_count else None,
+        }
+
+
 class Images(Base):
     """Images Table
     """
     __tablename__ = 'images'
+    __table_args__ = (
+        # keyset pagination walks images in (created_at, id) order
+        Index('ix_images_created_at_id', 'created_at', 'id'),
+        # the same file is stored once, its leading checksum column also serves content lookups
+        Index('uq_images_checksum_filename', 'checksum', 'filename', unique=True),
+    )
     id = Column(String, primary_key=True)
     filename = Column(String)
     filetype = Column(String)
     url = Column(String, nullable=True)
-    content = Column(LargeBinary)
+    content = deferred(Column(LargeBinary, nullable=True)) # legacy storage, new content lives in the blob store
+    content_key = Column(String, nullable=True) # blob store key of the image content
     checksum = Column(String)
+    phash = Column(String(16), nullable=True) # perceptual hash in hex, near duplicates differ in a few bits
+    created_at = Column(DateTime, default=datetime.utcnow)
 
-    def to_dict(self):
-        return {
+    labels = relationship(Labels, lazy='select')
+
+    # response field name -> mapped column, 'label' is served from the labels relationship
+    FIELDS = {
+        'id': 'id',
+        'filename': 'filename',
+        'filetype': 'filetype',
+        'url': 'url',
+        'check_sum': 'checksum',
+        'created_at': 'created_at',
+        'label': None,
+    }
+
+    def to_dict(self, fields: list = None):
+        d = {
             'id': self.id,
             'filename': self.filename,
             'filetype': self.filetype,
             'url': self.url,
-            'check_sum': self.checksum
+            'check_sum': self.checksum,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
         }
 
+        if fields is not None:
+            d = {key: value for key, value in d.items() if key in fields}
+
+        return d
+
     def __repr__(self):
         return ("<Image("
                 "id='%s', "
@@ -83,33 +179,304 @@ class Images(Base):
                    self.check_sum))
 
 
+class Annotations(Base):
+    """Detector results cached by image checksum, detector source and detector version
+    """
+    __tablename__ = 'annotations'
+    checksum = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)
+    version = Column(String, primary_key=True)
+    labels = Column(Text) # json encoded list of labels returned by the detector
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Jobs(Base):
+    """Background detection jobs of images
+    """
+    __tablename__ = 'jobs'
+    id = Column(String, primary_key=True)
+    image_id = Column(String, ForeignKey('images.id'), index=True)
+    status = Column(String) # pending, running, done or failed
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'image_id': self.image_id,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool which records how long callers wait to check out a connection
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._wait_lock:
+                self.wait_count += 1
+                self.wait_time_total += elapsed
+                self.wait_time_max = max(self.wait_time_max, elapsed)
+
+    def wait_stats(self) -> dict:
+        with self._wait_lock:
+            return {
+                'wait_count': self.wait_count,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+                'wait_time_mean': self.wait_time_total / self.wait_count \
+                    if self.wait_count else 0.0,
+            }
+
+
+def _engine_options(conn_str: str,
+                    pool_size: int,
+                    max_overflow: int,
+                    pool_timeout: float) -> dict:
+    """Builds create_engine keyword arguments for the connection pool
+    """
+    url = make_url(conn_str)
+    options = {}
+
+    if url.get_backend_name() == 'sqlite':
+        # pooled connections are handed between request threads
+        options['connect_args'] = {'check_same_thread': False}
+
+        # an in-memory database only lives as long as its single connection
+        if url.database in (None, '', ':memory:'):
+            options['poolclass'] = StaticPool
+            return options
+
+    options.update(poolclass=TimedQueuePool,
+                   pool_size=pool_size,
+                   max_overflow=max_overflow,
+                   pool_timeout=pool_timeout)
+    return options
+
+
+def upgrade_schema(engine: Engine) -> List[str]:
+    """Adds columns and indexes missing from tables created by an older version of the schema.
+    Returns descriptions of the applied changes
+    """
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    changes = []
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                changes.append(f'added column {table.name}.{column.name}')
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = _index_names(conn, table.name)
+            for name in REPLACED_INDEXES.get(table.name, []):
+                if name in existing:
+                    conn.execute(text(f'DROP INDEX {name}'))
+                    changes.append(f'dropped index {name}')
+
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+
+                # rows written before the unique index existed may repeat a label
+                if index.unique and table.name == Labels.__tablename__:
+                    deleted = _dedupe_labels(conn)
+                    if deleted:
+                        changes.append(f'deleted {deleted} duplicate labels')
+
+                index.create(bind=conn)
+                changes.append(f'created index {index.name}')
+
+    return changes
+
+
+def _index_names(conn, table_name: str) -> set:
+    """Names of the indexes of a table, including expression indexes which the inspector skips
+    """
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        rows = conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+                            {'table': table_name})
+    elif dialect == 'postgresql':
+        rows = conn.execute(text('SELECT indexname FROM pg_indexes WHERE tablename = :table'),
+                            {'table': table_name})
+    else:
+        return {i['name'] for i in inspect(conn).get_indexes(table_name)}
+
+    return {row[0] for row in rows}
+
+
+def _dedupe_labels(conn) -> int:
+    """Deletes labels repeating a label of the same image and source, keeping one of them.
+    Returns the number of deleted labels
+    """
+    keep = select(func.min(Labels.id)) \
+        .group_by(Labels.image_id, Labels.label, func.coalesce(Labels.source, ''))
+    return conn.execute(Labels.__table__.delete().where(Labels.id.notin_(keep))).rowcount
+
+
+# statement kinds counted separately in query metrics, others are counted as 'other'
+QUERY_OPERATIONS = ('select', 'insert', 'update', 'delete')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    operation = statement.lstrip()[:6].lower()
+    observe_query(operation if operation in QUERY_OPERATIONS else 'other', elapsed)
+
+
+def detection_key(content_key: str) -> str:
+    """Blob store key of the copy of an image sent to detectors
+    """
+    return f'{content_key}detect'
+
+
+class Database:
+    """Application scoped engine, connection pool and session registry.
+    Create one per process and hand out a DatabaseAPI per request with api()
+    """
+    def __init__(self,
+                 conn_str: str = 'sqlite:///images.db',
+                 pool_size: int = 5,
+                 max_overflow: int = 10,
+                 pool_timeout: float = 30,
+                 blob_store: BlobStore = None,
+                 response_cache: ResponseCache = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.conn_str = conn_str
+        self.blob_store = InstrumentedBlobStore(blob_store if blob_store is not None else LocalBlobStore())
+        self.response_cache = response_cache
+        self.engine = create_engine(
+            conn_str,
+            **_engine_options(conn_str, pool_size, max_overflow, pool_timeout))
+
+        # count and time every statement for the /metrics endpoint
+        event.listen(self.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(self.engine, 'after_cursor_execute', _after_cursor_execute)
+
+        # one session per thread, released by remove_session() at request teardown
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+
+        # set up tables once for the lifetime of the engine
+        Base.metadata.create_all(self.engine)
+
+    def api(self) -> 'DatabaseAPI':
+        return DatabaseAPI(database=self)
+
+    def remove_session(self):
+        self.Session.remove()
+
+    def pool_status(self) -> dict:
+        """Reports connection pool usage to help sizing the pool
+        """
+        pool = self.engine.pool
+        status = {'pool': type(pool).__name__}
+
+        if isinstance(pool, QueuePool):
+            status.update({
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                # QueuePool counts up from -size until it starts to overflow
+                'overflow': max(pool.overflow(), 0),
+                'max_overflow': pool._max_overflow,
+            })
+
+        if isinstance(pool, TimedQueuePool):
+            status.update(pool.wait_stats())
+
+        return status
+
+    def dispose(self):
+        self.Session.remove()
+        self.engine.dispose()
+
+
 class DatabaseAPI:
     """Creates interface with sqlite database to retrieve and store images metadata
     """
-    def __init__(self, conn_str: str = 'sqlite:///images.db'):
+    def __init__(self,
+                 conn_str: str = 'sqlite:///images.db',
+                 database: Database = None,
+                 blob_store: BlobStore = None):
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.engine = create_engine(conn_str)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
 
-        # set up tables
-        Base.metadata.create_all(self.engine)
+        # standalone usage gets its own engine, the app shares one per process
+        if database is None:
+            database = Database(conn_str=conn_str, blob_store=blob_store)
+
+        self.database = database
+        self.engine = database.engine
+        self.session = database.Session()
+        self.blob_store = database.blob_store
+        self.response_cache = database.response_cache
 
-    def get_images_by_label(self, labels: list) -> List[dict]:
-        """Retrieves list of images based on label name
+    LABEL_MATCHES = ('any', 'all')
+    LABEL_ORDERS = ('score', 'topicality')
+    FACET_ORDERS = ('count', 'score', 'label')
+
+    @stage('db.get_images_by_label')
+    def get_images_by_label(self,
+                            labels: list,
+                            match: str = 'any',
+                            min_score: float = None,
+                            order_by: str = None) -> List[dict]:
+        """Retrieves list of images based on label name with a single joined query.
+        match='any' returns images with at least one of the labels, match='all' images with every label.
+        Labels scoring below min_score are ignored and results can be ordered
+        by the best matching label 'score' or 'topicality'
         """
-        
+        if match not in self.LABEL_MATCHES:
+            raise InvalidInputException(f"'match' must be one of {', '.join(self.LABEL_MATCHES)}")
+
+        if order_by is not None and order_by not in self.LABEL_ORDERS:
+            raise InvalidInputException(f"'order_by' must be one of {', '.join(self.LABEL_ORDERS)}")
+
         # make label query case insensitive
-        labels = self.session.query(Labels) \
-            .filter( \
-                func.upper( Labels.label ) \
-                .in_([l.upper() for l in labels])
-            ).all()
-        self.logger.info(f'labels: {labels}')
+        labels = {normalize_label(l) for l in labels}
+
+        q = self.session.query(Images) \
+            .join(Labels, Labels.image_id == Images.id) \
+            .filter(Labels.label_normalized.in_(labels))
 
-        # get image id's for all found labels
-        image_ids = [l.image_id for l in labels]
-        images = self.session.query(Images).filter(Images.id.in_(image_ids)).all()
+        if min_score is not None:
+            q = q.filter(Labels.score >= min_score)
+
+        q = q.group_by(Images.id)
+
+        if match == 'all':
+            q = q.having(func.count(func.distinct(Labels.label_normalized)) == len(labels))
+
+        if order_by is not None:
+            q = q.order_by(desc(func.max(getattr(Labels, order_by))))
+
+        images = q.order_by(Images.created_at, Images.id).all()
 
         to_return = []
         for image in images:
@@ -117,49 +484,418 @@ class DatabaseAPI:
 
         return to_return
 
+    @stage('db.get_images')
     def get_images(self, **kwargs) -> List[dict]:
-        """Retrieves list of images based on criteria
+        """Retrieves list of images based on criteria.
+        Labels of all images are loaded with one IN-batched select
         """
-        images = self._query(table_class=Images, **kwargs)
+        images = self.session.query(Images) \
+            .options(selectinload(Images.labels)) \
+            .filter_by(**kwargs).all()
         to_return = []
 
         for image in images:
             d = image.to_dict()
-            d['label'] = [
-                label.to_dict() for label in \
-                    self._query(table_class=Labels, image_id=image.id)]
+            d['label'] = [label.to_dict() for label in image.labels]
             to_return.append(d)
 
         return to_return
 
+    def iter_images(self,
+                    labels: list = None,
+                    match: str = 'any',
+                    min_score: float = None,
+                    batch_size: int = 1000) -> Iterator[dict]:
+        """Streams every image with its labels in (created_at, id) order from a server side cursor.
+        Rows are fetched batch_size at a time along with the labels of the batch, so memory stays
+        flat regardless of the table size. labels, match and min_score filter images like get_images_by_label
+        """
+        if match not in self.LABEL_MATCHES:
+            raise InvalidInputException(f"'match' must be one of {', '.join(self.LABEL_MATCHES)}")
+
+        q = self.session.query(Images)
+        if labels:
+            q = q.filter(Images.id.in_(self._label_matches(labels, match, min_score)))
+
+        # invalid arguments raise here rather than once the caller starts iterating
+        return self._iter_batches(q.order_by(Images.created_at, Images.id), batch_size)
+
+    def _iter_batches(self, q, batch_size: int) -> Iterator[dict]:
+        batch = []
+        for image in q.yield_per(batch_size):
+            batch.append(image)
+            if len(batch) == batch_size:
+                yield from self._with_labels(batch)
+                batch = []
+
+        yield from self._with_labels(batch)
+
+    def _label_matches(self, labels: list, match: str, min_score: float = None):
+        """Select of ids of images with any or all of the labels
+        """
+        labels = {normalize_label(l) for l in labels}
+        q = self.session.query(Labels.image_id).filter(Labels.label_normalized.in_(labels))
+
+        if min_score is not None:
+            q = q.filter(Labels.score >= min_score)
+
+        if match == 'all':
+            q = q.group_by(Labels.image_id) \
+                .having(func.count(func.distinct(Labels.label_normalized)) == len(labels))
+
+        return q.subquery().select()
+
+    def _with_labels(self, images: List[Images]) -> Iterator[dict]:
+        if not(images):
+            return
+
+        labels = {}
+        for label in self.session.query(Labels).filter(Labels.image_id.in_([image.id for image in images])):
+            labels.setdefault(label.image_id, []).append(label.to_dict())
+
+        for image in images:
+            d = image.to_dict()
+            d['label'] = labels.get(image.id, [])
+            yield d
+
+    @stage('db.get_images_by_ids')
+    def get_images_by_ids(self, ids: List[str]) -> List[dict]:
+        """Retrieves images with their labels in the order of the given ids
+        """
+        images = self.session.query(Images) \
+            .options(selectinload(Images.labels)) \
+            .filter(Images.id.in_(ids)).all()
+        by_id = {image.id: image for image in images}
+
+        to_return = []
+        for image_id in ids:
+            if image_id in by_id:
+                d = by_id[image_id].to_dict()
+                d['label'] = [label.to_dict() for label in by_id[image_id].labels]
+                to_return.append(d)
+
+        return to_return
+
+    @stage('db.get_images_page')
+    def get_images_page(self,
+                        limit: int,
+                        cursor: str = None,
+                        fields: list = None) -> Tuple[List[dict], str]:
+        """Retrieves one page of images in (created_at, id) order using keyset pagination.
+        Returns images of the page and the cursor of the next page, None on the last page.
+        fields restricts the returned keys, i.e ['id', 'label']
+        """
+        if fields is not None:
+            unknown = [f for f in fields if f not in Images.FIELDS]
+            if unknown:
+                raise InvalidInputException(f'Unknown fields: {",".join(unknown)}')
+
+        q = self.session.query(Images)
+
+        if fields is None or 'label' in fields:
+            q = q.options(selectinload(Images.labels))
+
+        if fields is not None:
+            columns = {Images.FIELDS[f] for f in fields if Images.FIELDS[f]}
+            # created_at and id are always needed to build the next cursor
+            columns.update(('id', 'created_at'))
+            q = q.options(load_only(*[getattr(Images, c) for c in columns]))
+
+        if cursor:
+            created_at, image_id = self._decode_cursor(cursor)
+            q = q.filter(or_(Images.created_at > created_at,
+                             and_(Images.created_at == created_at, Images.id > image_id)))
+
+        # fetch one extra row to know whether another page exists
+        images = q.order_by(Images.created_at, Images.id).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(images) > limit:
+            images = images[:limit]
+            next_cursor = self._encode_cursor(images[-1])
+
+        to_return = []
+        for image in images:
+            d = image.to_dict(fields)
+            if fields is None or 'label' in fields:
+                d['label'] = [label.to_dict() for label in image.labels]
+            to_return.append(d)
+
+        return to_return, next_cursor
+
+    @staticmethod
+    def _encode_cursor(image: Images) -> str:
+        raw = json.dumps([image.created_at.isoformat(), image.id])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[datetime, str]:
+        try:
+            created_at, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.fromisoformat(created_at), image_id
+        except (ValueError, TypeError):
+            raise InvalidInputException(f'Invalid cursor: {cursor}')
+
+    @stage('db.get_labels_by_image_id')
     def get_labels_by_image_id(self, image_id: str) -> List[Labels]:
         return [label.to_dict() for label in \
             self._query(Labels, image_id=image_id)]
 
     def add_label(self, label: LabelModel) -> dict:
-        """Stores image metadata in Images table
-        """
-
-        duplicates = self._query(Labels,
-                                 label=label.label,
-                                 image_id=label.image_id,
-                                 source=label.source)
-
-        # if no duplicate is found then create a label in db
-        if not(duplicates):
-            label = Labels(
-                id=label.id,
-                label=label.label,
-                score=label.score,
-                topicality=label.topicality,
-                image_id=label.image_id,
-                source=label.source,
-            )
-            self.session.add(label)
-            self.session.commit()
-            return label.to_dict()
+        """Stores a label of an image in Labels table
+        """
+        return self.add_labels([label])[0]
+
+    @stage('db.add_labels')
+    def add_labels(self, labels: List[LabelModel]) -> List[dict]:
+        """Stores labels in Labels table with one duplicate lookup and one bulk insert.
+        Labels already stored for the same image and source are skipped.
+        Returns stored labels in the order given, existing ones for duplicates
+        """
+        if not(labels):
+            return []
+
+        image_ids = {l.image_id for l in labels}
+        existing = {}
+        for label in self.session.query(Labels).filter(Labels.image_id.in_(image_ids)):
+            existing[(label.image_id, label.label, label.source)] = label.to_dict()
+
+        rows = []
+        to_return = []
+        for label in labels:
+            key = (label.image_id, label.label, label.source)
+            if key not in existing:
+                existing[key] = {
+                    'id': label.id,
+                    'label': label.label,
+                    'score': label.score,
+                    'topicality': label.topicality,
+                    'image_id': label.image_id,
+                    'source': label.source
+                }
+                rows.append(dict(existing[key], label_normalized=normalize_label(label.label)))
+
+            to_return.append(key)
+
+        if rows:
+            if self.engine.dialect.name != 'sqlite':
+                # writers of the same images wait for this transaction, sqlite serializes them at the insert
+                self.session.query(Images.id).filter(Images.id.in_(image_ids)).with_for_update().all()
+
+            self.session.execute(self._insert_ignoring_duplicates(Labels), rows)
+            # statistics change in the same transaction as the labels
+            self._update_label_stats(self._label_stats_deltas(rows, existing))
+        self.session.commit()
+
+        if rows:
+            self._invalidate_responses({row['image_id'] for row in rows})
+
+        return [existing[key] for key in to_return]
+
+    def _label_stats_deltas(self, rows: List[dict], existing: dict) -> dict:
+        """Statistics deltas of the rows the insert actually stored, read back in its transaction.
+        Rows skipped because a concurrent writer stored the same label are not counted,
+        existing is updated with the labels stored in their place
+        """
+        ids = {row['id'] for row in rows}
+        inserted = []
+        labeled = set()
+
+        for label in self.session.query(Labels).filter(Labels.image_id.in_({row['image_id'] for row in rows})):
+            if label.id in ids:
+                inserted.append(label)
+                continue
+
+            existing[(label.image_id, label.label, label.source)] = label.to_dict()
+            for source in (label.source or '', ALL_SOURCES):
+                labeled.add((label.image_id, label.label_normalized, source))
+
+        stats = {}
+        for label in inserted:
+            self._count_label(stats, labeled, label)
+        return stats
+
+    @staticmethod
+    def _count_label(stats: dict, labeled: set, label: Labels):
+        """Adds a new label to the statistics deltas of its source and of all sources.
+        An image is counted once per label, also when sources or spellings differ in case
+        """
+        label_normalized = normalize_label(label.label)
+        for source in (label.source or '', ALL_SOURCES):
+            delta = stats.setdefault((label_normalized, source), {
+                'label_normalized': label_normalized,
+                'source': source,
+                'label': label.label,
+                'image_count': 0,
+                'score_total': 0.0,
+                'score_count': 0,
+            })
+
+            if (label.image_id, label_normalized, source) not in labeled:
+                labeled.add((label.image_id, label_normalized, source))
+                delta['image_count'] += 1
+
+            if label.score is not None:
+                delta['score_total'] += label.score
+                delta['score_count'] += 1
+
+    def _update_label_stats(self, stats: dict):
+        """Adds deltas to the label statistics with one upsert
+        """
+        if not(stats):
+            return
+
+        table = LabelStats.__table__
+        dialect = self.engine.dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite_insert(table) if dialect == 'sqlite' else postgresql_insert(table)
+            self.session.execute(insert.on_conflict_do_update(
+                index_elements=['label_normalized', 'source'],
+                set_={column: table.c[column] + insert.excluded[column]
+                      for column in ('image_count', 'score_total', 'score_count')}),
+                list(stats.values()))
+            return
 
-        return duplicates[0].to_dict()
+        for delta in stats.values():
+            row = self.session.get(LabelStats, (delta['label_normalized'], delta['source']))
+            if row is None:
+                self.session.add(LabelStats(**delta))
+            else:
+                row.image_count += delta['image_count']
+                row.score_total += delta['score_total']
+                row.score_count += delta['score_count']
+
+    def rebuild_label_stats(self) -> int:
+        """Recomputes label statistics from the labels table, i.e after labels were written
+        without add_labels. Returns the number of statistics rows
+        """
+        self.session.query(LabelStats).delete()
+
+        for source in (None, ALL_SOURCES):
+            q = self.session.query(Labels.label_normalized,
+                                   func.min(Labels.label),
+                                   func.count(func.distinct(Labels.image_id)),
+                                   func.coalesce(func.sum(Labels.score), 0.0),
+                                   func.count(Labels.score))
+            q = q.add_columns(Labels.source).group_by(Labels.label_normalized, Labels.source) \
+                if source is None else q.group_by(Labels.label_normalized)
+
+            self.session.bulk_insert_mappings(LabelStats, [{
+                'label_normalized': row[0],
+                'source': (row[5] or '') if source is None else source,
+                'label': row[1],
+                'image_count': row[2],
+                'score_total': row[3],
+                'score_count': row[4],
+            } for row in q if row[0] is not None])
+
+        self.session.commit()
+        if self.response_cache is not None:
+            self.response_cache.clear()
+
+        return self.session.query(LabelStats).count()
+
+    @stage('db.get_label_facets')
+    def get_label_facets(self,
+                         source: str = None,
+                         prefix: str = None,
+                         order_by: str = 'count',
+                         limit: int = 100) -> List[dict]:
+        """Labels with the number of images carrying them, their mean score and a breakdown per source.
+        source counts only labels of that source, prefix matches the start of labels case insensitively
+        """
+        if order_by not in self.FACET_ORDERS:
+            raise InvalidInputException(f"'order_by' must be one of {', '.join(self.FACET_ORDERS)}")
+
+        q = self.session.query(LabelStats).filter(LabelStats.source == (source or ALL_SOURCES))
+
+        if prefix:
+            # escape wildcards so the prefix is matched literally
+            escaped = normalize_label(prefix).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            q = q.filter(LabelStats.label_normalized.like(f'{escaped}%', escape='\\'))
+
+        q = q.filter(LabelStats.image_count > 0)
+        if order_by == 'count':
+            q = q.order_by(desc(LabelStats.image_count), LabelStats.label_normalized)
+        elif order_by == 'score':
+            q = q.order_by(desc(LabelStats.score_total / func.nullif(LabelStats.score_count, 0)),
+                           LabelStats.label_normalized)
+        else:
+            q = q.order_by(LabelStats.label_normalized)
+
+        facets = q.limit(limit).all()
+
+        # per source rows of the returned labels in one query
+        sources = {}
+        for row in self.session.query(LabelStats) \
+                .filter(LabelStats.label_normalized.in_([f.label_normalized for f in facets]),
+                        LabelStats.source != ALL_SOURCES):
+            sources.setdefault(row.label_normalized, {})[row.source] = row.to_dict()
+
+        to_return = []
+        for facet in facets:
+            d = facet.to_dict()
+            d['sources'] = {name: {'count': stats['count'], 'mean_score': stats['mean_score']}
+                            for name, stats in sorted(sources.get(facet.label_normalized, {}).items())}
+            to_return.append(d)
+
+        return to_return
+
+    def _insert_ignoring_duplicates(self, table_class: Base):
+        """INSERT skipping rows which violate a unique index, raced by a concurrent writer
+        """
+        dialect = self.engine.dialect.name
+        if dialect == 'sqlite':
+            return sqlite_insert(table_class.__table__).on_conflict_do_nothing()
+        if dialect == 'postgresql':
+            return postgresql_insert(table_class.__table__).on_conflict_do_nothing()
+
+        return table_class.__table__.insert()
+
+    def get_annotation(self,
+                       checksum: str,
+                       source: str,
+                       version: str,
+                       max_age: float = None) -> Optional[List[dict]]:
+        """Retrieves cached detector labels of an image checksum.
+        Entries older than max_age seconds are ignored
+        """
+        q = self.session.query(Annotations.labels) \
+            .filter_by(checksum=checksum, source=source, version=version)
+
+        if max_age is not None:
+            q = q.filter(Annotations.created_at >= datetime.utcnow() - timedelta(seconds=max_age))
+
+        labels = q.scalar()
+        return json.loads(labels) if labels is not None else None
+
+    def put_annotation(self, checksum: str, source: str, version: str, labels: List[dict]):
+        """Caches detector labels of an image checksum
+        """
+        self.session.merge(Annotations(checksum=checksum,
+                                       source=source,
+                                       version=version,
+                                       labels=json.dumps(labels),
+                                       created_at=datetime.utcnow()))
+        self.session.commit()
+
+    def create_job(self, job_id: str, image_id: str) -> dict:
+        job = Jobs(id=job_id, image_id=image_id, status='pending')
+        self.session.add(job)
+        self.session.commit()
+        return job.to_dict()
+
+    def update_job(self, job_id: str, status: str, error: str = None) -> dict:
+        job = self.session.query(Jobs).filter_by(id=job_id).one()
+        job.status = status
+        job.error = error
+        self.session.commit()
+        return job.to_dict()
+
+    def get_jobs_by_image_id(self, image_id: str) -> List[dict]:
+        return [job.to_dict() for job in self.session.query(Jobs) \
+            .filter_by(image_id=image_id) \
+            .order_by(Jobs.created_at)]
 
     def check_duplicate_image(self, image: ImageModel) -> dict:
         images = self._query(Images, checksum=image.checksum, filename=image.filename)
@@ -169,29 +905,281 @@ class DatabaseAPI:
         
         return {}
 
+    @stage('db.add_image')
     def add_image(self, image: ImageModel) -> dict:
-        """Stores image metadata in Images table
+        """Stores image content in the blob store and its metadata in Images table.
+        Content is keyed by checksum so identical bytes are only stored once, also under
+        different filenames. Returns the stored image if the same file was added before
         """
+        # a single indexed lookup finds both the same file and stored content to share
+        same_content = self._query(Images, checksum=image.checksum)
+        for existing in same_content:
+            if existing.filename == image.filename:
+                return existing.to_dict()
+
+        content_key = image.content_key
+        if content_key is None:
+            content_key = next((e.content_key for e in same_content if e.content_key), None)
 
-        image = Images(
+        # streamed uploads and content shared with other filenames are already in the blob store
+        if content_key is None:
+            self.blob_store.put(image.checksum, image.content)
+            content_key = image.checksum
+
+        image_to_add = Images(
             id=image.id,
             filename=image.filename,
             filetype=image.filetype,
             url=image.url,
-            content=image.content,
+            content_key=content_key,
             checksum=image.checksum,
+            phash=image.phash,
         )
 
-        duplicate = self.check_duplicate_image(image)
-        if not(duplicate):
-            self.session.add(image)
+        self.session.add(image_to_add)
+        try:
             self.session.commit()
-            return image.to_dict()
-        else:
-            return duplicate
+        except IntegrityError:
+            # a concurrent upload of the same file was committed first
+            self.session.rollback()
+            return self.check_duplicate_image(image)
+
+        self._invalidate_responses([image_to_add.id])
+        return image_to_add.to_dict()
+
+    @stage('db.add_images')
+    def add_images(self, images: List[ImageModel]) -> List[dict]:
+        """Stores many images in one transaction, deduplicating them like add_image.
+        Returns stored images in the order given, the existing image for files added before
+        """
+        if not(images):
+            return []
+
+        checksums = {image.checksum for image in images}
+        existing = set()
+        content_keys = {}
+        for stored in self.session.query(Images).filter(Images.checksum.in_(checksums)):
+            existing.add((stored.checksum, stored.filename))
+            if stored.content_key:
+                content_keys.setdefault(stored.checksum, stored.content_key)
+
+        rows = []
+        for image in images:
+            if (image.checksum, image.filename) in existing:
+                continue
+
+            content_key = image.content_key or content_keys.get(image.checksum)
+            if content_key is None:
+                self.blob_store.put(image.checksum, image.content)
+                content_key = image.checksum
+            content_keys.setdefault(image.checksum, content_key)
+
+            existing.add((image.checksum, image.filename))
+            rows.append({
+                'id': image.id,
+                'filename': image.filename,
+                'filetype': image.filetype,
+                'url': image.url,
+                'content_key': content_key,
+                'checksum': image.checksum,
+                'phash': image.phash,
+                'created_at': datetime.utcnow(),
+            })
+
+        if rows:
+            self.session.execute(self._insert_ignoring_duplicates(Images), rows)
+        self.session.commit()
+
+        # read back what was stored, rows raced by a concurrent writer were skipped by the insert
+        stored = {(image.checksum, image.filename): image
+                  for image in self.session.query(Images).filter(Images.checksum.in_(checksums))}
+
+        if rows:
+            self._invalidate_responses([row['id'] for row in rows])
+
+        return [stored[(image.checksum, image.filename)].to_dict() for image in images]
+
+    def get_phashes(self, after: Tuple[datetime, str] = None, limit: int = 1000) -> List[tuple]:
+        """Returns (created_at, id, phash) of images with a perceptual hash in (created_at, id) order,
+        starting after the given (created_at, id)
+        """
+        q = self.session.query(Images.created_at, Images.id, Images.phash) \
+            .filter(Images.phash.isnot(None))
+
+        if after is not None:
+            created_at, image_id = after
+            q = q.filter(or_(Images.created_at > created_at,
+                             and_(Images.created_at == created_at, Images.id > image_id)))
 
+        return q.order_by(Images.created_at, Images.id).limit(limit).all()
+
+    def get_image_checksum(self, image_id: str) -> str:
+        row = self.session.query(Images.checksum).filter_by(id=image_id).one_or_none()
+        if row is None:
+            raise NotFoundException(f'Image {image_id} not found')
+        return row[0]
+
+    def get_image_phash(self, image_id: str) -> Optional[str]:
+        row = self.session.query(Images.phash).filter_by(id=image_id).one_or_none()
+        if row is None:
+            raise NotFoundException(f'Image {image_id} not found')
+        return row[0]
+
+    def copy_labels(self, from_image_id: str, to_image_id: str, sources: List[str]) -> List[dict]:
+        """Copies labels of the given sources from one image to another
+        """
+        labels = self.session.query(Labels) \
+            .filter(Labels.image_id == from_image_id, Labels.source.in_(sources)).all()
+
+        return self.add_labels([LabelModel(id=str(uuid.uuid1()),
+                                           label=label.label,
+                                           score=label.score,
+                                           topicality=label.topicality,
+                                           image_id=to_image_id,
+                                           source=label.source)
+                                for label in labels])
+
+    def add_detection_content(self, content_key: str, content: bytes):
+        """Stores the downscaled copy of an image sent to detectors
+        """
+        self.blob_store.put(detection_key(content_key), content)
+
+    @stage('db.fetch_detection_content_by_id')
+    def fetch_detection_content_by_id(self, id) -> bytes:
+        """Content to send to detectors, the downscaled copy made at ingest if there is one
+        """
+        content_key = self.session.query(Images.content_key).filter_by(id=id).scalar()
+        if content_key and self.blob_store.exists(detection_key(content_key)):
+            return self.blob_store.get(detection_key(content_key))
+
+        return self.fetch_image_content_by_id(id)
+
+    @stage('db.fetch_image_content_by_id')
     def fetch_image_content_by_id(self, id):
-        return self._query(Images, id=id)[0].content
+        content_key, content = self.session.query(Images.content_key, Images.content) \
+            .filter_by(id=id).one()
+
+        if content_key:
+            return self.blob_store.get(content_key)
+
+        # rows written before the blob store was introduced
+        return content
+
+    def open_image_content(self, id) -> Tuple[Union[str, BinaryIO], dict]:
+        """Opens image content for streaming without reading it into memory.
+        Returns a filesystem path when the blob store keeps local files, a readable
+        file object otherwise, along with the image metadata
+        """
+        image = self.session.query(Images) \
+            .options(load_only(Images.id, Images.filename, Images.filetype,
+                               Images.url, Images.checksum, Images.content_key,
+                               Images.created_at)) \
+            .filter_by(id=id).first()
+
+        if image is None:
+            raise NotFoundException(f'Image {id} does not exist')
+
+        if image.content_key:
+            source = self.blob_store.path(image.content_key) or \
+                self.blob_store.open(image.content_key)
+        else:
+            source = BytesIO(self.fetch_image_content_by_id(id))
+
+        return source, image.to_dict()
+
+    def migrate_content_to_blob_store(self, batch_size: int = 100) -> int:
+        """Moves image content stored in Images table into the blob store.
+        Returns number of migrated images
+        """
+        migrated = 0
+
+        while True:
+            rows = self.session.query(Images.id, Images.content, Images.checksum) \
+                .filter(Images.content_key.is_(None), Images.content.isnot(None)) \
+                .limit(batch_size).all()
+            if not(rows):
+                break
+
+            for image_id, content, checksum in rows:
+                key = checksum or hashlib.md5(content).hexdigest()
+                self.blob_store.put(key, content)
+                self.session.query(Images).filter_by(id=image_id).update({
+                    'content_key': key,
+                    'checksum': key,
+                    'content': None,
+                }, synchronize_session=False)
+
+            self.session.commit()
+            self._invalidate_responses([image_id for image_id, _, _ in rows])
+            migrated += len(rows)
+            self.logger.info(f'migrated {migrated} images to the blob store')
+
+        return migrated
+
+    def backfill_label_normalized(self, batch_size: int = 1000) -> int:
+        """Sets label_normalized of labels created before the column existed
+        """
+        count = 0
+
+        while True:
+            labels = self.session.query(Labels) \
+                .filter(Labels.label_normalized.is_(None), Labels.label.isnot(None)) \
+                .limit(batch_size).all()
+            if not(labels):
+                break
+
+            for label in labels:
+                label.label_normalized = normalize_label(label.label)
+
+            self.session.commit()
+            count += len(labels)
+
+        return count
+
+    def backfill_created_at(self) -> int:
+        """Sets created_at of images created before the column existed
+        """
+        count = self.session.query(Images) \
+            .filter(Images.created_at.is_(None)) \
+            .update({'created_at': datetime.utcnow()}, synchronize_session=False)
+        self.session.commit()
+
+        if count and self.response_cache is not None:
+            self.response_cache.clear()
+        return count
+
+    def backfill_phash(self, batch_size: int = 100) -> int:
+        """Computes perceptual hashes of images stored before the column existed
+        """
+        count = 0
+        after = None
+
+        while True:
+            q = self.session.query(Images.id).filter(Images.phash.is_(None))
+            if after is not None:
+                q = q.filter(Images.id > after)
+            image_ids = [row[0] for row in q.order_by(Images.id).limit(batch_size).all()]
+            if not(image_ids):
+                break
+
+            for image_id in image_ids:
+                # images which are not readable keep a null hash and are skipped next time
+                phash = dhash(self.fetch_image_content_by_id(image_id))
+                if phash is not None:
+                    self.session.query(Images).filter_by(id=image_id) \
+                        .update({'phash': phash}, synchronize_session=False)
+                    count += 1
+
+            self.session.commit()
+            after = image_ids[-1]
+
+        return count
+
+    def _invalidate_responses(self, image_ids):
+        """Drops cached read responses showing the written images
+        """
+        if self.response_cache is not None:
+            self.response_cache.invalidate_images(image_ids)
 
     def _query_by_id(self, table_class: Base, id: list):
         q = self.session.query(table_class).filter(table_class.id.in_(id))
@@ -202,8 +1190,16 @@ class DatabaseAPI:
         return q.all()
 
     def reset(self):
-        os.remove('images.db')
+        """Drops and recreates all tables.
+        The pooled engine keeps its connections so the database file is not removed
+        """
+        self.session.close()
+        Base.metadata.drop_all(self.engine)
         Base.metadata.create_all(self.engine)
+        self.blob_store.clear()
+
+        if self.response_cache is not None:
+            self.response_cache.clear()
 
 
 def main():
@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from object_detector_backend.util.lru import LRUCache
+
+# generation of every response listing several images
+COLLECTION = 'images'
+
+
+class ResponseCache():
+    """Storage of serialized read responses, invalidated by DatabaseAPI writes.
+    Every key carries a generation counter bumped after a write commits, so a response
+    built while a write commits is stored under a key which is no longer read.
+    Responses of one image carry the generation of that image, listings the generation
+    of the collection, which any image or label write bumps
+    Implement this interface to share cached responses between processes, i.e with redis
+    """
+    def get(self, key: str) -> Optional[tuple]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: tuple):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def generation(self, name: str) -> int:
+        """Current generation of name, 0 until it is bumped
+        """
+        raise NotImplementedError
+
+    def bump(self, name: str) -> int:
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+    def collection_key(self, query: str) -> str:
+        return f'{COLLECTION}:{self.generation(COLLECTION)}:{query}'
+
+    def image_key(self, image_id: str) -> str:
+        return f'image:{self.generation(f"image:{image_id}")}:{image_id}'
+
+    def invalidate_images(self, image_ids: Iterable[str]):
+        """Drops cached responses showing the given images
+        """
+        for image_id in image_ids:
+            self.bump(f'image:{image_id}')
+        self.bump(COLLECTION)
+
+
+class MemoryResponseCache(ResponseCache):
+    """Keeps responses in a bounded in-memory LRU of this process.
+    Entries expire after ttl seconds to bound staleness when other processes write.
+    At most max_generations generations are kept, names without one get the highest
+    generation dropped so far, which is never below a generation they had before
+    """
+    def __init__(self, max_entries: int = 1024, ttl: float = None, max_generations: int = 65536):
+        self.entries = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.max_generations = max_generations
+        self._generations = OrderedDict()
+        self._floor = 0 # highest dropped generation
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[tuple]:
+        return self.entries.get(key)
+
+    def set(self, key: str, value: tuple):
+        self.entries.set(key, value)
+
+    def delete(self, key: str):
+        self.entries.delete(key)
+
+    def generation(self, name: str) -> int:
+        with self._lock:
+            return self._generations.get(name, self._floor)
+
+    def bump(self, name: str) -> int:
+        with self._lock:
+            generation = self._generations.pop(name, self._floor) + 1
+            self._generations[name] = generation
+            if len(self._generations) > self.max_generations:
+                _, dropped = self._generations.popitem(last=False)
+                self._floor = max(self._floor, dropped)
+            return generation
+
+    def clear(self):
+        self.entries.clear()
+        self.bump(COLLECTION)
+
+    def stats(self) -> dict:
+        return self.entries.stats()
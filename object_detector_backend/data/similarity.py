@@ -0,0 +1,179 @@
+import io
+import logging
+import threading
+from datetime import timedelta
+from typing import BinaryIO, List, Optional, Tuple, Union
+
+# optional dependency of perceptual hashing: pip install pillow
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+def dhash(source: Union[bytes, str, BinaryIO], hash_size: int = 8) -> Optional[str]:
+    """Difference hash of an image: compares the brightness of neighbouring pixels of a
+    (hash_size + 1) x hash_size grayscale thumbnail, so re-encoded or resized copies of
+    a photo get hashes a few bits apart. Returns the hash as hex, None if Pillow is not
+    installed or the content is not an image
+    """
+    if Image is None:
+        return None
+
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    try:
+        with Image.open(source) as image:
+            # let the jpeg decoder downscale while decoding instead of decoding full size
+            image.draft('L', (hash_size * 8, hash_size * 8))
+            pixels = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS).tobytes()
+    except Exception:
+        logger.warning('Could not compute perceptual hash, content is not a readable image')
+        return None
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | int(left > right)
+
+    return format(bits, f'0{hash_size * hash_size // 4}x')
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class BKTree():
+    """Burkhard-Keller tree over integer hashes with Hamming distance.
+    A search only descends into children whose edge distance is within max_distance
+    of the query distance, so near matches are found without scanning every hash
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def add(self, value: int, item):
+        with self._lock:
+            self.size += 1
+            if self.root is None:
+                self.root = (value, [item], {})
+                return
+
+            node = self.root
+            while True:
+                distance = hamming_distance(value, node[0])
+                if distance == 0:
+                    node[1].append(item)
+                    return
+
+                child = node[2].get(distance)
+                if child is None:
+                    node[2][distance] = (value, [item], {})
+                    return
+                node = child
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, object]]:
+        """Returns (distance, item) of hashes within max_distance ordered by distance
+        """
+        found = []
+
+        with self._lock:
+            nodes = [self.root] if self.root is not None else []
+            while nodes:
+                node = nodes.pop()
+                distance = hamming_distance(value, node[0])
+                if distance <= max_distance:
+                    found.extend((distance, item) for item in node[1])
+
+                for edge, child in node[2].items():
+                    if distance - max_distance <= edge <= distance + max_distance:
+                        nodes.append(child)
+
+        return sorted(found, key=lambda match: match[0])
+
+    def __len__(self):
+        return self.size
+
+
+class SimilarityIndex():
+    """In-memory BK-tree of image perceptual hashes.
+    The tree is filled from the Images table on first use and catches up with images added by
+    other processes before each search. A search only reads rows when an image was added after
+    the last indexed one, then it reads rows created up to lookback seconds before it again,
+    as other workers may commit rows late. Hashes backfilled on older images are picked up by
+    rescan, which reads every row and runs in the background, off the request path.
+    Indexed ids are skipped on every read
+    """
+    def __init__(self, batch_size: int = 1000, lookback: float = 60):
+        self.batch_size = batch_size
+        self.lookback = lookback
+        self.tree = BKTree()
+        self.indexed = set() # ids of indexed images
+        self.after = None # (created_at, id) of the last indexed image
+        self.loaded = False
+        self._refresh_lock = threading.Lock()
+
+    def _add(self, rows: List[tuple]) -> int:
+        count = 0
+        for created_at, image_id, phash in rows:
+            if phash is not None and image_id not in self.indexed:
+                self.tree.add(int(phash, 16), image_id)
+                self.indexed.add(image_id)
+                count += 1
+        return count
+
+    def refresh(self, db_api) -> int:
+        """Indexes images added since the last refresh. Returns the number of indexed images
+        """
+        count = 0
+        with self._refresh_lock:
+            after = None
+            if self.loaded:
+                # nothing was written after the high-water mark
+                if not(db_api.get_phashes(after=self.after, limit=1)):
+                    return 0
+                if self.after is not None and self.after[0] is not None:
+                    after = (self.after[0] - timedelta(seconds=self.lookback), '')
+
+            while True:
+                rows = db_api.get_phashes(after=after, limit=self.batch_size)
+                count += self._add(rows)
+
+                if rows:
+                    after = self.after = (rows[-1][0], rows[-1][1])
+                if len(rows) < self.batch_size:
+                    break
+
+            self.loaded = True
+
+        return count
+
+    def rescan(self, db_api) -> int:
+        """Reads every row again to index hashes backfilled on older images.
+        Searches only wait for the batch being indexed. Returns the number of indexed images
+        """
+        count = 0
+        after = None
+
+        while True:
+            rows = db_api.get_phashes(after=after, limit=self.batch_size)
+            with self._refresh_lock:
+                count += self._add(rows)
+
+            if len(rows) < self.batch_size:
+                break
+            after = (rows[-1][0], rows[-1][1])
+
+        return count
+
+    def search(self, db_api, phash: str, max_distance: int) -> List[Tuple[int, str]]:
+        """Returns (distance, image id) of images within max_distance bits of phash
+        """
+        self.refresh(db_api)
+        return self.tree.search(int(phash, 16), max_distance)
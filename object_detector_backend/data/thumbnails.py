@@ -0,0 +1,101 @@
+import io
+import logging
+import threading
+from typing import BinaryIO, Callable, List
+
+from object_detector_backend.data.blobs import BlobStore
+from object_detector_backend.util.exceptions import InvalidInputException, UnavailableException
+from object_detector_backend.util.lru import LRUCache
+
+# optional dependency of thumbnails: pip install pillow
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+
+def thumbnail_key(checksum: str, size: int) -> str:
+    """Blob store key of a thumbnail
+    """
+    return f'{checksum}thumb{size}'
+
+
+class ThumbnailCache():
+    """Two tier cache of jpeg thumbnails keyed by (checksum, size).
+    A bounded in-memory LRU sits in front of thumbnails stored in the blob store,
+    thumbnails missing from both are generated from the image content on first request.
+    Only the given sizes are served so the number of cached thumbnails stays bounded
+    """
+    def __init__(self,
+                 blob_store: BlobStore,
+                 sizes: List[int] = (64, 128, 256, 512),
+                 max_entries: int = 256,
+                 quality: int = 80):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.blob_store = blob_store
+        self.sizes = sorted(sizes)
+        self.quality = quality
+        self.memory = LRUCache(max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self._lock = threading.Lock()
+
+    def validate_size(self, size: int):
+        if size not in self.sizes:
+            raise InvalidInputException(f"'size' must be one of {', '.join(str(s) for s in self.sizes)}")
+
+    def get(self, checksum: str, size: int, open_source: Callable[[], BinaryIO]) -> bytes:
+        """Returns the thumbnail of at most size pixels on its longer side.
+        open_source opens the image content, it is only called if the thumbnail has to be generated
+        """
+        self.validate_size(size)
+        key = thumbnail_key(checksum, size)
+        thumbnail = self.memory.get(key)
+        hit = thumbnail is not None
+
+        if thumbnail is None and self.blob_store.exists(key):
+            thumbnail = self.blob_store.get(key)
+            hit = True
+
+        if thumbnail is None:
+            with open_source() as source:
+                thumbnail = self.generate(source, size)
+            self.blob_store.put(key, thumbnail)
+
+        self.memory.set(key, thumbnail)
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.generated += 1
+
+        return thumbnail
+
+    def generate(self, source: BinaryIO, size: int) -> bytes:
+        if Image is None:
+            raise UnavailableException('Thumbnails require pillow to be installed')
+
+        with Image.open(source) as image:
+            # jpeg decoding downscales cheaply to about the thumbnail size
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.LANCZOS)
+
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            out = io.BytesIO()
+            image.save(out, format='JPEG', quality=self.quality, optimize=True)
+            return out.getvalue()
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'generated': self.generated,
+            'memory': self.memory.stats(),
+        }
@@ -1,13 +1,115 @@
+import importlib
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Union
+
 from google.cloud import vision
 
+from object_detector_backend.util.exceptions import InvalidInputException
+from object_detector_backend.util.metrics import metrics, timed
+
 # os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = './metal-circle-337704-f5cefa6e0d43.json'
 
 GOOGLE_VISION_API = 'https://vision.googleapis.com'
 ANNOTATE_METHPD = '/v1/images:annotate'
 
-class GoogleVisionAPICaller():
+logger = logging.getLogger(__name__)
+
+class Detector():
+    """Annotates image content with labels.
+    source and version identify the detector in stored labels and cached annotations
+    """
+    source = None
+    version = None
+
+    def annotate(self, content) -> list:
+        """Returns list of labels with score and topicality of the image content
+        """
+        raise NotImplementedError
+
+    def warmup(self):
+        """Prepares the detector ahead of the first request, i.e runs a dummy inference
+        """
+        pass
+
+
+# detector name -> class or import path of the class, imported when first used
+DETECTORS = {
+    'google': 'object_detector_backend.data.vision.GoogleVisionAPICaller',
+    'onnx': 'object_detector_backend.data.local_vision.OnnxDetector',
+}
+
+
+def register_detector(name: str, detector_class: Union[type, str]):
+    """Makes a detector class selectable by name
+    """
+    DETECTORS[name] = detector_class
+
+
+def _resolve_detector_class(name: str) -> type:
+    if name not in DETECTORS:
+        raise InvalidInputException(
+            f"Unknown detector '{name}', available detectors: {', '.join(sorted(DETECTORS))}")
+
+    detector_class = DETECTORS[name]
+    if isinstance(detector_class, str):
+        module_name, class_name = detector_class.rsplit('.', 1)
+        detector_class = getattr(importlib.import_module(module_name), class_name)
+
+    return detector_class
+
+
+class DetectorRegistry():
+    """Creates each detector once per process and hands out the same instance afterwards.
+    options maps detector names to keyword arguments of their constructor
+    """
+    def __init__(self, options: dict = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.options = options or {}
+        self._detectors = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Detector:
+        detector = self._detectors.get(name)
+        if detector is None:
+            with self._lock:
+                detector = self._detectors.get(name)
+                if detector is None:
+                    self.logger.info(f'Loading detector {name}')
+                    detector_class = _resolve_detector_class(name)
+                    detector = detector_class(**self.options.get(name, {}))
+                    self._detectors[name] = detector
+
+        return detector
+
+    def set(self, name: str, detector: Detector):
+        """Installs a ready detector instance under name, i.e a fake in tests
+        """
+        with self._lock:
+            self._detectors[name] = detector
+
+    def warmup(self, names: List[str]):
+        """Loads and warms up detectors. A detector failing to load is logged and loaded again on first use
+        """
+        for name in names:
+            start = time.perf_counter()
+            try:
+                self.get(name).warmup()
+            except Exception:
+                self.logger.exception(f'Warming up detector {name} failed')
+                continue
+            self.logger.info(f'Detector {name} warmed up in {time.perf_counter() - start:.2f}s')
+
+
+class GoogleVisionAPICaller(Detector):
     """Calls Google Vision API to annotate image with labels
     """
+    source = 'Google Vision'
+    version = 'v1'
+
     def __init__(self):
         self.client = vision.ImageAnnotatorClient()
 
@@ -21,8 +123,31 @@ class GoogleVisionAPICaller():
 
         image = vision.Image(content=content)
         response = self.client.label_detection(image=image)
-        labels = response.label_annotations
+        return self._to_labels(response.label_annotations)
+
+    def annotate_batch(self, contents: List[bytes]) -> list:
+        """call batch annotate method of the API with up to 16 images in one request.
+        Returns list of labels per image, images the API failed to annotate get an Exception instead
+        """
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=[vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION)])
+            for content in contents
+        ]
+        response = self.client.batch_annotate_images(requests=requests)
+
+        to_return = []
+        for image_response in response.responses:
+            if image_response.error.message:
+                to_return.append(Exception(image_response.error.message))
+            else:
+                to_return.append(self._to_labels(image_response.label_annotations))
+
+        return to_return
 
+    @staticmethod
+    def _to_labels(labels) -> list:
         to_return = []
 
         for label in labels:
@@ -34,6 +159,118 @@ class GoogleVisionAPICaller():
 
         return to_return
 
+
+def annotate_timed(detector, content) -> list:
+    """Annotates content with the detector, recording the call latency and failures in the process metrics
+    """
+    with timed('vision_call_duration_seconds', errors='vision_errors_total', trace='vision',
+               source=detector.source, method='annotate'):
+        return detector.annotate(content=content)
+
+
+def annotate_batch_timed(detector, contents: List[bytes]) -> list:
+    """Annotates contents in one annotate_batch call of the detector, recording the call latency and failures
+    in the process metrics. Returns labels per content, contents which failed get an Exception instead
+    """
+    try:
+        with timed('vision_call_duration_seconds', source=detector.source, method='annotate_batch'):
+            results = detector.annotate_batch(contents)
+    except Exception as e:
+        logger.exception(f'Batch of {len(contents)} images failed')
+        results = [e] * len(contents)
+
+    if len(results) != len(contents):
+        logger.error(f'Batch of {len(contents)} images returned {len(results)} results')
+        error = Exception(f'Detector returned {len(results)} results for a batch of {len(contents)} images')
+        results = [error] * len(contents)
+
+    # images the API failed to annotate are reported in the results
+    metrics.inc('vision_errors_total', sum(isinstance(r, Exception) for r in results),
+                source=detector.source, method='annotate_batch')
+    return results
+
+
+class BatchingAnnotator():
+    """Coalesces images submitted by concurrent callers into batched annotate calls.
+    A batch is sent once batch_size images are pending or the oldest pending image
+    waited max_wait seconds. Wraps any detector, detectors without annotate_batch
+    are called once per image
+    """
+    def __init__(self, detector, batch_size: int = 16, max_wait: float = 0.05):
+        self.detector = detector
+        self.source = detector.source
+        self.version = detector.version
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='vision-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, content) -> Future:
+        """Queues an image for annotation. The future resolves to its labels
+        """
+        if content is None:
+            raise Exception('content of an image cannot be none')
+
+        future = Future()
+        self._queue.put((content, future))
+        return future
+
+    def annotate(self, content) -> list:
+        return self.submit(content).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            closing = False
+
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            self._annotate(batch)
+            if closing:
+                return
+
+    def _annotate(self, batch: list):
+        contents = [content for content, _ in batch]
+        self.batches += 1
+
+        if hasattr(self.detector, 'annotate_batch'):
+            results = annotate_batch_timed(self.detector, contents)
+        else:
+            results = []
+            for content in contents:
+                try:
+                    results.append(annotate_timed(self.detector, content))
+                except Exception as e:
+                    results.append(e)
+
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
 def main():
     vision_caller = GoogleVisionAPICaller()
 
@@ -0,0 +1,124 @@
+import threading
+
+from app import create_app
+from object_detector_backend.blueprints.extensions import get_job_queue, init_worker, shutdown_app
+from object_detector_backend.data.vision import Detector, register_detector
+
+def test_create_app_builds_independent_apps(tmp_path):
+    config = {
+        'DATABASE_URL': f'sqlite:///{tmp_path / "app.db"}',
+        'BLOB_STORE_PATH': str(tmp_path / 'blobs'),
+        'DETECTORS_WARMUP': [],
+    }
+    first = create_app(config)
+    second = create_app(config)
+    assert(first is not second)
+    assert(first.config['DATABASE_URL'] == config['DATABASE_URL'])
+    assert(first.config['DATABASE_POOL_SIZE'] == 5)
+
+    init_worker(first)
+    assert('database' in first.extensions)
+    assert('database' not in second.extensions)
+
+    resp = first.test_client().get('/images')
+    assert(resp.status_code == 200)
+    assert(resp.json['images'] == [])
+
+    assert(shutdown_app(first))
+    assert('database' not in first.extensions)
+
+def test_shutdown_app_drains_detection_jobs(tmp_path):
+    app = create_app({
+        'DATABASE_URL': f'sqlite:///{tmp_path / "app.db"}',
+        'BLOB_STORE_PATH': str(tmp_path / 'blobs'),
+        'DETECTORS_WARMUP': [],
+    })
+    init_worker(app)
+    release = threading.Event()
+    finished = []
+
+    def job():
+        release.wait(5)
+        finished.append(1)
+
+    with app.app_context():
+        get_job_queue().submit(job)
+
+    # jobs still running past the timeout are reported
+    assert(not(shutdown_app(app, timeout=0.05)))
+    release.set()
+
+    with app.app_context():
+        get_job_queue().submit(finished.append, 2)
+    assert(shutdown_app(app, timeout=5))
+    assert(sorted(finished) == [1, 2])
+
+def test_worker_writes_metrics_snapshots(tmp_path):
+    import os
+    import time
+
+    app = create_app({
+        'DATABASE_URL': f'sqlite:///{tmp_path / "app.db"}',
+        'BLOB_STORE_PATH': str(tmp_path / 'blobs'),
+        'DETECTORS_WARMUP': [],
+        'METRICS_DIR': str(tmp_path / 'metrics'),
+        'METRICS_SNAPSHOT_INTERVAL': 0.05,
+    })
+    init_worker(app)
+    snapshot = tmp_path / 'metrics' / f'metrics-{os.getpid()}.json'
+
+    deadline = time.monotonic() + 5
+    while not(snapshot.exists()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert(snapshot.exists())
+
+    # the last snapshot is written when the worker stops
+    snapshot.unlink()
+    assert(shutdown_app(app))
+    assert(snapshot.exists())
+
+def test_worker_rescans_similarity_index(tmp_path):
+    import time
+
+    app = create_app({
+        'DATABASE_URL': f'sqlite:///{tmp_path / "app.db"}',
+        'BLOB_STORE_PATH': str(tmp_path / 'blobs'),
+        'DETECTORS_WARMUP': [],
+        'SIMILARITY_RESCAN_INTERVAL': 0.05,
+    })
+    init_worker(app)
+
+    class CountingIndex():
+        rescans = 0
+
+        def rescan(self, db_api):
+            self.rescans += 1
+
+    index = app.extensions['similarity_index'] = CountingIndex()
+    deadline = time.monotonic() + 5
+    while index.rescans == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert(index.rescans > 0)
+    assert(shutdown_app(app))
+
+class WarmupDetector(Detector):
+    source = 'Warmup'
+    version = '1'
+    warmups = 0
+
+    def warmup(self):
+        WarmupDetector.warmups += 1
+
+def test_worker_warms_up_default_detector(tmp_path):
+    register_detector('warmup-fake', WarmupDetector)
+    WarmupDetector.warmups = 0
+    app = create_app({
+        'DATABASE_URL': f'sqlite:///{tmp_path / "app.db"}',
+        'BLOB_STORE_PATH': str(tmp_path / 'blobs'),
+        'DETECTOR': 'warmup-fake',
+    })
+
+    # gunicorn.conf.py and python3 -m app both start workers with init_worker
+    init_worker(app)
+    assert(WarmupDetector.warmups == 1)
+    assert(shutdown_app(app))
@@ -0,0 +1,49 @@
+from object_detector_backend.benchmark.fake_vision import FakeVisionDetector
+from object_detector_backend.benchmark.run import SCENARIOS, percentile, run_benchmark
+
+def test_fake_vision_is_deterministic():
+    detector = FakeVisionDetector(labels_per_image=3)
+    labels = detector.annotate(b'content')
+    assert(len(labels) == 3)
+    assert(labels == FakeVisionDetector(labels_per_image=3).annotate(b'content'))
+    assert(detector.annotate_batch([b'content', b'other'])[0] == labels)
+    assert(detector.calls == 2)
+
+def test_percentile():
+    values = [i / 100 for i in range(1, 101)]
+    assert(percentile(values, 50) == 0.5)
+    assert(percentile(values, 99) == 0.99)
+    assert(percentile([], 95) == 0.0)
+
+def test_run_benchmark(tmp_path):
+    config = {
+        'DATABASE_URL': f'sqlite:///{tmp_path / "bench.db"}',
+        'BLOB_STORE_PATH': str(tmp_path / 'blobs'),
+        'DETECTOR': 'fake',
+        'DETECTORS_WARMUP': [],
+        'DETECTOR_OPTIONS': {'fake': {'latency': 0.0}},
+    }
+    report = run_benchmark(config, rows=50, requests=10, concurrency=2)
+    assert(report['seeded'] == 50)
+    assert(report['peak_rss_mb'] > 0)
+    assert([result['scenario'] for result in report['scenarios']] == list(SCENARIOS))
+    for result in report['scenarios']:
+        assert(result['errors'] == 0)
+        assert(result['requests'] == 10)
+        assert(result['cache_hits'] == 0)
+        assert(result['p50_ms'] <= result['p95_ms'] <= result['p99_ms'] <= result['max_ms'])
+
+    # seeded rows are reused by later runs
+    report = run_benchmark(config, rows=50, requests=5, concurrency=1, scenarios=['by_id'])
+    assert(report['seeded'] == 0)
+
+def test_run_benchmark_response_cache(tmp_path):
+    config = {
+        'DATABASE_URL': f'sqlite:///{tmp_path / "bench.db"}',
+        'BLOB_STORE_PATH': str(tmp_path / 'blobs'),
+        'DETECTOR': 'fake',
+        'DETECTORS_WARMUP': [],
+        'RESPONSE_CACHE_ENABLED': True,
+    }
+    report = run_benchmark(config, rows=5, requests=20, concurrency=1, scenarios=['by_id'])
+    assert(report['scenarios'][0]['cache_hits'] > 0)
@@ -0,0 +1,98 @@
+import hashlib
+import os
+
+from object_detector_backend.data.blobs import LocalBlobStore, MemoryBlobStore
+from object_detector_backend.util.exceptions import PayloadTooLargeException
+
+def test_local_blob_store_shards_by_key(tmp_path):
+    store = LocalBlobStore(tmp_path)
+    key = 'e1f0ab68247b61dd8995d1d7b823c158'
+
+    assert(store.put(key, b'1234'))
+    assert(store.path(key) == os.path.join(str(tmp_path), 'e1', 'f0', key))
+    assert(store.exists(key))
+    assert(store.get(key) == b'1234')
+
+    with store.open(key) as f:
+        assert(f.read() == b'1234')
+
+def test_local_blob_store_resolves_relative_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = LocalBlobStore('blobs')
+    key = 'e1f0ab68247b61dd8995d1d7b823c158'
+
+    assert(store.root == str(tmp_path / 'blobs'))
+    assert(os.path.isabs(store.path(key)))
+
+    # the root is created by the first write, not by the constructor
+    assert(not(os.path.exists(store.root)))
+    assert(store.put(key, b'1234'))
+    assert(store.exists(key))
+
+def test_local_blob_store_dedupes_content(tmp_path):
+    store = LocalBlobStore(tmp_path)
+    key = 'e1f0ab68247b61dd8995d1d7b823c158'
+
+    assert(store.put(key, b'1234'))
+    assert(not(store.put(key, b'1234')))
+
+    store.clear()
+    assert(not(store.exists(key)))
+    assert(store.put(key, b'1234'))
+
+def test_local_blob_store_clear_keeps_other_files(tmp_path):
+    store = LocalBlobStore(tmp_path)
+    key = 'e1f0ab68247b61dd8995d1d7b823c158'
+    store.put(key, b'1234')
+    store.put_stream([b'5678'])
+    (tmp_path / 'notes.txt').write_text('not a blob')
+    (tmp_path / 'e1' / 'README').write_text('not a blob either')
+    (tmp_path / 'photos').mkdir()
+    (tmp_path / 'photos' / 'e1f0ab68247b61dd8995d1d7b823c158').write_bytes(b'1234')
+
+    store.clear()
+    assert(not(store.exists(key)))
+    assert(sorted(os.listdir(tmp_path)) == ['e1', 'notes.txt', 'photos'])
+    assert(os.listdir(tmp_path / 'e1') == ['README'])
+    assert(os.listdir(tmp_path / 'photos') == ['e1f0ab68247b61dd8995d1d7b823c158'])
+
+def test_local_blob_store_rejects_path_keys(tmp_path):
+    store = LocalBlobStore(tmp_path)
+    try:
+        store.put('../escape', b'1234')
+        assert(False)
+    except ValueError:
+        pass
+
+def test_memory_blob_store():
+    store = MemoryBlobStore()
+    assert(store.put('abc', b'1234'))
+    assert(not(store.put('abc', b'1234')))
+    assert(store.open('abc').read() == b'1234')
+
+    store.delete('abc')
+    assert(not(store.exists('abc')))
+
+def test_local_blob_store_put_stream(tmp_path):
+    store = LocalBlobStore(tmp_path)
+    key, size = store.put_stream(iter([b'12', b'34']))
+
+    assert(key == hashlib.md5(b'1234').hexdigest())
+    assert(size == 4)
+    assert(store.get(key) == b'1234')
+
+    # identical content streamed again keeps the stored blob and leaves no temp file behind
+    assert(store.put_stream(iter([b'1234']))[0] == key)
+    assert(os.listdir(tmp_path / 'tmp') == [])
+
+def test_put_stream_rejects_large_content(tmp_path):
+    for store in (LocalBlobStore(tmp_path), MemoryBlobStore()):
+        try:
+            store.put_stream(iter([b'12', b'34', b'56']), max_bytes=5)
+            assert(False)
+        except PayloadTooLargeException:
+            pass
+
+        assert(not(store.exists(hashlib.md5(b'123456').hexdigest())))
+
+    assert(os.listdir(tmp_path / 'tmp') == [])
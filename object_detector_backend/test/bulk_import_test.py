@@ -0,0 +1,124 @@
+import shutil
+
+import pytest
+
+from object_detector_backend.data.bulk_import import BulkImporter, ImportCheckpoint, iter_directory, iter_manifest
+from object_detector_backend.data.cache import AnnotationCache
+from object_detector_backend.util.exceptions import InvalidInputException
+
+class CountingDetector():
+    source = 'Google Vision'
+    version = 'v1'
+
+    def __init__(self):
+        self.calls = 0
+
+    def annotate(self, content) -> list:
+        self.calls += 1
+        return [{'label': 'Animal', 'score': 0.9, 'topicality': 0.9}]
+
+class CountingBatchDetector(CountingDetector):
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def annotate_batch(self, contents: list) -> list:
+        self.batch_sizes.append(len(contents))
+        return [[{'label': 'Animal', 'score': 0.9, 'topicality': 0.9}] for _ in contents]
+
+def _image_dir(tmp_path):
+    root = tmp_path / 'import'
+    (root / 'pets').mkdir(parents=True)
+    shutil.copy('images/whale.jpeg', root / 'whale.jpeg')
+    shutil.copy('images/dog.jpeg', root / 'pets' / 'dog.jpeg')
+    shutil.copy('images/dog.jpeg', root / 'pets' / 'puppy.jpeg')
+    shutil.copy('images/cat.jpeg', root / 'pets' / 'cat.jpeg')
+    (root / 'notes.txt').write_text('not an image')
+    (root / 'broken.png').write_bytes(b'not an image either')
+    return root
+
+def test_iter_directory_and_manifest(tmp_path):
+    root = _image_dir(tmp_path)
+    assert([item.source for item in iter_directory(root)] ==
+           ['broken.png', 'whale.jpeg', 'pets/cat.jpeg', 'pets/dog.jpeg', 'pets/puppy.jpeg'])
+
+    manifest = tmp_path / 'urls.txt'
+    manifest.write_text('# images\nhttp://localhost/a.jpeg\n\nhttp://localhost/b.jpeg\n')
+    assert([item.url for item in iter_manifest(manifest)] == ['http://localhost/a.jpeg', 'http://localhost/b.jpeg'])
+
+def test_bulk_import_directory(setup_database, tmp_path):
+    db = setup_database
+    root = _image_dir(tmp_path)
+    detector = CountingDetector()
+    importer = BulkImporter(db.database,
+                            detector=detector,
+                            annotation_cache=AnnotationCache(db.database),
+                            workers=2,
+                            detection_workers=2,
+                            batch_size=2)
+
+    stats = importer.run(iter_directory(root), str(root))
+    assert(stats['processed'] == 5)
+    assert(stats['imported'] == 4)
+    assert(stats['failed'] == 1)
+    assert(stats['annotated'] == 4)
+    # puppy.jpeg shares its content with dog.jpeg, only distinct content is annotated
+    assert(detector.calls == 3)
+
+    images = db.get_images()
+    assert(sorted(image['filename'] for image in images) == ['pets/cat.jpeg', 'pets/dog.jpeg', 'pets/puppy.jpeg', 'whale.jpeg'])
+    assert(all(image['label'][0]['label'] == 'Animal' for image in images))
+
+    # importing again finds every file stored already
+    stats = BulkImporter(db.database, detector=detector).run(iter_directory(root), str(root))
+    assert(stats['imported'] == 0)
+    assert(stats['duplicates'] == 4)
+    assert(detector.calls == 3)
+
+def test_bulk_import_copies_labels_within_batch(setup_database, tmp_path):
+    db = setup_database
+    root = tmp_path / 'import'
+    root.mkdir()
+    shutil.copy('images/dog.jpeg', root / 'dog.jpeg')
+    shutil.copy('images/dog.jpeg', root / 'puppy.jpeg')
+    detector = CountingDetector()
+
+    # identical content in one batch is annotated once, without an annotation cache
+    stats = BulkImporter(db.database, detector=detector, batch_size=2).run(iter_directory(root), str(root))
+    assert(stats['imported'] == 2)
+    assert(stats['annotated'] == 2)
+    assert(detector.calls == 1)
+
+    images = db.get_images()
+    assert(sorted(image['filename'] for image in images) == ['dog.jpeg', 'puppy.jpeg'])
+    assert(all([label['label'] for label in image['label']] == ['Animal'] for image in images))
+
+def test_bulk_import_sends_batches_to_the_detector(setup_database, tmp_path):
+    db = setup_database
+    root = _image_dir(tmp_path)
+    detector = CountingBatchDetector()
+
+    stats = BulkImporter(db.database, detector=detector, batch_size=10, detection_workers=1,
+                         detection_batch_size=2).run(iter_directory(root), str(root))
+    assert(stats['annotated'] == 4)
+    # whale, cat and dog are annotated, the last one alone, puppy gets the labels of dog
+    assert(detector.batch_sizes == [2])
+    assert(detector.calls == 1)
+
+def test_bulk_import_resumes_from_checkpoint(setup_database, tmp_path):
+    db = setup_database
+    root = _image_dir(tmp_path)
+    checkpoint = ImportCheckpoint(str(tmp_path / 'import.json'))
+    items = list(iter_directory(root))
+
+    # an import interrupted after its first batch
+    BulkImporter(db.database, batch_size=2, checkpoint=checkpoint).run(items[:2], str(root))
+    assert(checkpoint.load()['processed'] == 2)
+
+    stats = BulkImporter(db.database, batch_size=2, checkpoint=checkpoint).run(items, str(root))
+    assert(stats['processed'] == 5)
+    assert(stats['imported'] == 4)
+    assert(stats['duplicates'] == 0)
+
+    with pytest.raises(InvalidInputException):
+        BulkImporter(db.database, checkpoint=checkpoint).run(items, 'another directory')
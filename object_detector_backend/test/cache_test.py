@@ -0,0 +1,76 @@
+from object_detector_backend.data.cache import AnnotationCache
+from object_detector_backend.data.response_cache import MemoryResponseCache
+from object_detector_backend.util.lru import LRUCache
+
+LABELS = [{'label': 'Whale', 'score': 0.9, 'topicality': 0.9}]
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert(cache.get('a') == 1)
+
+    cache.set('c', 3)
+    assert(cache.get('b') is None)
+    assert(cache.get('a') == 1)
+    assert(cache.get('c') == 3)
+    assert(cache.stats()['evictions'] == 1)
+    assert(cache.hits == 3)
+    assert(cache.misses == 1)
+
+def test_lru_cache_expires_entries():
+    clock = FakeClock()
+    cache = LRUCache(max_entries=2, ttl=10, clock=clock)
+    cache.set('a', 1)
+
+    clock.now = 5
+    assert(cache.get('a') == 1)
+
+    clock.now = 11
+    assert(cache.get('a') is None)
+    assert(len(cache) == 0)
+
+def test_annotation_cache(setup_database):
+    db = setup_database
+    cache = AnnotationCache(db.database, max_entries=10)
+
+    assert(cache.get('checksum', 'Google Vision', 'v1') is None)
+    cache.put('checksum', 'Google Vision', 'v1', LABELS)
+    assert(cache.get('checksum', 'Google Vision', 'v1') == LABELS)
+
+    # keyed by detector version as well
+    assert(cache.get('checksum', 'Google Vision', 'v2') is None)
+    assert(cache.stats()['hits'] == 1)
+    assert(cache.stats()['misses'] == 2)
+
+def test_annotation_cache_persists(setup_database):
+    db = setup_database
+    AnnotationCache(db.database).put('checksum', 'Google Vision', 'v1', LABELS)
+
+    # a new process starts with an empty memory tier
+    cache = AnnotationCache(db.database)
+    assert(cache.get('checksum', 'Google Vision', 'v1') == LABELS)
+    assert(cache.memory.misses == 1)
+    assert(cache.get('checksum', 'Google Vision', 'v1') == LABELS)
+    assert(cache.memory.hits == 1)
+
+    assert(db.get_annotation('checksum', 'Google Vision', 'v1', max_age=-1) is None)
+
+def test_response_cache_invalidates_written_images():
+    cache = MemoryResponseCache(max_generations=2)
+    dog, cat = cache.image_key('dog'), cache.image_key('cat')
+    cache.invalidate_images(['dog'])
+    assert(cache.image_key('dog') != dog)
+    assert(cache.image_key('cat') == cat)
+
+    # the generation of dog is dropped, its key does not go back to the one cached before the write
+    cache.invalidate_images(['cat'])
+    assert(len(cache._generations) == 2)
+    assert(cache.image_key('dog') != dog)
@@ -1,22 +1,75 @@
 import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
+from sqlalchemy import event
 
+from object_detector_backend.data.blobs import LocalBlobStore
 from object_detector_backend.data.persistence import DatabaseAPI
 from object_detector_backend.data.vision import GoogleVisionAPICaller
 
 TEST_DB_PATH = 'test.db'
 
 @pytest.fixture()
-def setup_database():
+def setup_database(tmp_path):
     """create a fresh database for each test
     """
-    db = DatabaseAPI(conn_str=f'sqlite:///{TEST_DB_PATH}')
+    db = DatabaseAPI(conn_str=f'sqlite:///{TEST_DB_PATH}',
+                     blob_store=LocalBlobStore(tmp_path / 'blobs'))
 
     yield db
 
     # database teardown
+    db.database.dispose()
     os.remove(TEST_DB_PATH)
 
+@pytest.fixture()
+def query_counter(setup_database):
+    """counts SQL statements executed against the test database
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(setup_database.engine, 'before_cursor_execute', count)
+    yield statements
+    event.remove(setup_database.engine, 'before_cursor_execute', count)
+
+@pytest.fixture()
+def setup_client(tmp_path):
+    """flask test client backed by a fresh database and blob store
+    """
+    from app import app
+    from object_detector_backend.blueprints.extensions import create_database
+
+    app.config.update(TESTING=True,
+                      DATABASE_URL=f'sqlite:///{tmp_path / "app.db"}',
+                      BLOB_STORE_PATH=str(tmp_path / 'blobs'))
+    database = create_database(app)
+
+    yield app.test_client()
+
+    job_queue = app.extensions.pop('job_queue', None)
+    if job_queue is not None:
+        job_queue.shutdown(wait=True)
+
+    fan_out_executor = app.extensions.pop('fan_out_executor', None)
+    if fan_out_executor is not None:
+        fan_out_executor.shutdown(wait=False)
+
+    for batching_annotator in app.extensions.pop('batching_annotators', {}).values():
+        batching_annotator.close()
+
+    for name in ('detectors', 'annotation_cache', 'fetcher'):
+        app.extensions.pop(name, None)
+
+    database.dispose()
+    app.extensions.pop('database')
+
 @pytest.fixture
 def setup_vision_client():
     """create a vision client for each test
@@ -31,3 +84,38 @@ def setup_vision_client():
     return vision_caller
 
 
+
+class ImageRequestHandler(SimpleHTTPRequestHandler):
+    """serves files of the images directory, /slow/<file> streams slowly and /missing fails
+    """
+    def do_GET(self):
+        if self.path.startswith('/slow/'):
+            self.send_response(200)
+            self.end_headers()
+            for _ in range(20):
+                try:
+                    self.wfile.write(b'0' * 1024)
+                    self.wfile.flush()
+                except ConnectionError:
+                    return
+                time.sleep(0.1)
+            return
+
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture()
+def setup_http_server():
+    """local stand-in for remote image hosts, yields its base url
+    """
+    handler = partial(ImageRequestHandler, directory='images')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,66 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from object_detector_backend.data.cache import AnnotationCache
+from object_detector_backend.data.detection import aggregate_labels, detect_labels_fan_out
+from object_detector_backend.data.models import ImageModel
+
+class StaticDetector():
+    def __init__(self, source: str, labels: list, delay: float = 0.0, fail: bool = False):
+        self.source = source
+        self.version = '1'
+        self.labels = labels
+        self.delay = delay
+        self.fail = fail
+
+    def annotate(self, content) -> list:
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception('detector unavailable')
+        return self.labels
+
+def _label(label: str, score: float) -> dict:
+    return {'label': label, 'score': score, 'topicality': score}
+
+def test_aggregate_labels():
+    results = {
+        'a': [_label('Dog', 0.9), _label('Animal', 0.5)],
+        'b': [_label('dog', 0.5)],
+    }
+
+    mean = {l['label']: l['score'] for l in aggregate_labels(results, method='mean')}
+    assert(mean == {'Dog': 0.7, 'Animal': 0.5})
+
+    best = aggregate_labels(results, method='max')
+    assert(best[0] == _label('Dog', 0.9))
+
+    weighted = aggregate_labels(results, method='weighted', weights={'a': 3.0})
+    assert(abs(weighted[0]['score'] - 0.8) < 1e-9)
+
+def test_detect_labels_fan_out(setup_database):
+    db = setup_database
+    with open('images/dog.jpeg', 'rb') as f:
+        image = db.add_image(ImageModel(id=str(uuid.uuid1()), filename='dog.jpeg', content=f.read()))
+
+    detectors = {
+        'fast': StaticDetector('Fast', [_label('Dog', 0.8)]),
+        'slow': StaticDetector('Slow', [_label('Cat', 0.9)], delay=1.0),
+        'broken': StaticDetector('Broken', [], fail=True),
+    }
+    cache = AnnotationCache(db.database)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        start = time.monotonic()
+        labels, statuses = detect_labels_fan_out(db, image, detectors, executor,
+                                                 timeouts={'slow': 0.1},
+                                                 annotation_cache=cache)
+
+        # the slow detector never stalls the response past its deadline
+        assert(time.monotonic() - start < 0.9)
+
+    assert(statuses == {'fast': 'done', 'slow': 'timeout', 'broken': 'failed'})
+    assert(sorted((l['source'], l['label']) for l in labels) == [('Aggregated', 'Dog'), ('Fast', 'Dog')])
+
+    # the late result was still cached once it arrived
+    assert(cache.get(image['check_sum'], 'Slow', '1') == [_label('Cat', 0.9)])
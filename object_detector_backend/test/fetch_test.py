@@ -0,0 +1,43 @@
+import time
+
+import pytest
+import requests
+
+from object_detector_backend.data.fetch import ImageFetcher
+from object_detector_backend.util.exceptions import PayloadTooLargeException
+
+def test_fetch_image(setup_http_server):
+    fetcher = ImageFetcher(chunk_size=1024)
+    fetched = fetcher.fetch(f'{setup_http_server}/dog.jpeg')
+
+    with open('images/dog.jpeg', 'rb') as f:
+        content = f.read()
+
+    assert(fetched.content == content)
+    assert(fetched.filename == 'dog.jpeg')
+    assert(fetched.content_type == 'image/jpeg')
+
+def test_fetch_enforces_max_bytes(setup_http_server):
+    fetcher = ImageFetcher(max_bytes=1000, chunk_size=1024)
+    with pytest.raises(PayloadTooLargeException):
+        fetcher.fetch(f'{setup_http_server}/dog.jpeg')
+
+    # the size cap also applies to responses without Content-Length
+    with pytest.raises(PayloadTooLargeException):
+        fetcher.fetch(f'{setup_http_server}/slow/dog.jpeg')
+
+def test_fetch_enforces_max_time(setup_http_server):
+    fetcher = ImageFetcher(max_time=0.3, chunk_size=1024)
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        fetcher.fetch(f'{setup_http_server}/slow/dog.jpeg')
+    assert(time.monotonic() - start < 1.5)
+
+def test_fetch_many(setup_http_server):
+    fetcher = ImageFetcher()
+    urls = [f'{setup_http_server}/{name}' for name in ('cat.jpeg', 'missing.jpeg', 'whale.jpeg')]
+    cat, missing, whale = fetcher.fetch_many(urls)
+
+    assert(cat.filename == 'cat.jpeg')
+    assert(isinstance(missing, requests.exceptions.HTTPError))
+    assert(whale.filename == 'whale.jpeg')
@@ -0,0 +1,551 @@
+import hashlib
+import io
+
+from PIL import Image
+
+from object_detector_backend.data.models import LabelModel
+
+def _post_image(client, path: str, filename: str) -> str:
+    with open(path, 'rb') as f:
+        resp = client.post('/images', data={
+            'image': (f, filename),
+            'filename': filename,
+            'enable_detection': 'False',
+        })
+    assert(resp.status_code == 200)
+    return resp.json['id']
+
+def test_get_image_content(setup_client):
+    client = setup_client
+    image_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+
+    with open('images/dog.jpeg', 'rb') as f:
+        content = f.read()
+
+    resp = client.get(f'/images/{image_id}/content')
+    assert(resp.status_code == 200)
+    assert(resp.data == content)
+    assert(resp.mimetype == 'image/jpeg')
+
+    # strong etag derived from the checksum
+    etag = resp.headers['ETag']
+    assert(not(etag.startswith('W/')))
+
+    resp = client.get(f'/images/{image_id}/content', headers={'If-None-Match': etag})
+    assert(resp.status_code == 304)
+    assert(resp.data == b'')
+
+def test_get_image_content_range(setup_client):
+    client = setup_client
+    image_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+
+    with open('images/dog.jpeg', 'rb') as f:
+        content = f.read()
+
+    resp = client.get(f'/images/{image_id}/content', headers={'Range': 'bytes=10-19'})
+    assert(resp.status_code == 206)
+    assert(resp.data == content[10:20])
+    assert(resp.headers['Content-Range'] == f'bytes 10-19/{len(content)}')
+
+    resp = client.get(f'/images/{image_id}/content', headers={'Range': f'bytes={len(content) + 10}-'})
+    assert(resp.status_code == 416)
+
+def test_get_missing_image_content(setup_client):
+    resp = setup_client.get('/images/missing/content')
+    assert(resp.status_code == 404)
+
+class FakeDetector():
+    """Stands in for GoogleVisionAPICaller without network calls
+    """
+    source = 'Google Vision'
+    version = 'v1'
+
+    def __init__(self, fail: bool = False):
+        self.calls = 0
+        self.fail = fail
+
+    def annotate(self, content) -> list:
+        self.calls += 1
+        if self.fail:
+            raise Exception('detector unavailable')
+        return [{'label': 'Dog', 'score': 0.9, 'topicality': 0.8}]
+
+class RecordingDetector(FakeDetector):
+    """Keeps the content each annotate call received
+    """
+    def __init__(self):
+        super().__init__()
+        self.contents = []
+
+    def annotate(self, content) -> list:
+        self.contents.append(content)
+        return super().annotate(content)
+
+def _use_detector(client, detector, name: str = 'google'):
+    from object_detector_backend.blueprints.extensions import get_detector_registry
+
+    with client.application.app_context():
+        get_detector_registry().set(name, detector)
+    return detector
+
+def test_post_duplicate_content_uses_annotation_cache(setup_client, monkeypatch):
+    client = setup_client
+    detector = _use_detector(client, FakeDetector())
+    # near duplicate reuse would answer before the annotation cache
+    monkeypatch.setitem(client.application.config, 'PHASH_ENABLED', False)
+
+    for filename in ('dog.jpeg', 'puppy.jpeg'):
+        with open('images/dog.jpeg', 'rb') as f:
+            resp = client.post('/images', data={'image': (f, filename), 'filename': filename})
+        assert(resp.status_code == 200)
+        assert([label['label'] for label in resp.json['labels']] == ['Dog'])
+
+    assert(detector.calls == 1)
+    assert(client.get('/cache').json['annotations']['hits'] == 1)
+
+def test_post_image_async(setup_client):
+    client = setup_client
+    _use_detector(client, FakeDetector())
+
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={
+            'image': (f, 'dog.jpeg'),
+            'filename': 'dog.jpeg',
+            'label': 'pet',
+            'async': 'True',
+        })
+    assert(resp.status_code == 202)
+    assert(resp.json['job_id'])
+    assert(resp.json['status'] == 'pending')
+    # the background job may already have added its labels
+    assert('pet' in [label['label'] for label in resp.json['labels']])
+
+    assert(client.application.extensions['job_queue'].drain(timeout=10))
+
+    resp = client.get(f"/images/{resp.json['id']}/jobs")
+    assert([job['status'] for job in resp.json['jobs']] == ['done'])
+    assert(sorted(label['label'] for label in resp.json['labels']) == ['Dog', 'pet'])
+
+def test_post_image_async_failure(setup_client):
+    client = setup_client
+    _use_detector(client, FakeDetector(fail=True))
+
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={'image': (f, 'dog.jpeg'), 'filename': 'dog.jpeg', 'async': 'True'})
+    assert(resp.status_code == 202)
+    assert(client.application.extensions['job_queue'].drain(timeout=10))
+
+    jobs = client.get(f"/images/{resp.json['id']}/jobs").json['jobs']
+    assert(jobs[0]['status'] == 'failed')
+    assert(jobs[0]['error'] == 'detector unavailable')
+
+def test_get_jobs_of_unknown_image(setup_client):
+    assert(setup_client.get('/images/unknown/jobs').status_code == 404)
+
+class FakeBatchDetector(FakeDetector):
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def annotate_batch(self, contents: list) -> list:
+        self.batch_sizes.append(len(contents))
+        return [self.annotate(content) for content in contents]
+
+def test_post_images_batch(setup_client, monkeypatch):
+    client = setup_client
+    detector = _use_detector(client, FakeBatchDetector())
+    monkeypatch.setitem(client.application.config, 'VISION_BATCH_MAX_WAIT', 0.5)
+
+    files = [open(f'images/{name}', 'rb') for name in ('cat.jpeg', 'dog.jpeg', 'whale.jpeg')]
+    try:
+        resp = client.post('/images/batch', data={
+            'image': [(f, f.name.split('/')[-1]) for f in files],
+            'label': 'bulk',
+        })
+    finally:
+        for f in files:
+            f.close()
+
+    assert(resp.status_code == 200)
+    assert(len(resp.json['images']) == 3)
+    for image in resp.json['images']:
+        assert(sorted(label['label'] for label in image['labels']) == ['Dog', 'bulk'])
+
+    # three images annotated with one batched call
+    assert(detector.batch_sizes == [3])
+
+def test_post_image_with_selected_detector(setup_client):
+    client = setup_client
+    default = _use_detector(client, FakeDetector())
+    selected = _use_detector(client, FakeDetector(), name='fake')
+
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={'image': (f, 'dog.jpeg'), 'filename': 'dog.jpeg', 'detector': 'fake'})
+    assert(resp.status_code == 200)
+    assert(selected.calls == 1)
+    assert(default.calls == 0)
+
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={'image': (f, 'dog.jpeg'), 'filename': 'dog.jpeg', 'detector': 'missing'})
+    assert(resp.status_code == 400)
+
+def test_post_image_fan_out(setup_client):
+    client = setup_client
+    _use_detector(client, FakeDetector(), name='first')
+    _use_detector(client, FakeDetector(), name='second')
+
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={
+            'image': (f, 'dog.jpeg'),
+            'filename': 'dog.jpeg',
+            'detectors': 'first,second',
+            'aggregation': 'max',
+        })
+    assert(resp.status_code == 200)
+    assert(resp.json['detectors'] == {'first': 'done', 'second': 'done'})
+
+    # both detectors share a source so one raw label set and the aggregate are stored
+    assert(sorted(label['source'] for label in resp.json['labels']) == ['Aggregated', 'Google Vision'])
+
+def test_post_image_fan_out_of_one_detector(setup_client):
+    client = setup_client
+    default = _use_detector(client, FakeDetector())
+    selected = _use_detector(client, FakeDetector(), name='first')
+
+    # a single entry selects that detector instead of the default one
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={'image': (f, 'dog.jpeg'), 'filename': 'dog.jpeg', 'detectors': 'first'})
+    assert(resp.status_code == 200)
+    assert(selected.calls == 1)
+    assert(default.calls == 0)
+
+    # invalid detectors and aggregations are rejected before the image is stored
+    for data in ({'detectors': 'first,missing'}, {'detectors': 'first,google', 'aggregation': 'median'}):
+        with open('images/whale.jpeg', 'rb') as f:
+            resp = client.post('/images', data=dict(data, image=(f, 'whale.jpeg'), filename='whale.jpeg'))
+        assert(resp.status_code == 400)
+    assert(len(client.get('/images').json['images']) == 1)
+
+def test_post_image_url(setup_client, setup_http_server, monkeypatch):
+    client = setup_client
+
+    resp = client.post('/images', data={'url': f'{setup_http_server}/whale.jpeg', 'enable_detection': 'False'})
+    assert(resp.status_code == 200)
+
+    resp = client.post('/images', data={'url': f'{setup_http_server}/missing.jpeg', 'enable_detection': 'False'})
+    assert(resp.status_code == 400)
+
+    monkeypatch.setitem(client.application.config, 'FETCH_MAX_BYTES', 1000)
+    client.application.extensions.pop('fetcher')
+    resp = client.post('/images', data={'url': f'{setup_http_server}/cat.jpeg', 'enable_detection': 'False'})
+    assert(resp.status_code == 413)
+
+def test_post_image_streams_upload_to_blob_store(setup_client):
+    client = setup_client
+    image_id = _post_image(client, 'images/whale.jpeg', 'whale.jpeg')
+
+    with open('images/whale.jpeg', 'rb') as f:
+        content = f.read()
+
+    resp = client.get(f'/images/{image_id}')
+    assert(resp.json['images'][0]['check_sum'] == hashlib.md5(content).hexdigest())
+    assert(client.get(f'/images/{image_id}/content').data == content)
+
+def test_post_image_rejects_large_upload(setup_client, monkeypatch):
+    client = setup_client
+    monkeypatch.setitem(client.application.config, 'UPLOAD_MAX_BYTES', 1000)
+
+    with open('images/whale.jpeg', 'rb') as f:
+        resp = client.post('/images', data={
+            'image': (f, 'whale.jpeg'),
+            'filename': 'whale.jpeg',
+            'enable_detection': 'False',
+        })
+    assert(resp.status_code == 413)
+
+    # bodies over MAX_CONTENT_LENGTH are refused before they are read
+    monkeypatch.setitem(client.application.config, 'MAX_CONTENT_LENGTH', 1000)
+    with open('images/whale.jpeg', 'rb') as f:
+        resp = client.post('/images', data={
+            'image': (f, 'whale.jpeg'),
+            'filename': 'whale.jpeg',
+        })
+    assert(resp.status_code == 413)
+    assert(client.get('/images').json['images'] == [])
+
+def test_post_near_duplicate_reuses_labels(setup_client):
+    client = setup_client
+    detector = _use_detector(client, FakeDetector())
+    with open('images/dog.jpeg', 'rb') as f:
+        original_id = client.post('/images', data={'image': (f, 'dog.jpeg'), 'filename': 'dog.jpeg'}).json['id']
+    assert(detector.calls == 1)
+
+    # a smaller re-encoded copy is labeled without calling the detector
+    image = Image.open('images/dog.jpeg')
+    copy = io.BytesIO()
+    image.resize((image.width // 2, image.height // 2)).save(copy, format='JPEG', quality=60)
+    copy.seek(0)
+
+    resp = client.post('/images', data={'image': (copy, 'small_dog.jpeg'), 'filename': 'small_dog.jpeg'})
+    assert(resp.status_code == 200)
+    assert(resp.json['near_duplicate_of'] == original_id)
+    assert([label['label'] for label in resp.json['labels']] == ['Dog'])
+    assert(detector.calls == 1)
+
+    _post_image(client, 'images/whale.jpeg', 'whale.jpeg')
+    resp = client.get(f'/images/{original_id}/similar')
+    assert(resp.status_code == 200)
+    assert(len(resp.json['images']) == 1)
+    assert(resp.json['images'][0]['filename'] == 'small_dog.jpeg')
+    assert(resp.json['images'][0]['distance'] <= 4)
+
+    assert(client.get('/images/missing/similar').status_code == 404)
+    assert(client.get(f'/images/{original_id}/similar?limit=-1').status_code == 400)
+    assert(client.get(f'/images/{original_id}/similar?limit=100000').status_code == 400)
+
+def test_post_image_rejects_non_image_content(setup_client):
+    client = setup_client
+    resp = client.post('/images', data={
+        'image': (io.BytesIO(b'#!/bin/sh\necho hi'), 'script.jpeg'),
+        'filename': 'script.jpeg',
+        'enable_detection': 'False',
+    })
+    assert(resp.status_code == 400)
+
+def test_post_image_normalizes_content(setup_client, monkeypatch):
+    client = setup_client
+    detector = _use_detector(client, RecordingDetector())
+    monkeypatch.setitem(client.application.config, 'INGEST_FORMAT', 'webp')
+    monkeypatch.setitem(client.application.config, 'INGEST_MAX_DIMENSION', 800)
+
+    with open('images/whale.jpeg', 'rb') as f:
+        resp = client.post('/images', data={'image': (f, 'whale.jpeg'), 'filename': 'whale.jpeg'})
+
+    assert(resp.status_code == 200)
+    assert(resp.json['ingest']['bytes_saved'] > 0)
+
+    image = client.get(f"/images/{resp.json['id']}").json['images'][0]
+    assert(image['filetype'] == 'webp')
+
+    stored = client.get(f"/images/{resp.json['id']}/content")
+    assert(stored.mimetype == 'image/webp')
+    assert(len(stored.data) == resp.json['ingest']['stored_bytes'])
+
+    # detectors get the downscaled copy
+    assert(max(Image.open(io.BytesIO(detector.contents[0])).size) == 640)
+    assert(len(detector.contents[0]) == resp.json['ingest']['detection_bytes'])
+
+def test_get_image_thumbnail(setup_client):
+    client = setup_client
+    image_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+
+    resp = client.get(f'/images/{image_id}/thumbnail?size=128')
+    assert(resp.status_code == 200)
+    assert(resp.mimetype == 'image/jpeg')
+    assert(max(Image.open(io.BytesIO(resp.data)).size) == 128)
+    assert(resp.headers['Cache-Control'] == 'public, max-age=3600')
+
+    etag = resp.headers['ETag']
+    resp = client.get(f'/images/{image_id}/thumbnail?size=128', headers={'If-None-Match': etag})
+    assert(resp.status_code == 304)
+
+    assert(client.get(f'/images/{image_id}/thumbnail?size=100').status_code == 400)
+    assert(client.get('/images/missing/thumbnail').status_code == 404)
+    assert(client.get('/cache').json['thumbnails']['generated'] == 1)
+
+def test_get_image_thumbnail_without_pillow(setup_client, monkeypatch):
+    from object_detector_backend.data import thumbnails
+
+    client = setup_client
+    image_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+    monkeypatch.setattr(thumbnails, 'Image', None)
+
+    resp = client.get(f'/images/{image_id}/thumbnail?size=128')
+    assert(resp.status_code == 503)
+    assert(resp.json['message'] == 'Thumbnails require pillow to be installed')
+
+def test_post_image_generates_thumbnails_eagerly(setup_client, monkeypatch):
+    client = setup_client
+    monkeypatch.setitem(client.application.config, 'THUMBNAIL_EAGER_SIZES', [64, 256])
+    image_id = _post_image(client, 'images/whale.jpeg', 'whale.jpeg')
+
+    assert(client.get('/cache').json['thumbnails']['generated'] == 2)
+    resp = client.get(f'/images/{image_id}/thumbnail?size=256')
+    assert(max(Image.open(io.BytesIO(resp.data)).size) == 256)
+    assert(client.get('/cache').json['thumbnails']['generated'] == 2)
+
+def test_get_images_responses_are_cached_until_written(setup_client):
+    client = setup_client
+    image_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+
+    first = client.get('/images?limit=10')
+    second = client.get('/images?limit=10')
+    assert(second.json == first.json)
+    assert(client.get('/cache').json['responses']['hits'] == 1)
+
+    # unchanged collection revalidates without a body
+    resp = client.get('/images?limit=10', headers={'If-None-Match': first.headers['ETag']})
+    assert(resp.status_code == 304)
+
+    client.get(f'/images/{image_id}')
+    _post_image(client, 'images/cat.jpeg', 'cat.jpeg')
+    resp = client.get('/images?limit=10', headers={'If-None-Match': first.headers['ETag']})
+    assert(resp.status_code == 200)
+    assert(len(resp.json['images']) == 2)
+
+    # a label written to the image drops its cached response
+    with client.application.app_context():
+        from object_detector_backend.blueprints.extensions import get_db_api
+        get_db_api().add_label(LabelModel(id='1', label='Dog', image_id=image_id, source='User'))
+
+    assert(client.get(f'/images/{image_id}').json['images'][0]['label'][0]['label'] == 'Dog')
+    assert(client.get('/images?objects=dog').json['images'][0]['id'] == image_id)
+
+def test_get_image_response_built_during_a_write_is_not_served(setup_client, monkeypatch):
+    from object_detector_backend.blueprints import images
+    from object_detector_backend.blueprints.extensions import get_db_api
+
+    client = setup_client
+    image_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+    find_image = images._find_image
+
+    def find_image_then_write(db_api, image_id):
+        # a label is committed after the response was built, before it is cached
+        found = find_image(db_api, image_id)
+        get_db_api().add_label(LabelModel(id='1', label='Dog', image_id=image_id, source='User'))
+        return found
+
+    monkeypatch.setattr(images, '_find_image', find_image_then_write)
+    assert(client.get(f'/images/{image_id}').json['images'][0]['label'] == [])
+    monkeypatch.setattr(images, '_find_image', find_image)
+
+    assert(client.get(f'/images/{image_id}').json['images'][0]['label'][0]['label'] == 'Dog')
+
+def test_get_images_revalidates_without_response_cache(setup_client, monkeypatch):
+    client = setup_client
+    monkeypatch.setattr(client.application.extensions['database'], 'response_cache', None)
+    _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+
+    first = client.get('/images?limit=10')
+    resp = client.get('/images?limit=10', headers={'If-None-Match': first.headers['ETag']})
+    assert(resp.status_code == 304)
+    assert(client.get('/labels', headers={'If-None-Match': client.get('/labels').headers['ETag']}).status_code == 304)
+
+    _post_image(client, 'images/cat.jpeg', 'cat.jpeg')
+    resp = client.get('/images?limit=10', headers={'If-None-Match': first.headers['ETag']})
+    assert(resp.status_code == 200)
+    assert(len(resp.json['images']) == 2)
+
+def test_get_image_responses_of_other_images_stay_cached(setup_client):
+    client = setup_client
+    dog_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+    cat_id = _post_image(client, 'images/cat.jpeg', 'cat.jpeg')
+    client.get(f'/images/{dog_id}')
+    client.get(f'/images/{cat_id}')
+
+    with client.application.app_context():
+        from object_detector_backend.blueprints.extensions import get_db_api
+        get_db_api().add_label(LabelModel(id='1', label='Dog', image_id=dog_id, source='User'))
+
+    hits = client.get('/cache').json['responses']['hits']
+    assert(client.get(f'/images/{cat_id}').json['images'][0]['id'] == cat_id)
+    assert(client.get(f'/images/{dog_id}').json['images'][0]['label'][0]['label'] == 'Dog')
+    assert(client.get('/cache').json['responses']['hits'] == hits + 1)
+
+def test_get_metrics(setup_client):
+    client = setup_client
+    _use_detector(client, FakeDetector())
+
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={'image': (f, 'dog.jpeg'), 'filename': 'dog.jpeg'})
+    assert(resp.status_code == 200)
+
+    # stages of the upload and its queries are reported per request
+    timing = resp.headers['Server-Timing']
+    for name in ('normalize', 'hash_and_store', 'db.add_image', 'detect', 'vision', 'db.add_labels', 'db', 'total'):
+        assert(f'{name};' in timing)
+
+    resp = client.get('/metrics')
+    assert(resp.status_code == 200)
+    assert(resp.mimetype == 'text/plain')
+    body = resp.get_data(as_text=True)
+    assert('http_requests_total{endpoint="image.post_images",method="POST",status="200"}' in body)
+    assert('stage_duration_seconds_count{stage="detect"}' in body)
+    assert('db_queries_total{operation="insert"}' in body)
+    assert('blob_bytes_total{direction="written"}' in body)
+    assert('vision_call_duration_seconds_count{method="annotate",source="Google Vision"}' in body)
+    assert('db_pool_connections{state="checked_out"}' in body)
+    assert('cache_requests_total{cache="annotations",result="miss"}' in body)
+
+def test_failed_vision_calls_are_counted(setup_client):
+    from object_detector_backend.util.metrics import metrics
+
+    client = setup_client
+    _use_detector(client, FakeDetector(fail=True))
+    before = metrics.value('vision_errors_total', source='Google Vision', method='annotate')
+
+    with open('images/dog.jpeg', 'rb') as f:
+        resp = client.post('/images', data={'image': (f, 'dog.jpeg'), 'filename': 'dog.jpeg'})
+    assert(resp.status_code == 500)
+    assert(metrics.value('vision_errors_total', source='Google Vision', method='annotate') == before + 1)
+
+def test_slow_requests_are_profiled(setup_client, tmp_path, monkeypatch):
+    client = setup_client
+    monkeypatch.setitem(client.application.config, 'PROFILE_REQUESTS', True)
+    monkeypatch.setitem(client.application.config, 'PROFILE_MIN_SECONDS', 0)
+    monkeypatch.setitem(client.application.config, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+
+    resp = client.get('/images')
+    assert(resp.status_code == 200)
+
+    profiles = list((tmp_path / 'profiles').iterdir())
+    assert(len(profiles) == 1)
+    assert(profiles[0].name.endswith('.prof'))
+    assert('image.get_images' in profiles[0].name)
+
+def test_export_images_as_ndjson(setup_client):
+    import gzip
+    import json
+
+    client = setup_client
+    _use_detector(client, FakeDetector())
+    dog_id = _post_image(client, 'images/dog.jpeg', 'dog.jpeg')
+    with open('images/cat.jpeg', 'rb') as f:
+        client.post('/images', data={'image': (f, 'cat.jpeg'), 'filename': 'cat.jpeg', 'label': 'Cat'})
+
+    resp = client.get('/images/export')
+    assert(resp.status_code == 200)
+    assert(resp.mimetype == 'application/x-ndjson')
+    lines = [json.loads(line) for line in resp.get_data().splitlines()]
+    assert([image['filename'] for image in lines] == ['dog.jpeg', 'cat.jpeg'])
+    assert(lines[0]['id'] == dog_id)
+    assert(sorted(label['label'] for label in lines[1]['label']) == ['Cat', 'Dog'])
+
+    resp = client.get('/images/export?objects=cat&gzip=true')
+    assert(resp.headers['Content-Encoding'] == 'gzip')
+    lines = gzip.decompress(resp.get_data()).splitlines()
+    assert([json.loads(line)['filename'] for line in lines] == ['cat.jpeg'])
+
+    assert(client.get('/images/export?objects=cat&match=some').status_code == 400)
+
+def test_get_label_facets(setup_client):
+    client = setup_client
+    _use_detector(client, FakeDetector())
+    for filename in ('dog.jpeg', 'cat.jpeg'):
+        with open(f'images/{filename}', 'rb') as f:
+            client.post('/images', data={'image': (f, filename), 'filename': filename, 'label': 'Pet'})
+
+    resp = client.get('/labels')
+    assert(resp.status_code == 200)
+    assert([(f['label'], f['count']) for f in resp.json['labels']] == [('Dog', 2), ('Pet', 2)])
+    assert(resp.json['labels'][0]['sources'] == {'Google Vision': {'count': 2, 'mean_score': 0.9}})
+
+    # facets are cached until labels change
+    with open('images/whale.jpeg', 'rb') as f:
+        client.post('/images', data={'image': (f, 'whale.jpeg'), 'filename': 'whale.jpeg', 'enable_detection': 'False', 'label': 'Whale'})
+    assert([f['label'] for f in client.get('/labels').json['labels']] == ['Dog', 'Pet', 'Whale'])
+    assert(client.get('/labels?prefix=wh').json['labels'][0]['count'] == 1)
+    assert(client.get('/labels?source=User&order_by=label').json['labels'][0]['label'] == 'Pet')
+
+    assert(client.get('/labels?order_by=size').status_code == 400)
+    assert(client.get('/labels?limit=0').status_code == 400)
@@ -0,0 +1,61 @@
+import io
+
+from PIL import Image
+
+from object_detector_backend.data.ingest import ImageNormalizer, sniff_image_type
+from object_detector_backend.util.exceptions import InvalidInputException, PayloadTooLargeException
+
+def _open(path: str) -> io.BytesIO:
+    with open(path, 'rb') as f:
+        return io.BytesIO(f.read())
+
+def test_sniff_image_type():
+    assert(sniff_image_type(b'\xff\xd8\xff\xe0\x00\x10JFIF') == 'jpeg')
+    assert(sniff_image_type(b'\x89PNG\r\n\x1a\n\x00\x00') == 'png')
+    assert(sniff_image_type(b'RIFF\x10\x00\x00\x00WEBPVP8 ') == 'webp')
+    assert(sniff_image_type(b'GIF89a') == 'gif')
+    assert(sniff_image_type(b'<html></html>') is None)
+
+def test_normalize_rejects_non_images():
+    try:
+        ImageNormalizer().normalize(io.BytesIO(b'#!/bin/sh\necho hi'))
+        assert(False)
+    except InvalidInputException:
+        pass
+
+    try:
+        ImageNormalizer(max_bytes=1000).normalize(_open('images/dog.jpeg'))
+        assert(False)
+    except PayloadTooLargeException:
+        pass
+
+def test_normalize_keeps_content_by_default():
+    stream = _open('images/dog.jpeg')
+    normalized = ImageNormalizer().normalize(stream)
+
+    assert(normalized.stream is stream)
+    assert(normalized.stream.tell() == 0)
+    assert(normalized.filetype == 'jpeg')
+    assert(normalized.bytes_saved == 0)
+    assert(normalized.detection_content is None)
+
+def test_normalize_reencodes_and_makes_detection_copy():
+    normalized = ImageNormalizer(format='webp', quality=75, max_dimension=800, detection_size=320) \
+        .normalize(_open('images/whale.jpeg'))
+
+    assert(normalized.filetype == 'webp')
+    assert(normalized.original_bytes == 190480)
+    assert(normalized.bytes_saved > 0)
+    assert(normalized.to_dict()['bytes_saved'] == normalized.original_bytes - normalized.stored_bytes)
+
+    stored = Image.open(normalized.stream)
+    assert(stored.format == 'WEBP')
+    assert(max(stored.size) == 800)
+
+    detection = Image.open(io.BytesIO(normalized.detection_content))
+    assert(max(detection.size) == 320)
+    assert(normalized.to_dict()['detection_bytes'] < normalized.stored_bytes)
+
+def test_normalize_skips_detection_copy_of_small_images():
+    normalized = ImageNormalizer(detection_size=640).normalize(_open('images/cat.jpeg'))
+    assert(normalized.detection_content is None)
@@ -0,0 +1,93 @@
+import pytest
+
+from object_detector_backend.util.metrics import Metrics, current_trace, end_trace, metrics, stage, start_trace
+
+def test_metrics_render_prometheus_text():
+    registry = Metrics(buckets=(0.1, 1.0), descriptions={'requests_total': ('counter', 'Requests served')})
+    registry.inc('requests_total', endpoint='images')
+    registry.inc('requests_total', 2, endpoint='images')
+    registry.set('connections', 3, state='checked_out')
+    registry.observe('latency_seconds', 0.05, stage='fetch')
+    registry.observe('latency_seconds', 0.5, stage='fetch')
+    registry.observe('latency_seconds', 5, stage='fetch')
+
+    assert(registry.value('requests_total', endpoint='images') == 3)
+    assert(registry.count('latency_seconds', stage='fetch') == 3)
+
+    lines = registry.render().splitlines()
+    assert('# HELP requests_total Requests served' in lines)
+    assert('# TYPE requests_total counter' in lines)
+    assert('requests_total{endpoint="images"} 3' in lines)
+    assert('connections{state="checked_out"} 3' in lines)
+    assert('# TYPE latency_seconds histogram' in lines)
+    assert('latency_seconds_bucket{stage="fetch",le="0.1"} 1' in lines)
+    assert('latency_seconds_bucket{stage="fetch",le="1.0"} 2' in lines)
+    assert('latency_seconds_bucket{stage="fetch",le="+Inf"} 3' in lines)
+    assert('latency_seconds_sum{stage="fetch"} 5.55' in lines)
+    assert('latency_seconds_count{stage="fetch"} 3' in lines)
+
+def test_metrics_escape_label_values():
+    registry = Metrics()
+    registry.inc('errors_total', message='say "hi"\n')
+    assert('errors_total{message="say \\"hi\\"\\n"} 1' in registry.render())
+
+def test_stage_records_trace_and_errors():
+    assert(current_trace() is None)
+    before = metrics.count('stage_duration_seconds', stage='test')
+
+    token = start_trace()
+    with stage('test'):
+        pass
+
+    @stage('test')
+    def fail():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        fail()
+
+    trace = current_trace()
+    end_trace(token)
+
+    assert(current_trace() is None)
+    assert(metrics.count('stage_duration_seconds', stage='test') == before + 2)
+    assert(list(trace.stages) == ['test'])
+    assert(trace.server_timing().startswith('test;dur='))
+
+def test_collect_sums_snapshots_of_workers(tmp_path):
+    registry = Metrics(buckets=(0.1, 1.0), descriptions={'connections': ('gauge', None)})
+    registry.inc('requests_total', 2, endpoint='images')
+    registry.set('connections', 3, state='checked_out')
+    registry.observe('latency_seconds', 0.5)
+
+    other = Metrics(buckets=(0.1, 1.0), descriptions={'connections': ('gauge', None)})
+    other.inc('requests_total', endpoint='images')
+    other.merge(registry.snapshot())
+    other.merge(registry.snapshot(), gauge_labels={'pid': 7})
+
+    assert(other.value('requests_total', endpoint='images') == 5)
+    assert(other.count('latency_seconds') == 2)
+    # gauges are not summed, only kept per worker
+    assert(other.value('connections', state='checked_out') == 0)
+    assert(other.value('connections', state='checked_out', pid=7) == 3)
+
+def test_metrics_endpoint_reports_all_workers(setup_client, tmp_path, monkeypatch):
+    import json
+    import os
+
+    client = setup_client
+    monkeypatch.setitem(client.application.config, 'METRICS_DIR', str(tmp_path))
+    before = metrics.value('http_requests_total', method='GET', endpoint='image.get_images', status=200)
+
+    # snapshot of a worker which has exited
+    exited = Metrics()
+    exited.inc('http_requests_total', 5, method='GET', endpoint='image.get_images', status=200)
+    exited.set('db_pool_connections', 9, state='checked_out')
+    (tmp_path / 'metrics-999999999.json').write_text(json.dumps(exited.snapshot()))
+
+    assert(client.get('/images').status_code == 200)
+    lines = client.get('/metrics').data.decode().splitlines()
+    assert((tmp_path / f'metrics-{os.getpid()}.json').exists())
+    assert(f'http_requests_total{{endpoint="image.get_images",method="GET",status="200"}} {before + 6}' in lines)
+    assert(not(any(line.startswith('db_pool_connections') and '999999999' in line for line in lines)))
+    assert(any(line.startswith('db_pool_connections') and f'pid="{os.getpid()}"' in line for line in lines))
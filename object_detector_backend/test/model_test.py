@@ -1,13 +1,14 @@
-from object_detector_backend.data.models import LabelModel, ImageModel
+import hashlib
 
-def test_image_model_creation_with_url():
-    image = ImageModel(id='test12345',
-                       filename='whale.jpeg',
-                       url="https://files.worldwildlife.org/wwfcmsprod/images/African_Elephant_Kenya_112367/story_full_width/qxyqxqjtu_WW187785.jpg")
+from object_detector_backend.data.models import LabelModel, ImageModel
+from object_detector_backend.util.exceptions import InvalidInputException
 
-    assert(image.checksum)
-    assert(image.content)
-    assert(image.filetype == 'jpg')
+def test_image_model_does_not_fetch_url():
+    try:
+        ImageModel(id='test12345', url='http://127.0.0.1:1/whale.jpeg')
+        assert(False)
+    except Exception as e:
+        assert(str(e) == 'Image model should have file content')
 
 def test_image_model_creation_with_content():
     with open('images/dog.jpeg', 'rb') as f:
@@ -27,4 +28,14 @@ def test_create_image_without_content():
 
         assert(False)
     except Exception:
-        pass
\ No newline at end of file
+        pass
+
+def test_image_model_hash_algorithm():
+    image = ImageModel(id='test12345', filename='a.jpeg', content=b'1234', hash_algorithm='blake2b')
+    assert(image.checksum == hashlib.blake2b(b'1234', digest_size=16).hexdigest())
+
+    try:
+        ImageModel(id='test12345', filename='a.jpeg', content=b'1234', hash_algorithm='crc32')
+        assert(False)
+    except InvalidInputException:
+        pass
@@ -1,7 +1,10 @@
+import re
 import uuid
+from sqlalchemy import inspect, text
 
-from object_detector_backend.data.persistence import Labels, Images
+from object_detector_backend.data.persistence import DatabaseAPI, Labels, Images, upgrade_schema
 from object_detector_backend.data.models import LabelModel, ImageModel
+from object_detector_backend.util.exceptions import InvalidInputException
 
 def test_get_images(setup_database):
     """Tests posting an image and retrieving it
@@ -144,4 +147,372 @@ def test_get_images_by_label(setup_database):
 
     images = db.get_images_by_label(labels=['cat', 'dog'])
     assert(len(images) == 2)
-    
\ No newline at end of file
+    
+def test_database_api_shares_pool(setup_database):
+    """DatabaseAPI instances created from one Database reuse its engine and session
+    """
+    db = setup_database
+    other = db.database.api()
+    assert(other.engine is db.engine)
+    assert(other.session is db.session)
+
+    db.get_images()
+    status = db.database.pool_status()
+    assert(status['checked_out'] == 1)
+    assert(status['overflow'] == 0)
+    assert(status['wait_count'] >= 1)
+
+    db.database.remove_session()
+    assert(db.database.pool_status()['checked_out'] == 0)
+
+def _add_labeled_images(db, count: int):
+    for i in range(count):
+        image_id = str(uuid.uuid1())
+        db.session.add(Images(id=image_id,
+                              filename=f'image_{i}',
+                              content=b'1234',
+                              checksum=image_id.replace("-", "")))
+        for label in ('animal', 'dog'):
+            db.session.add(Labels(id=str(uuid.uuid1()),
+                                  label=label,
+                                  score=0.5,
+                                  topicality=0.5,
+                                  image_id=image_id))
+    db.session.commit()
+
+def test_get_images_query_count_is_constant(setup_database, query_counter):
+    """get_images should not issue a label query per image
+    """
+    db = setup_database
+
+    _add_labeled_images(db, 5)
+    query_counter.clear()
+    images = db.get_images()
+    small_count = len(query_counter)
+    assert(len(images) == 5)
+    assert(all(len(image['label']) == 2 for image in images))
+
+    _add_labeled_images(db, 200)
+    query_counter.clear()
+    images = db.get_images()
+    assert(len(images) == 205)
+    assert(len(query_counter) == small_count)
+    assert(small_count <= 2)
+
+def test_get_images_page(setup_database):
+    """Walks all images with keyset pagination without repeating or skipping rows
+    """
+    db = setup_database
+    _add_labeled_images(db, 25)
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        images, cursor = db.get_images_page(limit=10, cursor=cursor)
+        seen.extend(image['id'] for image in images)
+        pages += 1
+        if cursor is None:
+            break
+
+    assert(pages == 3)
+    assert(len(seen) == 25)
+    assert(len(set(seen)) == 25)
+    assert(seen == [image['id'] for image in db.get_images_page(limit=25)[0]])
+
+def test_get_images_page_fields(setup_database):
+    db = setup_database
+    _add_labeled_images(db, 3)
+
+    images, cursor = db.get_images_page(limit=10, fields=['id', 'label'])
+    assert(cursor is None)
+    assert(set(images[0].keys()) == {'id', 'label'})
+    assert(len(images[0]['label']) == 2)
+
+    try:
+        db.get_images_page(limit=10, fields=['content'])
+        assert(False)
+    except InvalidInputException:
+        pass
+
+def test_listing_does_not_load_content(setup_database, query_counter):
+    db = setup_database
+    _add_labeled_images(db, 1)
+    image_id = db.get_images()[0]['id']
+
+    query_counter.clear()
+    db.get_images_page(limit=10)
+    assert(not any(re.search(r'images\.content\b', statement) for statement in query_counter))
+
+    assert(db.fetch_image_content_by_id(image_id) == b'1234')
+
+def test_add_image_stores_content_in_blob_store(setup_database):
+    db = setup_database
+
+    with open('images/whale.jpeg', 'rb') as image_file:
+        content = image_file.read()
+
+    whale = db.add_image(ImageModel(id=str(uuid.uuid1()), filename='whale.jpeg', content=content))
+    cat = db.add_image(ImageModel(id=str(uuid.uuid1()), filename='cat.jpeg', content=content))
+
+    # both rows point at a single stored copy of the bytes
+    assert(db.blob_store.exists(whale['check_sum']))
+    assert(db.session.query(Images.content).filter(Images.content.isnot(None)).count() == 0)
+    assert(db.fetch_image_content_by_id(whale['id']) == content)
+    assert(db.fetch_image_content_by_id(cat['id']) == content)
+
+def test_migrate_content_to_blob_store(setup_database):
+    db = setup_database
+    _add_labeled_images(db, 3)
+    image_id = db.get_images()[0]['id']
+
+    assert(db.migrate_content_to_blob_store(batch_size=2) == 3)
+    assert(db.migrate_content_to_blob_store() == 0)
+    assert(db.session.query(Images.content).filter(Images.content.isnot(None)).count() == 0)
+    assert(db.fetch_image_content_by_id(image_id) == b'1234')
+
+def _add_image_with_labels(db, filename: str, labels: dict) -> str:
+    image_id = str(uuid.uuid1())
+    db.session.add(Images(id=image_id, filename=filename, checksum=filename))
+    for label, score in labels.items():
+        db.session.add(Labels(id=str(uuid.uuid1()),
+                              label=label,
+                              score=score,
+                              topicality=score,
+                              image_id=image_id))
+    db.session.commit()
+    return image_id
+
+def test_get_images_by_label_match_and_order(setup_database, query_counter):
+    db = setup_database
+    dog_id = _add_image_with_labels(db, 'dog', {'Dog': 0.9, 'Animal': 0.6})
+    cat_id = _add_image_with_labels(db, 'cat', {'Cat': 0.8, 'Animal': 0.95})
+    _add_image_with_labels(db, 'car', {'Car': 0.99})
+
+    query_counter.clear()
+    images = db.get_images_by_label(labels=['ANIMAL '], order_by='score')
+    assert([image['id'] for image in images] == [cat_id, dog_id])
+    assert(len(query_counter) == 1)
+
+    images = db.get_images_by_label(labels=['dog', 'animal'], match='all')
+    assert([image['id'] for image in images] == [dog_id])
+
+    images = db.get_images_by_label(labels=['animal'], min_score=0.9)
+    assert([image['id'] for image in images] == [cat_id])
+
+    try:
+        db.get_images_by_label(labels=['animal'], match='some')
+        assert(False)
+    except InvalidInputException:
+        pass
+
+def test_add_labels_bulk(setup_database, query_counter):
+    db = setup_database
+    image_id = _add_image_with_labels(db, 'dog', {'dog': 0.9})
+
+    labels = [LabelModel(id=str(uuid.uuid1()),
+                         label=f'label_{i}',
+                         score=0.5,
+                         topicality=0.5,
+                         image_id=image_id,
+                         source=None) for i in range(20)]
+    # duplicates of a stored label and within the batch are skipped
+    labels.append(LabelModel(id=str(uuid.uuid1()), label='dog', image_id=image_id, source=None))
+    labels.append(LabelModel(id=str(uuid.uuid1()), label='label_0', image_id=image_id, source=None))
+
+    query_counter.clear()
+    stored = db.add_labels(labels)
+    inserts = [s for s in query_counter if s.startswith('INSERT INTO labels ')]
+    assert(len(inserts) == 1)
+    # plus one upsert of label statistics
+    assert(len([s for s in query_counter if s.startswith('INSERT INTO label_stats')]) == 1)
+    assert(len(query_counter) <= 4)
+
+    assert(len(stored) == 22)
+    assert(stored[-1]['id'] == stored[0]['id'])
+    assert(stored[-2]['score'] == 0.9)
+    assert(len(db.get_labels_by_image_id(image_id)) == 21)
+    assert(len(db.get_images_by_label(['LABEL_19'])) == 1)
+
+def test_labels_without_source_are_unique(setup_database):
+    db = setup_database
+    image_id = _add_image_with_labels(db, 'dog', {})
+
+    # the insert skips labels stored concurrently, also when they have no source
+    rows = [{'id': str(uuid.uuid1()), 'label': 'Dog', 'label_normalized': 'dog', 'image_id': image_id, 'source': source}
+            for source in (None, None, 'User', 'User')]
+    for row in rows:
+        db.session.execute(db._insert_ignoring_duplicates(Labels), [row])
+    db.session.commit()
+
+    assert(sorted(label['source'] or '' for label in db.get_labels_by_image_id(image_id)) == ['', 'User'])
+
+def test_upgrade_schema_dedupes_labels_before_unique_index(setup_database):
+    db = setup_database
+    image_id = _add_image_with_labels(db, 'dog', {})
+
+    # a database written before the unique index existed
+    with db.engine.begin() as conn:
+        conn.execute(text('DROP INDEX uq_labels_image_id_label_coalesced_source'))
+        conn.execute(Labels.__table__.insert(), [
+            {'id': str(i), 'label': 'Dog', 'label_normalized': 'dog', 'image_id': image_id, 'source': source}
+            for i, source in enumerate((None, None, 'User', 'User', 'Google Vision'))])
+        conn.execute(text('CREATE INDEX uq_labels_image_id_label_source ON labels (image_id, label, source)'))
+
+    changes = upgrade_schema(db.engine)
+    assert('dropped index uq_labels_image_id_label_source' in changes)
+    assert('deleted 2 duplicate labels' in changes)
+    assert('created index uq_labels_image_id_label_coalesced_source' in changes)
+    assert(len(db.get_labels_by_image_id(image_id)) == 3)
+
+    assert(upgrade_schema(db.engine) == [])
+
+def test_add_image_dedupes_with_one_lookup(setup_database, query_counter):
+    db = setup_database
+    image = db.add_image(ImageModel(id='1', filename='a.jpeg', content=b'1234'))
+
+    query_counter.clear()
+    duplicate = db.add_image(ImageModel(id='2', filename='a.jpeg', content=b'1234'))
+    assert(duplicate['id'] == image['id'])
+    assert(len([s for s in query_counter if s.lstrip().upper().startswith('SELECT')]) == 1)
+    assert(any('images.checksum' in s for s in query_counter))
+
+def test_add_image_shares_content_across_filenames(setup_database):
+    db = setup_database
+    first = db.add_image(ImageModel(id='1', filename='a.jpeg', content=b'1234'))
+    db.blob_store.put = None # content must not be stored again
+
+    second = db.add_image(ImageModel(id='2', filename='b.jpeg', content=b'1234'))
+    assert(second['id'] != first['id'])
+    assert(second['check_sum'] == first['check_sum'])
+    assert(db.fetch_image_content_by_id('2') == b'1234')
+
+def test_checksum_index_is_unique_per_filename(setup_database):
+    db = setup_database
+    indexes = {i['name']: i for i in inspect(db.engine).get_indexes('images')}
+    assert(indexes['uq_images_checksum_filename']['unique'])
+    assert(indexes['uq_images_checksum_filename']['column_names'] == ['checksum', 'filename'])
+
+def test_add_images_in_one_transaction(setup_database, query_counter):
+    db = setup_database
+    with open('images/dog.jpeg', 'rb') as f:
+        content = f.read()
+    stored = db.add_image(ImageModel(id='1', filename='dog.jpeg', content=content))
+
+    images = [
+        ImageModel(id='2', filename='dog.jpeg', content=content),
+        ImageModel(id='3', filename='puppy.jpeg', content=content),
+        ImageModel(id='4', filename='other.jpeg', content=b'other'),
+        ImageModel(id='5', filename='other.jpeg', content=b'other'),
+    ]
+    query_counter.clear()
+    added = db.add_images(images)
+
+    assert([image['id'] for image in added] == [stored['id'], '3', '4', '4'])
+    assert(len([s for s in query_counter if s.lstrip().upper().startswith('INSERT')]) == 1)
+    assert(db.get_images(id='3')[0]['check_sum'] == stored['check_sum'])
+    assert(db.add_images([]) == [])
+
+def test_iter_images_streams_in_batches(setup_database, query_counter):
+    db = setup_database
+    _add_labeled_images(db, 25)
+    db.add_label(LabelModel(id='cat', label='Cat', image_id=db.get_images_page(limit=1)[0][0]['id'], source='User'))
+
+    query_counter.clear()
+    images = list(db.iter_images(batch_size=10))
+    assert(len(images) == 25)
+    assert(all(len(image['label']) >= 2 for image in images))
+    # one images query and a label query per batch
+    assert(len(query_counter) == 4)
+
+    page, _ = db.get_images_page(limit=25)
+    assert([image['id'] for image in images] == [image['id'] for image in page])
+
+    assert(len(list(db.iter_images(labels=['CAT', 'dog'], match='any'))) == 25)
+    matched = list(db.iter_images(labels=['cat', 'dog'], match='all'))
+    assert(len(matched) == 1)
+    assert(len(matched[0]['label']) == 3)
+    assert(list(db.iter_images(labels=['dog'], min_score=0.9)) == [])
+
+    try:
+        db.iter_images(labels=['dog'], match='some')
+        assert(False)
+    except InvalidInputException:
+        pass
+
+def test_label_facets_are_maintained_by_add_labels(setup_database, query_counter):
+    db = setup_database
+    dog = _add_image_with_labels(db, 'dog', {})
+    cat = _add_image_with_labels(db, 'cat', {})
+    db.add_labels([
+        LabelModel(id=str(uuid.uuid1()), label=label, score=score, image_id=image_id, source='Google Vision')
+        for image_id, label, score in ((dog, 'Dog', 0.9), (dog, 'Animal', 0.8), (cat, 'Cat', 0.7), (cat, 'Animal', 0.6))
+    ])
+    db.add_labels([
+        LabelModel(id=str(uuid.uuid1()), label='dog', image_id=dog, source='User'),
+        LabelModel(id=str(uuid.uuid1()), label='Animal', score=1.0, image_id=cat, source='Aggregated'),
+    ])
+    # stored labels do not count again
+    db.add_label(LabelModel(id=str(uuid.uuid1()), label='dog', image_id=dog, source='User'))
+
+    query_counter.clear()
+    facets = db.get_label_facets()
+    # facets and their per source breakdown are two reads of the statistics table
+    assert(len(query_counter) == 2)
+    assert([(f['label'], f['count']) for f in facets] == [('Animal', 2), ('Cat', 1), ('Dog', 1)])
+    assert(abs(facets[0]['mean_score'] - 0.8) < 1e-9)
+    assert(set(facets[0]['sources']) == {'Google Vision', 'Aggregated'})
+    assert(facets[0]['sources']['Aggregated'] == {'count': 1, 'mean_score': 1.0})
+    assert(facets[2]['sources']['User'] == {'count': 1, 'mean_score': None})
+
+    assert([f['label'] for f in db.get_label_facets(source='User')] == ['dog'])
+    assert([f['label'] for f in db.get_label_facets(prefix='C')] == ['Cat'])
+    assert([f['label'] for f in db.get_label_facets(prefix='%')] == [])
+    assert([f['label'] for f in db.get_label_facets(order_by='score')] == ['Dog', 'Animal', 'Cat'])
+    assert([f['label'] for f in db.get_label_facets(order_by='label', limit=2)] == ['Animal', 'Cat'])
+
+    # a rebuild from the labels table arrives at the same statistics
+    before = db.get_label_facets()
+    assert(db.rebuild_label_stats() == 8)
+    assert(db.get_label_facets() == before)
+
+    try:
+        db.get_label_facets(order_by='size')
+        assert(False)
+    except InvalidInputException:
+        pass
+
+def test_label_facets_skip_labels_raced_by_concurrent_writer(setup_database):
+    db = setup_database
+    image_id = _add_image_with_labels(db, 'dog', {})
+    concurrent = DatabaseAPI(conn_str=str(db.engine.url), blob_store=db.blob_store)
+    insert = db._insert_ignoring_duplicates
+
+    def insert_after_concurrent_writer(table_class):
+        # another worker stores labels between the duplicate lookup and the insert
+        concurrent.add_labels([
+            LabelModel(id=str(uuid.uuid1()), label='Dog', score=0.5, image_id=image_id, source='Google Vision'),
+            LabelModel(id=str(uuid.uuid1()), label='Animal', score=1.0, image_id=image_id, source='Aggregated'),
+        ])
+        return insert(table_class)
+
+    db._insert_ignoring_duplicates = insert_after_concurrent_writer
+    stored = db.add_labels([
+        LabelModel(id=str(uuid.uuid1()), label='Dog', score=0.9, image_id=image_id, source='Google Vision'),
+        LabelModel(id=str(uuid.uuid1()), label='Animal', score=0.8, image_id=image_id, source='Google Vision'),
+    ])
+    concurrent.database.dispose()
+
+    # the label stored by the concurrent writer is returned instead of the skipped one
+    assert(stored[0]['score'] == 0.5)
+    assert(len(db.get_labels_by_image_id(image_id)) == 3)
+
+    # the image is counted once per label and the skipped label is not counted at all
+    facets = db.get_label_facets()
+    assert([(f['label'], f['count']) for f in facets] == [('Animal', 1), ('Dog', 1)])
+    assert(facets[0]['sources'] == {'Aggregated': {'count': 1, 'mean_score': 1.0},
+                                    'Google Vision': {'count': 1, 'mean_score': 0.8}})
+    assert(facets[1]['mean_score'] == 0.5)
+
+    db.rebuild_label_stats()
+    assert(db.get_label_facets() == facets)
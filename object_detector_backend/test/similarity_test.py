@@ -0,0 +1,80 @@
+import io
+import random
+from datetime import datetime, timedelta
+
+from PIL import Image
+
+from object_detector_backend.data.similarity import BKTree, SimilarityIndex, dhash, hamming_distance
+
+def _resized_copy(path: str, scale: float = 0.5, quality: int = 60) -> bytes:
+    image = Image.open(path)
+    image = image.resize((int(image.width * scale), int(image.height * scale)))
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+def test_dhash_of_resized_copy_is_near():
+    with open('images/dog.jpeg', 'rb') as f:
+        original = dhash(f.read())
+    copy = dhash(_resized_copy('images/dog.jpeg'))
+    other = dhash(open('images/whale.jpeg', 'rb').read())
+
+    assert(len(original) == 16)
+    assert(hamming_distance(int(original, 16), int(copy, 16)) <= 4)
+    assert(hamming_distance(int(original, 16), int(other, 16)) > 10)
+
+def test_dhash_of_non_image_is_none():
+    assert(dhash(b'not an image') is None)
+
+def test_bk_tree_search_matches_linear_scan():
+    rng = random.Random(0)
+    values = [rng.getrandbits(64) for _ in range(2000)]
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    assert(len(tree) == 2000)
+
+    query = values[10] ^ 0b1011 # three bits away from an indexed hash
+    expected = sorted((hamming_distance(query, value), i) for i, value in enumerate(values)
+                      if hamming_distance(query, value) <= 8)
+
+    assert(sorted(tree.search(query, 8)) == expected)
+    assert(tree.search(query, 3)[0] == (3, 10))
+
+class FakePhashes():
+    """get_phashes of DatabaseAPI over in-memory rows of (created_at, id, phash)
+    """
+    def __init__(self):
+        self.rows = []
+        self.reads = 0
+
+    def get_phashes(self, after=None, limit=1000):
+        self.reads += 1
+        rows = sorted(row for row in self.rows if row[2] is not None and (after is None or row[:2] > after))
+        return rows[:limit]
+
+def test_similarity_index_picks_up_late_and_backfilled_rows():
+    now = datetime.utcnow()
+    db_api = FakePhashes()
+    db_api.rows = [(now - timedelta(hours=1), 'old', None), (now, 'b', '00000000000000ff')]
+    index = SimilarityIndex(batch_size=1, lookback=60)
+    assert(index.refresh(db_api) == 1)
+
+    # without new rows a search reads a single row past the high-water mark
+    db_api.reads = 0
+    assert(index.search(db_api, '00000000000000ff', 1) == [(0, 'b')])
+    assert(db_api.reads == 1)
+
+    # committed late by another worker with an earlier created_at, found along with the next new row
+    db_api.rows.append((now - timedelta(seconds=5), 'a', '00000000000000fe'))
+    db_api.rows.append((now + timedelta(seconds=1), 'c', '0000000000000fff'))
+    assert(index.search(db_api, '00000000000000ff', 1) == [(0, 'b'), (1, 'a')])
+    assert(len(index.tree) == 3)
+    assert(index.refresh(db_api) == 0)
+
+    # backfilled hashes of old images are only found by a rescan
+    db_api.rows[0] = (now - timedelta(hours=1), 'old', '00000000000000ff')
+    assert(index.refresh(db_api) == 0)
+    assert(index.rescan(db_api) == 1)
+    assert(index.rescan(db_api) == 0)
+    assert(len(index.tree) == 4)
@@ -0,0 +1,37 @@
+import io
+
+from PIL import Image
+
+from object_detector_backend.data.blobs import MemoryBlobStore
+from object_detector_backend.data.thumbnails import ThumbnailCache, thumbnail_key
+from object_detector_backend.util.exceptions import InvalidInputException
+
+def test_thumbnail_cache_generates_once():
+    blob_store = MemoryBlobStore()
+    cache = ThumbnailCache(blob_store, sizes=[64, 128], max_entries=1)
+    opened = []
+
+    def open_source():
+        opened.append(1)
+        return open('images/dog.jpeg', 'rb')
+
+    thumbnail = cache.get('abc', 128, open_source)
+    assert(max(Image.open(io.BytesIO(thumbnail)).size) == 128)
+    assert(blob_store.exists(thumbnail_key('abc', 128)))
+
+    assert(cache.get('abc', 128, open_source) == thumbnail)
+    # evicted from memory, served from the blob store
+    cache.get('abc', 64, open_source)
+    assert(cache.get('abc', 128, open_source) == thumbnail)
+
+    assert(len(opened) == 2)
+    assert(cache.stats()['generated'] == 2)
+    assert(cache.stats()['hits'] == 2)
+
+def test_thumbnail_cache_rejects_unknown_sizes():
+    cache = ThumbnailCache(MemoryBlobStore(), sizes=[64])
+    try:
+        cache.get('abc', 100, lambda: open('images/dog.jpeg', 'rb'))
+        assert(False)
+    except InvalidInputException:
+        pass
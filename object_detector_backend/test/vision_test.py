@@ -1,6 +1,150 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from object_detector_backend.data.vision import BatchingAnnotator, Detector, DetectorRegistry, register_detector
+from object_detector_backend.util.exceptions import InvalidInputException
+
 def test_vision_annotate(setup_vision_client):
     vc = setup_vision_client
 
     with open('./images/whale.jpeg', 'rb') as f:
         resp = vc.annotate(content=f.read())
-        assert(len(resp))
\ No newline at end of file
+        assert(len(resp))
+
+class FakeBatchDetector():
+    source = 'Fake'
+    version = '1'
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def annotate_batch(self, contents: list) -> list:
+        self.batch_sizes.append(len(contents))
+        return [Exception('unreadable') if content == b'bad' else \
+            [{'label': content.decode(), 'score': 1.0, 'topicality': 1.0}]
+            for content in contents]
+
+def test_batching_annotator_coalesces_images():
+    detector = FakeBatchDetector()
+    annotator = BatchingAnnotator(detector, batch_size=4, max_wait=0.5)
+
+    futures = [annotator.submit(str(i).encode()) for i in range(10)]
+    labels = [future.result(timeout=5) for future in futures]
+    annotator.close()
+
+    assert([l[0]['label'] for l in labels] == [str(i) for i in range(10)])
+    assert(detector.batch_sizes == [4, 4, 2])
+
+def test_batching_annotator_concurrent_callers():
+    detector = FakeBatchDetector()
+    annotator = BatchingAnnotator(detector, batch_size=16, max_wait=0.2)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        labels = list(pool.map(annotator.annotate, [b'a'] * 8))
+    annotator.close()
+
+    assert(len(labels) == 8)
+    assert(sum(detector.batch_sizes) == 8)
+    assert(len(detector.batch_sizes) < 8)
+
+def test_batching_annotator_reports_image_errors():
+    annotator = BatchingAnnotator(FakeBatchDetector(), batch_size=2, max_wait=0.1)
+    good, bad = annotator.submit(b'good'), annotator.submit(b'bad')
+
+    assert(good.result(timeout=5)[0]['label'] == 'good')
+    assert(isinstance(bad.exception(timeout=5), Exception))
+    annotator.close()
+
+class ShortBatchDetector(FakeBatchDetector):
+    def annotate_batch(self, contents: list) -> list:
+        return super().annotate_batch(contents)[:-1]
+
+def test_batching_annotator_fails_images_missing_from_results():
+    annotator = BatchingAnnotator(ShortBatchDetector(), batch_size=2, max_wait=0.1)
+    futures = [annotator.submit(b'a'), annotator.submit(b'b')]
+
+    # callers get an error instead of waiting forever
+    for future in futures:
+        assert(isinstance(future.exception(timeout=5), Exception))
+    annotator.close()
+
+class FakeDetector(Detector):
+    source = 'Fake'
+    version = '1'
+    instances = 0
+
+    def __init__(self, label: str = 'thing'):
+        FakeDetector.instances += 1
+        self.label = label
+
+    def annotate(self, content) -> list:
+        return [{'label': self.label, 'score': 1.0, 'topicality': 1.0}]
+
+def test_detector_registry_creates_detectors_once():
+    register_detector('registry-fake', FakeDetector)
+    FakeDetector.instances = 0
+    registry = DetectorRegistry(options={'registry-fake': {'label': 'whale'}})
+
+    detector = registry.get('registry-fake')
+    assert(registry.get('registry-fake') is detector)
+    assert(FakeDetector.instances == 1)
+    assert(detector.annotate(b'1234')[0]['label'] == 'whale')
+
+    try:
+        registry.get('missing')
+        assert(False)
+    except InvalidInputException:
+        pass
+
+def _write_onnx_classifier(tmp_path, classes: int):
+    """writes a tiny classifier averaging each color channel followed by a dense layer
+    """
+    onnx = pytest.importorskip('onnx')
+    np = pytest.importorskip('numpy')
+    from onnx import helper, numpy_helper, TensorProto
+
+    weights = np.zeros((3, classes), dtype=np.float32)
+    weights[0, 0] = weights[1, 1] = weights[2, 2] = 10.0
+    graph = helper.make_graph(
+        [
+            helper.make_node('GlobalAveragePool', ['input'], ['pooled']),
+            helper.make_node('Flatten', ['pooled'], ['flat']),
+            helper.make_node('MatMul', ['flat', 'weights'], ['scores']),
+        ],
+        'classifier',
+        [helper.make_tensor_value_info('input', TensorProto.FLOAT, ['N', 3, 32, 32])],
+        [helper.make_tensor_value_info('scores', TensorProto.FLOAT, ['N', classes])],
+        [numpy_helper.from_array(weights, 'weights')])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+
+    model_path = tmp_path / 'model.onnx'
+    onnx.save(model, str(model_path))
+    labels_path = tmp_path / 'labels.txt'
+    labels_path.write_text('red\ngreen\nblue\n')
+    return str(model_path), str(labels_path)
+
+def test_onnx_detector(tmp_path):
+    pytest.importorskip('onnxruntime')
+    Image = pytest.importorskip('PIL.Image')
+    from object_detector_backend.data.local_vision import OnnxDetector
+
+    model_path, labels_path = _write_onnx_classifier(tmp_path, classes=3)
+    detector = OnnxDetector(model_path, labels_path, input_size=32,
+                            mean=(0, 0, 0), std=(1, 1, 1), top_k=2)
+    detector.warmup()
+
+    contents = []
+    for color in ((255, 0, 0), (0, 0, 255)):
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 48), color).save(buffer, format='PNG')
+        contents.append(buffer.getvalue())
+
+    red, blue = detector.annotate_batch(contents)
+    assert(red[0]['label'] == 'red')
+    assert(blue[0]['label'] == 'blue')
+    assert(len(red) <= 2)
+    assert(red[0]['score'] > 0.9)
+    assert(detector.annotate(contents[0]) == red)
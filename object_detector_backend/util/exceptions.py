@@ -4,4 +4,30 @@ class InvalidInputException(Exception):
     def __init__(self, message: str):
         self.status_code = 400
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+class NotFoundException(Exception):
+    """Requested resource does not exist
+    """
+    def __init__(self, message: str):
+        self.status_code = 404
+        self.message = message
+        super().__init__(self.message)
+
+
+class PayloadTooLargeException(Exception):
+    """Image is larger than the configured limit
+    """
+    def __init__(self, message: str):
+        self.status_code = 413
+        self.message = message
+        super().__init__(self.message)
+
+
+class UnavailableException(Exception):
+    """Feature needs an optional dependency which is not installed
+    """
+    def __init__(self, message: str):
+        self.status_code = 503
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,37 @@
+import hashlib
+from functools import partial
+from typing import Callable
+
+from object_detector_backend.util.exceptions import InvalidInputException
+
+# optional dependency of the xxhash algorithm: pip install xxhash
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# every algorithm gives 128 bit digests, 32 hex characters like the md5 checksums stored so far
+HASH_ALGORITHMS = ('md5', 'blake2b', 'xxhash')
+
+
+def get_hasher(algorithm: str = 'md5') -> Callable:
+    """Returns a factory of hashlib style objects with update() and hexdigest()
+    """
+    if algorithm == 'md5':
+        return hashlib.md5
+
+    if algorithm == 'blake2b':
+        return partial(hashlib.blake2b, digest_size=16)
+
+    if algorithm == 'xxhash':
+        if xxhash is None:
+            raise ImportError('xxhash content hashing requires the xxhash package to be installed')
+        return xxhash.xxh3_128
+
+    raise InvalidInputException(f"Hash algorithm must be one of {', '.join(HASH_ALGORITHMS)}")
+
+
+def checksum(content: bytes, algorithm: str = 'md5') -> str:
+    hasher = get_hasher(algorithm)()
+    hasher.update(content)
+    return hasher.hexdigest()
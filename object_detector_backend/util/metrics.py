@@ -0,0 +1,317 @@
+import bisect
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# upper bounds in seconds of histogram buckets, as used by prometheus client libraries
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help) of metrics recorded by the app
+METRICS = {
+    'http_requests_total': ('counter', 'Requests served by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Time spent serving requests by endpoint and method'),
+    'stage_duration_seconds': ('histogram', 'Time spent in each stage of request handling, i.e fetch, ingest or detect'),
+    'db_queries_total': ('counter', 'SQL statements executed by operation'),
+    'db_query_duration_seconds': ('histogram', 'Time spent executing SQL statements by operation'),
+    'blob_operations_total': ('counter', 'Blob store calls by operation'),
+    'blob_bytes_total': ('counter', 'Bytes written to and read from the blob store'),
+    'vision_call_duration_seconds': ('histogram', 'Latency of detector calls by source and method'),
+    'vision_errors_total': ('counter', 'Images detectors failed to annotate by source'),
+    'profiles_written_total': ('counter', 'Profiles dumped for slow requests'),
+    'db_pool_connections': ('gauge', 'Pooled database connections by state'),
+    'db_pool_wait_seconds_total': ('counter', 'Time callers waited to check out a database connection'),
+    'cache_requests_total': ('counter', 'Cache lookups by cache and result'),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Metrics():
+    """Thread safe registry of counters, gauges and histograms of this process,
+    rendered in the Prometheus text exposition format.
+    Each worker process keeps its own registry, registries of several workers
+    are combined through snapshots, see write_snapshot and collect
+    """
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, descriptions: dict = None):
+        self.buckets = tuple(buckets)
+        self.descriptions = dict(METRICS if descriptions is None else descriptions)
+        self._values: Dict[str, Dict[LabelKey, float]] = OrderedDict()
+        self._histograms: Dict[str, Dict[LabelKey, list]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """Sets a gauge, or a counter mirroring a total kept elsewhere
+        """
+        with self._lock:
+            self._values.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # bucket counts followed by the sum and count of observations
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [0] * len(self.buckets) + [0.0, 0]
+
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter or gauge, 0 if it was never recorded
+        """
+        with self._lock:
+            return self._values.get(name, {}).get(_label_key(labels), 0)
+
+    def count(self, name: str, **labels) -> int:
+        """Number of observations of a histogram
+        """
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_label_key(labels))
+            return histogram[-1] if histogram is not None else 0
+
+    def snapshot(self) -> dict:
+        """Json serializable copy of the recorded values
+        """
+        with self._lock:
+            return {
+                'values': {name: [[list(key), value] for key, value in series.items()]
+                           for name, series in self._values.items()},
+                'histograms': {name: [[list(key), list(histogram)] for key, histogram in series.items()]
+                               for name, series in self._histograms.items()},
+            }
+
+    def merge(self, snapshot: dict, gauge_labels: dict = None):
+        """Adds a snapshot of another registry with the same buckets, i.e of another worker process.
+        Counters and histograms are summed, gauges are kept apart under gauge_labels
+        or left out if gauge_labels is None
+        """
+        extra = _label_key(gauge_labels or {})
+        with self._lock:
+            for name, series in snapshot['values'].items():
+                gauge = self.descriptions.get(name, ('counter', None))[0] == 'gauge'
+                if gauge and gauge_labels is None:
+                    continue
+
+                values = self._values.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(tuple(pair) for pair in key)
+                    if gauge:
+                        key = tuple(sorted(key + extra))
+                    values[key] = values.get(key, 0) + value
+
+            for name, series in snapshot['histograms'].items():
+                histograms = self._histograms.setdefault(name, {})
+                for key, histogram in series:
+                    key = tuple(tuple(pair) for pair in key)
+                    existing = histograms.get(key)
+                    histograms[key] = histogram if existing is None else \
+                        [a + b for a, b in zip(existing, histogram)]
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in self._values.items():
+                lines.extend(self._header(name, 'counter'))
+                for key, value in series.items():
+                    lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+
+            for name, series in self._histograms.items():
+                lines.extend(self._header(name, 'histogram'))
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, bucket in zip(self.buckets, histogram):
+                        cumulative += bucket
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {histogram[-1]}")
+                    lines.append(f'{name}_sum{_format_labels(key)} {_format_value(histogram[-2])}')
+                    lines.append(f'{name}_count{_format_labels(key)} {histogram[-1]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name: str, default_type: str) -> List[str]:
+        metric_type, help = self.descriptions.get(name, (default_type, None))
+        header = [f'# HELP {name} {help}'] if help else []
+        return header + [f'# TYPE {name} {metric_type}']
+
+
+# registry of the process, shared like a logger so any module can record to it
+metrics = Metrics()
+
+def write_snapshot(directory: str, update: Callable = None):
+    """Writes the registry of this process to directory, where collect() in any worker reads it.
+    update is called right before, i.e to copy counters kept elsewhere into the registry
+    """
+    if update is not None:
+        update()
+
+    # readers never see a partially written snapshot
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(tmp_path, os.path.join(directory, f'metrics-{os.getpid()}.json'))
+
+
+def collect(directory: str) -> Metrics:
+    """Registry merging the snapshots of every worker process written to directory.
+    Counters and histograms are summed, including those of exited workers so totals
+    never go down, gauges are reported per running worker under a pid label
+    """
+    merged = Metrics(buckets=metrics.buckets, descriptions=metrics.descriptions)
+
+    for name in sorted(os.listdir(directory)):
+        if not(name.startswith('metrics-') and name.endswith('.json')):
+            continue
+
+        pid = int(name[len('metrics-'):-len('.json')])
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        merged.merge(snapshot, gauge_labels={'pid': pid} if _is_running(pid) else None)
+
+    return merged
+
+
+def clear_snapshots(directory: str):
+    """Removes snapshots of a previous server run, call before starting workers
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith('metrics-') and name.endswith('.json'):
+            os.remove(os.path.join(directory, name))
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RequestTrace():
+    """Time spent per stage and database queries of one request
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_query(self, seconds: float):
+        self.queries += 1
+        self.query_seconds += seconds
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, shown per request by browser developer tools
+        """
+        entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        if self.queries:
+            entries.append(f'db;desc="{self.queries} queries";dur={self.query_seconds * 1000:.1f}')
+
+        return ', '.join(entries)
+
+    def to_dict(self) -> dict:
+        return {
+            'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+            'queries': self.queries,
+            'query_seconds': round(self.query_seconds, 6),
+        }
+
+
+_trace = contextvars.ContextVar('request_trace', default=None)
+
+
+def start_trace() -> contextvars.Token:
+    return _trace.set(RequestTrace())
+
+
+def end_trace(token: contextvars.Token):
+    _trace.reset(token)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    """Trace of the request handled by this thread, None outside of requests, i.e in background jobs
+    """
+    return _trace.get()
+
+
+@contextmanager
+def timed(name: str, errors: str = None, trace: str = None, **labels):
+    """Observes seconds spent in the block in histogram name.
+    Exceptions raised in the block increment counter errors,
+    time is also added to the current request trace under trace
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            metrics.inc(errors, **labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe(name, elapsed, **labels)
+
+        request_trace = current_trace()
+        if trace is not None and request_trace is not None:
+            request_trace.add(trace, elapsed)
+
+
+def stage(name: str):
+    """Times a stage of request handling, usable as context manager or decorator
+    """
+    return timed('stage_duration_seconds', trace=name, stage=name)
+
+
+def observe_query(operation: str, seconds: float):
+    metrics.inc('db_queries_total', operation=operation)
+    metrics.observe('db_query_duration_seconds', seconds, operation=operation)
+
+    request_trace = current_trace()
+    if request_trace is not None:
+        request_trace.add_query(seconds)
+
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key: LabelKey) -> str:
+    if not(key):
+        return ''
+
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if not(isinstance(value, int)) else str(value)